@@ -0,0 +1,106 @@
+"""
+Throughput of eager vs. compiled (`--compile`) training steps on synthetic CIFAR-sized batches.
+
+Takes the options of train.py, e.g. from the repository root
+
+    python benchmarking/compile_benchmark.py --opt vasso-sgd --batch_size 64 --benchmark_steps 10
+
+and reports the images/s of every model in `--benchmark_models`, with and without compilation.
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from configs.defaulf_cfg import default_parser
+from models.build import build_model
+from solver.build import build_optimizer
+from utils.amp import AMP
+from utils.device import device
+from utils.engine import compile_train_step, select_train_step
+from utils.logger import Logger
+from utils.optimiser_based_selection import need_closure_fn
+from utils.seed import setup_seed
+
+
+class benchmark_parser(default_parser):
+    def benchmark_parser(self):
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument(
+            "--benchmark_models",
+            type=str,
+            nargs="+",
+            default=["resnet18", "wideresnet28x10"],
+        )
+        parser.add_argument(
+            "--benchmark_steps", type=int, default=10, help="Timed steps per run."
+        )
+        parser.add_argument(
+            "--benchmark_warmup",
+            type=int,
+            default=3,
+            help="Untimed steps per run, they include the compilation.",
+        )
+        return parser
+
+
+def images_per_second(args, compiled):
+    setup_seed(args)
+    model = build_model(args).to(device)
+    logger = Logger(args)
+    optimizer, _ = build_optimizer(args, model=model, logger=logger)
+    if compiled:
+        model = compile_train_step(model)
+    train_step = select_train_step(need_closure_fn(args))
+    criterion = torch.nn.CrossEntropyLoss()
+    amp = AMP(args)
+
+    images = torch.randn(args.batch_size, 3, 32, 32, device=device)
+    targets = torch.randint(0, args.n_classes, (args.batch_size,), device=device)
+    model.train()
+    for step in range(args.benchmark_warmup + args.benchmark_steps):
+        if step == args.benchmark_warmup:
+            if device != "cpu":
+                torch.cuda.synchronize()
+            start = time.time()
+        train_step(
+            model,
+            images,
+            targets,
+            criterion,
+            optimizer,
+            epoch=0,
+            step=step,
+            batch_idx=step,
+            train_data=None,
+            logger=logger,
+            amp=amp,
+        )
+    if device != "cpu":
+        torch.cuda.synchronize()
+    return args.benchmark_steps * args.batch_size / (time.time() - start)
+
+
+def main(args):
+    args.distributed = False
+    args.n_classes = 10
+    results = {}
+    # all eager runs first, compiling the step swaps the optimizer kernels for good
+    for compiled in [False, True]:
+        for model in args.benchmark_models:
+            args.model = model
+            results[model, compiled] = images_per_second(args, compiled)
+    for model in args.benchmark_models:
+        eager, compiled = results[model, False], results[model, True]
+        print(
+            f"{model} {args.opt}: eager {eager:.1f} images/s, "
+            f"compiled {compiled:.1f} images/s ({compiled / eager:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main(benchmark_parser().get_args())
@@ -0,0 +1,22 @@
+import argparse
+import os
+
+from data.mmap_cache import build_mmap_cache
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write the memory-mapped image cache read by `ImageNet_mmap`."
+    )
+    parser.add_argument("--datadir", type=str, required=True)
+    parser.add_argument("--splits", type=str, nargs="+", default=["train", "val"])
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    for split in args.splits:
+        build_mmap_cache(
+            os.path.join(args.datadir, split),
+            os.path.join(args.datadir, "mmap", split),
+            size=args.size,
+            num_workers=args.num_workers,
+        )
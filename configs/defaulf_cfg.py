@@ -1,4 +1,7 @@
 import argparse
+import shlex
+import sys
+
 from utils.device import dataset_directory
 
 
@@ -18,6 +21,19 @@ def wandb_parser(self):
             default="Default",
             help="Experiment name in wandb.",
         )
+        parser.add_argument(
+            "--log_flush_steps",
+            type=int,
+            default=100,
+            help="Number of steps whose batch metrics are buffered before they are sent to wandb.",
+        )
+        parser.add_argument(
+            "--metrics_backend",
+            type=str,
+            default="wandb",
+            choices=["wandb", "npz"],
+            help="Where batch/epoch/stage metrics go: wandb (with --wandb) or chunked .npz files in the log dir.",
+        )
         return parser
 
     def base_parser(self):
@@ -56,7 +72,7 @@ def base_parser(self):
         parser.add_argument(
             "--performance_scores_mode",
             action="store_true",
-            help="Performance Scores Mode: for correct inner forward pass loss calc even if forward pass is not needed",
+            help="Performance Scores Mode: log the inner loss at w every step, estimated to first order on steps that reuse the perturbation",
         )
         parser.add_argument(
             "--logging_mode",
@@ -64,11 +80,71 @@ def base_parser(self):
             help="If we need console, output file logging, and in general a logger",
         )
 
+        parser.add_argument(
+            "--amp",
+            type=str,
+            default="none",
+            choices=["none", "bf16", "fp16"],
+            help="Mixed precision: bf16 autocast, or fp16 autocast with dynamic loss scaling.",
+        )
+        parser.add_argument(
+            "--compile",
+            action="store_true",
+            help="torch.compile the forward/backward pass and the perturbation kernels of the SAM family.",
+        )
+        parser.add_argument(
+            "--profile_steps",
+            action="store_true",
+            help="Time the phases of every training step (data, inner/outer fwd/bwd, first/second step, logging); percentiles go to the results csv.",
+        )
+        parser.add_argument(
+            "--pack",
+            type=str,
+            nargs="+",
+            default=[],
+            help='Train one replica per entry in this process, on the same batches. Every entry overrides options of the command line, e.g. --pack "seed=42 crt_k=2" "seed=1234 crt_k=5".',
+        )
+
         parser.add_argument("--start_epoch", type=int, default=0)
         parser.add_argument(
             "--epochs", type=int, default=200, help="Epochs of training."
         )
         parser.add_argument("--dataset_nn_combination", type=str)
+        parser.add_argument(
+            "--hessian_samples",
+            type=int,
+            default=2048,
+            help="Training images (without augmentation) for the Hessian spectrum at the end of training, 0 to skip it.",
+        )
+        parser.add_argument(
+            "--hessian_iters",
+            type=int,
+            default=30,
+            help="Maximum number of Lanczos iterations for the Hessian spectrum.",
+        )
+        parser.add_argument(
+            "--hessian_tol",
+            type=float,
+            default=1e-3,
+            help="Relative residual at which the top Hessian eigenvalues count as converged.",
+        )
+        parser.add_argument(
+            "--sharpness_every",
+            type=int,
+            default=0,
+            help="Probe the top Hessian eigenvalue every N steps of a SAM-type optimizer (0: off), e.g. 100.",
+        )
+        parser.add_argument(
+            "--sharpness_iters",
+            type=int,
+            default=2,
+            help="Warm-started power iterations per sharpness probe, each costs one forward/backward pass.",
+        )
+        parser.add_argument(
+            "--hessian_retain_graphs",
+            action="store_true",
+            help="Keep the gradient graphs of the Hessian subsample across Hessian-vector products (faster, more memory).",
+        )
         parser.add_argument(
             "--exclusive_run",
             action="store_true",
@@ -83,6 +159,26 @@ def dist_parser(self):
             default="env://",
             help="url used to set up distributed training",
         )
+        parser.add_argument(
+            "--dist_backend",
+            type=str,
+            default="auto",
+            choices=["auto", "nccl", "gloo"],
+            help="Backend of torch.distributed, auto picks nccl on CUDA and gloo otherwise.",
+        )
+        parser.add_argument(
+            "--threads_per_process",
+            type=int,
+            default=0,
+            help="Torch threads of every process in distributed CPU runs, 0 splits the cores evenly.",
+        )
+        parser.add_argument(
+            "--dist_sam",
+            type=str,
+            default="sync",
+            choices=["sync", "local", "norm"],
+            help="Inner pass of SAM type optims under DDP: all-reduced gradient (sync), local-batch perturbation (local), or local-batch perturbation with all-reduced norm (norm).",
+        )
         return parser
 
     def data_parser(self):
@@ -113,6 +209,27 @@ def data_parser(self):
             help="Number of CPU threads for dataloaders.",
         )
         parser.add_argument("--pin_memory", action="store_true", default=True)
+        parser.add_argument(
+            "--persistent_workers",
+            action="store_true",
+            help="Keep the DataLoader workers alive across epochs.",
+        )
+        parser.add_argument(
+            "--prefetch_factor",
+            type=int,
+            default=2,
+            help="Number of batches loaded in advance by each worker.",
+        )
+        parser.add_argument(
+            "--auto_tune_loader",
+            action="store_true",
+            help="Pick num_workers and prefetch_factor from the data wait of the first epoch.",
+        )
+        parser.add_argument(
+            "--prefetch",
+            action="store_true",
+            help="Copy the next batch to the device while the current one is processed, and normalise the uint8 images on device.",
+        )
         parser.add_argument("--drop_last", action="store_true", default=True)
         parser.add_argument(
             "--distributed_val",
@@ -166,6 +283,16 @@ def sam_opt_parser(self):
         parser.add_argument(
             "--theta", type=float, default=0.4, help="Moving average for VASSO"
         )
+        parser.add_argument(
+            "--flat_state",
+            action="store_true",
+            help="Keep parameters and VaSSO state in one contiguous buffer per dtype/device",
+        )
+        parser.add_argument(
+            "--shard_state",
+            action="store_true",
+            help="In distributed runs, every process only keeps its slice of the VaSSO and base optimizer state",
+        )
 
         # Criteria for making SAM efficient
         parser.add_argument(
@@ -230,6 +357,12 @@ def sam_opt_parser(self):
             default=0,
             help="Check if cosSim criterion >0 or <0 (False)",
         )
+        parser.add_argument(
+            "--crt_lag",
+            type=int,
+            default=0,
+            help="gSAM*/cosSim: decide re-use from the criterion statistics of this many steps earlier, so reading them back never stalls the device",
+        )
         return parser
 
     def lr_scheduler_parser(self):
@@ -259,7 +392,42 @@ def model_parser(self):
         )
         return parser
 
-    def get_args(self):
+    def get_args(self, argv=None):
+        final_parser = self._final_parser()
+        args = final_parser.parse_args(argv)
+        self.auto_set_name(args)
+        return args
+
+    def pack_overrides(self, args, argv=None):
+        """
+        The options of every replica of `--pack` that differ from the command line, output_name included.
+        The data pipeline, the distributed setup and the epochs are shared by all replicas.
+        """
+        argv = sys.argv[1:] if argv is None else argv
+        shared = {"epochs", "start_epoch", "pack"}
+        for parser in [self.data_parser(), self.dist_parser()]:
+            shared |= set(vars(parser.parse_args([])))
+        assert not (
+            args.wandb and args.metrics_backend == "wandb"
+        ), "--pack needs `--metrics_backend npz`, one process holds one wandb run"
+
+        pack_overrides = []
+        for i, entry in enumerate(args.pack):
+            keys, pack_argv = [], []
+            for override in shlex.split(entry):
+                key, _, value = override.partition("=")
+                assert key not in shared, f"--pack cannot override the shared option {key}"
+                keys.append(key)
+                # `key` alone switches on a flag
+                pack_argv.extend(["--" + key] + ([value] if value else []))
+            replica = self.get_args(argv + pack_argv)
+            overrides = {key: getattr(replica, key) for key in keys}
+            overrides["output_name"] = f"{replica.output_name}_pack{i}"
+            overrides["wandb_name"] = f"{replica.wandb_name}_pack{i}"
+            pack_overrides.append(overrides)
+        return pack_overrides
+
+    def _final_parser(self):
         all_parser_funcs = []
         for func_or_attr in dir(self):
             if (
@@ -270,10 +438,7 @@ def get_args(self):
                 all_parser_funcs.append(getattr(self, func_or_attr))
         all_parsers = [parser_func() for parser_func in all_parser_funcs]
 
-        final_parser = argparse.ArgumentParser(parents=all_parsers)
-        args = final_parser.parse_args()
-        self.auto_set_name(args)
-        return args
+        return argparse.ArgumentParser(parents=all_parsers)
 
     def auto_set_name(self, args):
         def reuse_naming(args, output_name):
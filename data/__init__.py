@@ -4,5 +4,10 @@
     CIFAR10_cutout,
     CIFAR100_base,
     CIFAR100_cutout,
+    CIFAR10_gpu,
+    CIFAR10_cutout_gpu,
+    CIFAR100_gpu,
+    CIFAR100_cutout_gpu,
     ImageNet_base,
+    ImageNet_mmap,
 )
\ No newline at end of file
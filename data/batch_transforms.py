@@ -0,0 +1,119 @@
+"""
+Augmentations on whole `[B, C, H, W]` batches, drawing all their randomness from one `torch.Generator`.
+They run wherever the batch lives: on device for `DeviceDataset`, or on the host at collate time.
+"""
+import torch
+import torch.nn.functional as F
+from torch.utils.data import default_collate, get_worker_info
+
+
+class BatchCompose:
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, images, generator=None):
+        for t in self.transforms:
+            images = t(images, generator)
+        return images
+
+
+class BatchRandomCrop:
+    """
+    Zero-pads every image by `padding` and crops a random `size` window per image.
+    """
+
+    def __init__(self, size, padding=0):
+        self.size = (size, size) if isinstance(size, int) else tuple(size)
+        self.padding = padding
+
+    def __call__(self, images, generator=None):
+        b, device = images.size(0), images.device
+        h, w = self.size
+        padded = F.pad(images, [self.padding] * 4)
+        top = torch.randint(
+            padded.size(2) - h + 1, (b, 1), generator=generator, device=device
+        )
+        left = torch.randint(
+            padded.size(3) - w + 1, (b, 1), generator=generator, device=device
+        )
+        rows = (top + torch.arange(h, device=device))[:, :, None]
+        cols = (left + torch.arange(w, device=device))[:, None, :]
+        batch = torch.arange(b, device=device)[:, None, None]
+        # advanced indexing moves the channel dimension to the back
+        return padded.permute(0, 2, 3, 1)[batch, rows, cols].permute(0, 3, 1, 2)
+
+
+class BatchRandomHorizontalFlip:
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, images, generator=None):
+        flip = (
+            torch.rand(images.size(0), generator=generator, device=images.device)
+            < self.p
+        )
+        return torch.where(flip[:, None, None, None], images.flip(3), images)
+
+
+class BatchNormalize:
+    """
+    uint8 images to normalised float images, i.e. `ToTensor` followed by `Normalize`.
+    """
+
+    def __init__(self, mean, std):
+        self.mean = torch.as_tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = torch.as_tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+
+    def __call__(self, images, generator=None):
+        if self.mean.device != images.device:
+            self.mean = self.mean.to(images.device)
+            self.std = self.std.to(images.device)
+        images = images.float()
+        images = images / 255.0
+        return (images - self.mean) / self.std
+
+
+class BatchCutout:
+    """
+    With probability `p`, zeroes a `size` x `size` box (clipped at the border) around a random centre of every image.
+    """
+
+    def __init__(self, size=16, p=0.5):
+        self.size = size
+        self.p = p
+
+    def __call__(self, images, generator=None):
+        b, _, h, w = images.shape
+        device = images.device
+        apply = torch.rand(b, 1, generator=generator, device=device) <= self.p
+        y = torch.randint(h, (b, 1), generator=generator, device=device)
+        x = torch.randint(w, (b, 1), generator=generator, device=device)
+
+        rows = torch.arange(h, device=device)
+        cols = torch.arange(w, device=device)
+        in_rows = (rows >= y - self.size // 2) & (rows < y + self.size // 2) & apply
+        in_cols = (cols >= x - self.size // 2) & (cols < x + self.size // 2)
+        box = in_rows[:, :, None] & in_cols[:, None, :]
+        return images * (~box)[:, None].to(images.dtype)
+
+
+class BatchTransformCollate:
+    """
+    `default_collate` followed by a batch transform of the images.
+    Inside DataLoader workers the generator is reseeded from the worker seed, so workers do not repeat each other.
+    """
+
+    def __init__(self, transform, seed=None):
+        self.transform = transform
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        self._worker_id = None
+
+    def __call__(self, batch):
+        info = get_worker_info()
+        if info is not None and self._worker_id != info.id:
+            self._worker_id = info.id
+            self.generator.manual_seed(info.seed)
+        images, targets = default_collate(batch)
+        return self.transform(images, self.generator), targets
@@ -1,9 +1,18 @@
+import math
+import os
+import random
+
+import numpy as np
 import torch
 from torch.utils.data import RandomSampler, DistributedSampler, SequentialSampler
 
 from utils.configurable import configurable
 from utils.register import Registry
 from utils.dist import get_world_size, get_rank
+from data.batch_transforms import BatchCompose, BatchTransformCollate
+from data.device_dataset import DeviceDataset, DeviceDataLoader
+from data.prefetch_loader import PrefetchLoader
+from utils.device import device
 
 DATASET_REGISTRY = Registry("Datasets")
 
@@ -24,6 +33,10 @@ def _cfg_to_trainloader(args):
         "distributed": args.distributed,
         "world_size": get_world_size(),
         "rank": get_rank(),
+        "seed": args.seed,
+        "prefetch": args.prefetch,
+        "persistent_workers": args.persistent_workers,
+        "prefetch_factor": args.prefetch_factor,
     }
 
 
@@ -38,7 +51,27 @@ def build_train_dataloader(
     distributed: bool,
     world_size: int,
     rank: int,
+    seed: int = None,
+    prefetch: bool = False,
+    persistent_workers: bool = False,
+    prefetch_factor: int = 2,
+    epoch: int = 0,
 ):
+    """
+    `epoch` is the first epoch the loader serves: a loader rebuilt during training (`--auto_tune_loader`)
+    seeds its workers and augmentations differently from the one it replaces, instead of replaying its epochs.
+    """
+    if isinstance(train_dataset, DeviceDataset):
+        return DeviceDataLoader(
+            train_dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            drop_last=drop_last,
+            seed=seed,
+            num_replicas=world_size if distributed else 1,
+            rank=rank if distributed else 0,
+        )
+
     if distributed:
         sampler = DistributedSampler(
             train_dataset, num_replicas=world_size, rank=rank, shuffle=True
@@ -46,6 +79,27 @@ def build_train_dataloader(
     else:
         sampler = RandomSampler(train_dataset)
 
+    collate_fn = None
+    batch_transform = getattr(train_dataset, "batch_transform", None)
+    device_transform = getattr(train_dataset, "device_transform", None)
+    if prefetch and device_transform is not None and batch_transform is not None:
+        # e.g. Cutout has to follow the normalisation, which now happens on device
+        device_transform = BatchCompose([device_transform, batch_transform])
+        batch_transform = None
+    # distinct for every rank and every rebuild; the epoch is spread by a large odd constant so that it does not
+    # collide with the seeds of other runs (the CPU generator only keeps the low 32 bits)
+    loader_seed = None
+    if seed is not None:
+        loader_seed = (seed + rank + epoch * 0x9E3779B1) % 2**32
+    if batch_transform is not None:
+        collate_fn = BatchTransformCollate(batch_transform, seed=loader_seed)
+
+    generator = None
+    if seed is not None:
+        # fixes the worker seeds, and with them the augmentations
+        generator = torch.Generator()
+        generator.manual_seed(loader_seed)
+
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
         sampler=sampler,
@@ -53,10 +107,37 @@ def build_train_dataloader(
         num_workers=num_workers,
         pin_memory=pin_memory,
         drop_last=drop_last,
+        collate_fn=collate_fn,
+        generator=generator,
+        **_worker_kwargs(num_workers, persistent_workers, prefetch_factor),
     )
+    if prefetch:
+        return PrefetchLoader(
+            train_loader,
+            device,
+            transform=device_transform,
+            seed=loader_seed,
+        )
     return train_loader
 
 
+def _seed_worker(worker_id):
+    # torch seeds every worker, numpy and random have to follow
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+def _worker_kwargs(num_workers, persistent_workers, prefetch_factor):
+    if num_workers == 0:
+        return {}
+    return {
+        "persistent_workers": persistent_workers,
+        "prefetch_factor": prefetch_factor,
+        "worker_init_fn": _seed_worker,
+    }
+
+
 def build_full_train_dataloader(train_dataset):
     dataset_size = len(train_dataset)
     train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=dataset_size)
@@ -72,6 +153,9 @@ def _cfg_to_valloader(args):
         "distributed_val": args.distributed_val,
         "world_size": get_world_size(),
         "rank": get_rank(),
+        "prefetch": args.prefetch,
+        "persistent_workers": args.persistent_workers,
+        "prefetch_factor": args.prefetch_factor,
     }
 
 
@@ -86,7 +170,21 @@ def build_val_dataloader(
     distributed_val: bool,
     world_size: int,
     rank: int,
+    prefetch: bool = False,
+    persistent_workers: bool = False,
+    prefetch_factor: int = 2,
 ):
+    if isinstance(val_dataset, DeviceDataset):
+        sharded = distributed and distributed_val
+        return DeviceDataLoader(
+            val_dataset,
+            batch_size=batch_size,
+            shuffle=False,
+            drop_last=False,
+            num_replicas=world_size if sharded else 1,
+            rank=rank if sharded else 0,
+        )
+
     if distributed and distributed_val:
         if len(val_dataset) % world_size != 0:
             print(
@@ -107,5 +205,43 @@ def build_val_dataloader(
         num_workers=num_workers,
         pin_memory=pin_memory,
         drop_last=False,
+        **_worker_kwargs(num_workers, persistent_workers, prefetch_factor),
     )
+    if prefetch:
+        return PrefetchLoader(
+            val_loader, device, transform=getattr(val_dataset, "device_transform", None)
+        )
     return val_loader
+
+
+# data wait (% of the epoch) below which the loader is left as it is
+AUTOTUNE_DATA_WAIT = 2.0
+# extra workers on top of the estimate, for the fluctuations of the loading time
+AUTOTUNE_HEADROOM = 1.25
+
+
+def autotune_loader(args, train_stats):
+    """
+    Picks `num_workers` and `prefetch_factor` from the data wait measured in the first epoch
+    (see `train_one_epoch`) and writes them into `args`. Returns whether they changed.
+
+    In the steady state of a data-bound epoch, the workers together take `epoch_time` to load the epoch,
+    i.e. one worker would need `num_workers * epoch_time`. Hiding that behind the compute time
+    `epoch_time - data_wait` needs about `num_workers * epoch_time / (epoch_time - data_wait)` workers.
+    """
+    if train_stats["data_wait (%)"] < AUTOTUNE_DATA_WAIT:
+        return False
+    data_wait = train_stats["data_wait (s)"]
+    epoch_time = 100 * data_wait / train_stats["data_wait (%)"]
+    # without workers, the loading is serial and shows up in full as data wait
+    load_time = data_wait if args.num_workers == 0 else args.num_workers * epoch_time
+    compute_time = max(epoch_time - data_wait, 1e-6)
+    num_workers = math.ceil(AUTOTUNE_HEADROOM * load_time / compute_time)
+    # more workers than cores do not help, but never drop below the workers that were still too few
+    num_workers = max(1, args.num_workers, min(num_workers, os.cpu_count() or 1))
+    # deeper queues to ride out slow batches, e.g. when the number of workers is capped
+    prefetch_factor = max(args.prefetch_factor, 4)
+    changed = (num_workers, prefetch_factor) != (args.num_workers, args.prefetch_factor)
+    args.num_workers = num_workers
+    args.prefetch_factor = prefetch_factor
+    return changed
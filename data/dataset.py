@@ -4,14 +4,53 @@
 import numpy as np
 
 from utils.configurable import configurable
+from utils.device import device
 from data.build import DATASET_REGISTRY
+from data.batch_transforms import (
+    BatchCompose,
+    BatchCutout,
+    BatchNormalize,
+    BatchRandomCrop,
+    BatchRandomHorizontalFlip,
+)
+from data.device_dataset import DeviceDataset
+from data.mmap_cache import MmapImageDataset
+
+
+def _to_tensor(dataset, from_pil=True):
+    """
+    Final per-sample transforms: to a normalised float tensor, or only to a uint8 tensor
+    if the normalisation runs on device, see `_normalize_on_device`.
+    """
+    if dataset.normalize_on_device:
+        return [torchvision.transforms.PILToTensor()] if from_pil else []
+    if from_pil:
+        return [
+            torchvision.transforms.ToTensor(),
+            torchvision.transforms.Normalize(dataset.mean, dataset.std),
+        ]
+    return [
+        torchvision.transforms.ConvertImageDtype(torch.float),
+        torchvision.transforms.Normalize(dataset.mean, dataset.std),
+    ]
+
+
+def _normalize_on_device(dataset, train_data, val_data):
+    """
+    With `--prefetch`, the loaders normalise the uint8 batches on device, cf. `data.prefetch_loader`.
+    """
+    if dataset.normalize_on_device:
+        for data in [train_data, val_data]:
+            data.device_transform = BatchNormalize(dataset.mean, dataset.std)
+    return train_data, val_data
 
 
 @DATASET_REGISTRY.register()
 class CIFAR10_base:
     @configurable
-    def __init__(self, datadir) -> None:
+    def __init__(self, datadir, normalize_on_device=False) -> None:
         self.datadir = datadir
+        self.normalize_on_device = normalize_on_device
 
         self.n_classes = 10
         self.mean = np.array([125.3, 123.0, 113.9]) / 255.0
@@ -21,6 +60,7 @@ def __init__(self, datadir) -> None:
     def from_config(cls, args):
         return {
             "datadir": args.datadir,
+            "normalize_on_device": args.prefetch,
         }
 
     def get_data(self):
@@ -36,15 +76,14 @@ def get_data(self):
             transform=self._test_transform(),
             download=True,
         )
-        return train_data, val_data
+        return _normalize_on_device(self, train_data, val_data)
 
     def _train_transform(self):
         train_transform = torchvision.transforms.Compose(
             [
                 torchvision.transforms.RandomCrop(size=(32, 32), padding=4),
                 torchvision.transforms.RandomHorizontalFlip(),
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Normalize(self.mean, self.std),
+                *_to_tensor(self),
                 # Cutout()
             ]
         )
@@ -53,8 +92,7 @@ def _train_transform(self):
     def _test_transform(self):
         test_transform = torchvision.transforms.Compose(
             [
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Normalize(self.mean, self.std),
+                *_to_tensor(self),
             ]
         )
         return test_transform
@@ -62,24 +100,19 @@ def _test_transform(self):
 
 @DATASET_REGISTRY.register()
 class CIFAR10_cutout(CIFAR10_base):
-    def _train_transform(self):
-        train_transform = torchvision.transforms.Compose(
-            [
-                torchvision.transforms.RandomCrop(size=(32, 32), padding=4),
-                torchvision.transforms.RandomHorizontalFlip(),
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Normalize(self.mean, self.std),
-                Cutout(size=16, p=0.5),
-            ]
-        )
-        return train_transform
+    def get_data(self):
+        train_data, val_data = super().get_data()
+        # applied to whole batches at collate time, see `build_train_dataloader`
+        train_data.batch_transform = BatchCutout(size=16, p=0.5)
+        return train_data, val_data
 
 
 @DATASET_REGISTRY.register()
 class CIFAR100_base:
     @configurable
-    def __init__(self, datadir) -> None:
+    def __init__(self, datadir, normalize_on_device=False) -> None:
         self.datadir = datadir
+        self.normalize_on_device = normalize_on_device
 
         self.n_classes = 100
         self.mean = np.array([125.3, 123.0, 113.9]) / 255.0
@@ -89,6 +122,7 @@ def __init__(self, datadir) -> None:
     def from_config(cls, args):
         return {
             "datadir": args.datadir,
+            "normalize_on_device": args.prefetch,
         }
 
     def get_data(self):
@@ -104,15 +138,14 @@ def get_data(self):
             transform=self._test_transform(),
             download=True,
         )
-        return train_data, val_data
+        return _normalize_on_device(self, train_data, val_data)
 
     def _train_transform(self):
         train_transform = torchvision.transforms.Compose(
             [
                 torchvision.transforms.RandomCrop(size=(32, 32), padding=4),
                 torchvision.transforms.RandomHorizontalFlip(),
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Normalize(self.mean, self.std),
+                *_to_tensor(self),
                 # Cutout()
             ]
         )
@@ -121,8 +154,7 @@ def _train_transform(self):
     def _test_transform(self):
         test_transform = torchvision.transforms.Compose(
             [
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Normalize(self.mean, self.std),
+                *_to_tensor(self),
             ]
         )
         return test_transform
@@ -130,24 +162,70 @@ def _test_transform(self):
 
 @DATASET_REGISTRY.register()
 class CIFAR100_cutout(CIFAR100_base):
-    def _train_transform(self):
-        train_transform = torchvision.transforms.Compose(
-            [
-                torchvision.transforms.RandomCrop(size=(32, 32), padding=4),
-                torchvision.transforms.RandomHorizontalFlip(),
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Normalize(self.mean, self.std),
-                Cutout(size=16, p=0.5),
-            ]
+    def get_data(self):
+        train_data, val_data = super().get_data()
+        # applied to whole batches at collate time, see `build_train_dataloader`
+        train_data.batch_transform = BatchCutout(size=16, p=0.5)
+        return train_data, val_data
+
+
+class _DeviceResident:
+    """
+    Keeps the whole uint8 dataset in device memory and augments it per minibatch, see `data.device_dataset`.
+    """
+
+    cutout = False
+
+    def get_data(self):
+        train_data, val_data = super().get_data()
+        train_data = DeviceDataset.from_torchvision(
+            train_data, self._device_train_transform(), device
         )
-        return train_transform
+        val_data = DeviceDataset.from_torchvision(
+            val_data, self._device_test_transform(), device
+        )
+        return train_data, val_data
+
+    def _device_train_transform(self):
+        transforms = [
+            BatchRandomCrop(size=(32, 32), padding=4),
+            BatchRandomHorizontalFlip(),
+            BatchNormalize(self.mean, self.std),
+        ]
+        if self.cutout:
+            transforms.append(BatchCutout(size=16, p=0.5))
+        return BatchCompose(transforms)
+
+    def _device_test_transform(self):
+        return BatchCompose([BatchNormalize(self.mean, self.std)])
+
+
+@DATASET_REGISTRY.register()
+class CIFAR10_gpu(_DeviceResident, CIFAR10_base):
+    pass
+
+
+@DATASET_REGISTRY.register()
+class CIFAR10_cutout_gpu(_DeviceResident, CIFAR10_base):
+    cutout = True
+
+
+@DATASET_REGISTRY.register()
+class CIFAR100_gpu(_DeviceResident, CIFAR100_base):
+    pass
+
+
+@DATASET_REGISTRY.register()
+class CIFAR100_cutout_gpu(_DeviceResident, CIFAR100_base):
+    cutout = True
 
 
 @DATASET_REGISTRY.register()
 class ImageNet_base:
     @configurable
-    def __init__(self, datadir) -> None:
+    def __init__(self, datadir, normalize_on_device=False) -> None:
         self.datadir = datadir
+        self.normalize_on_device = normalize_on_device
 
         self.n_classes = 1000
         self.mean = np.array([0.485, 0.456, 0.406])
@@ -157,6 +235,7 @@ def __init__(self, datadir) -> None:
     def from_config(cls, args):
         return {
             "datadir": args.datadir,
+            "normalize_on_device": args.prefetch,
         }
 
     def get_data(self):
@@ -166,15 +245,14 @@ def get_data(self):
         val_dataset = torchvision.datasets.ImageFolder(
             root=self.datadir + "/val", transform=self._test_transform()
         )
-        return train_dataset, val_dataset
+        return _normalize_on_device(self, train_dataset, val_dataset)
 
     def _train_transform(self):
         train_transform = torchvision.transforms.Compose(
             [
                 torchvision.transforms.RandomResizedCrop(224),
                 torchvision.transforms.RandomHorizontalFlip(),
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Normalize(self.mean, self.std),
+                *_to_tensor(self),
                 # Cutout()
             ]
         )
@@ -185,35 +263,45 @@ def _test_transform(self):
             [
                 torchvision.transforms.Resize(256),
                 torchvision.transforms.CenterCrop(224),
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Normalize(self.mean, self.std),
+                *_to_tensor(self),
             ]
         )
         return test_transform
 
 
-class Cutout(object):
-    def __init__(self, size=16, p=0.5):
-        self.size = size
-        self.p = p
-
-    def __call__(self, image):
-        if torch.rand([1]).item() > self.p:
-            return image
-
-        h, w = image.size(1), image.size(2)
-        mask = np.ones((h, w), np.float32)
+@DATASET_REGISTRY.register()
+class ImageNet_mmap(ImageNet_base):
+    """
+    ImageNet read from the pre-decoded cache in `<datadir>/mmap`, see `data.mmap_cache`.
+    The transforms work on the cached uint8 tensors instead of PIL images.
+    """
 
-        x = np.random.randint(w)
-        y = np.random.randint(h)
+    def get_data(self):
+        train_dataset = MmapImageDataset(
+            self.datadir + "/mmap/train", transform=self._train_transform()
+        )
+        val_dataset = MmapImageDataset(
+            self.datadir + "/mmap/val", transform=self._test_transform()
+        )
+        return _normalize_on_device(self, train_dataset, val_dataset)
 
-        y1 = np.clip(y - self.size // 2, 0, h)
-        y2 = np.clip(y + self.size // 2, 0, h)
-        x1 = np.clip(x - self.size // 2, 0, w)
-        x2 = np.clip(x + self.size // 2, 0, w)
+    def _train_transform(self):
+        train_transform = torchvision.transforms.Compose(
+            [
+                torchvision.transforms.RandomResizedCrop(224, antialias=True),
+                torchvision.transforms.RandomHorizontalFlip(),
+                *_to_tensor(self, from_pil=False),
+            ]
+        )
+        return train_transform
 
-        mask[y1:y2, x1:x2] = 0.0
-        mask = torch.from_numpy(mask)
-        mask = mask.expand_as(image)
-        image = image * mask
-        return image
+    def _test_transform(self):
+        # the cache holds the images with their shorter side resized (to 256 by default), the resize is then a no-op
+        test_transform = torchvision.transforms.Compose(
+            [
+                torchvision.transforms.Resize(256, antialias=True),
+                torchvision.transforms.CenterCrop(224),
+                *_to_tensor(self, from_pil=False),
+            ]
+        )
+        return test_transform
@@ -0,0 +1,104 @@
+"""
+Datasets that live entirely in device memory, with augmentations applied per minibatch.
+
+`DeviceDataset` keeps the raw uint8 images as one `[N, C, H, W]` tensor on the target device and
+`DeviceDataLoader` slices minibatches out of it, so there are no DataLoader workers and no
+host-to-device copies during training. Augmentations are the batched transforms
+from `data.batch_transforms`.
+"""
+import math
+
+import torch
+
+
+class DeviceDataset:
+    def __init__(self, images, targets, transform=None):
+        assert images.size(0) == targets.size(0)
+        self.images = images
+        self.targets = targets
+        self.transform = transform
+
+    @classmethod
+    def from_torchvision(cls, dataset, transform, device):
+        """
+        From a torchvision dataset keeping its images as a `[N, H, W, C]` uint8 array in `data`, e.g. CIFAR.
+        """
+        images = torch.as_tensor(dataset.data).permute(0, 3, 1, 2).contiguous()
+        targets = torch.as_tensor(dataset.targets, dtype=torch.long)
+        return cls(images.to(device), targets.to(device), transform)
+
+    def __len__(self):
+        return self.images.size(0)
+
+    def get_batch(self, indices, generator=None):
+        images = self.images[indices]
+        if self.transform is not None:
+            images = self.transform(images, generator)
+        return images, self.targets[indices]
+
+
+class DeviceDataLoader:
+    """
+    Minibatches of a `DeviceDataset`, shuffled (and sharded across ranks) like `RandomSampler`/`DistributedSampler`.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size,
+        shuffle,
+        drop_last,
+        seed=0,
+        num_replicas=1,
+        rank=0,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = 0 if seed is None else seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.num_samples = math.ceil(len(dataset) / num_replicas)
+
+        # augmentations differ across ranks, the shuffling order has to agree
+        device = dataset.images.device
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(self.seed + rank)
+        self.shuffle_generator = torch.Generator(device=device)
+
+        # `train.py` calls `train_loader.sampler.set_epoch` in distributed runs
+        self.sampler = self
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return math.ceil(self.num_samples / self.batch_size)
+
+    def _indices(self):
+        device = self.dataset.images.device
+        n = len(self.dataset)
+        if not self.shuffle:
+            indices = torch.arange(n, device=device)
+        elif self.num_replicas > 1:
+            self.shuffle_generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(n, generator=self.shuffle_generator, device=device)
+        else:
+            indices = torch.randperm(n, generator=self.generator, device=device)
+
+        if self.num_replicas > 1:
+            # pad to a multiple of the number of replicas and shard, as `DistributedSampler`
+            total_size = self.num_samples * self.num_replicas
+            indices = torch.cat([indices, indices[: total_size - n]])
+            indices = indices[self.rank : total_size : self.num_replicas]
+        return indices
+
+    def __iter__(self):
+        indices = self._indices()
+        for i in range(len(self)):
+            batch = indices[i * self.batch_size : (i + 1) * self.batch_size]
+            yield self.dataset.get_batch(batch, self.generator)
@@ -0,0 +1,126 @@
+"""
+Pre-decoded, memory-mapped image cache for ImageFolder datasets such as ImageNet.
+
+Build it once per split, e.g.
+
+    python build_mmap_cache.py --datadir [path to ImageNet] --size 256 --num_workers 8
+
+which decodes every image of `<datadir>/{train,val}`, resizes its shorter side to `size` (keeping the aspect ratio,
+without cropping, so that `RandomResizedCrop` samples from the whole image as with the JPEGs) and writes to
+`<datadir>/mmap/{train,val}`:
+    images.bin   uint8, the `[3, H, W]` images one after the other
+    offsets.npy  int64 `[N]`, where every image starts in `images.bin`
+    shapes.npy   int64 `[N, 2]`, `(H, W)` of every image
+    labels.npy   int64 `[N]`
+    index.json   format version, number of images, short side and class names
+`MmapImageDataset` then reads images as copy-on-write slices of the memory map, without any decoding.
+"""
+import json
+import os
+
+import numpy as np
+import torch
+import torchvision.datasets
+import torchvision.transforms
+
+CACHE_VERSION = 2
+
+
+def _as_list(batch):
+    # the images differ in size, so they are not stacked
+    return batch
+
+
+def build_mmap_cache(image_folder, out_dir, size=256, num_workers=8, batch_size=256):
+    dataset = torchvision.datasets.ImageFolder(
+        root=image_folder,
+        transform=torchvision.transforms.Compose(
+            [
+                torchvision.transforms.Resize(size),
+                torchvision.transforms.PILToTensor(),
+            ]
+        ),
+    )
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        shuffle=False,
+        collate_fn=_as_list,
+    )
+
+    os.makedirs(out_dir, exist_ok=True)
+    offsets = np.empty(len(dataset), dtype=np.int64)
+    shapes = np.empty((len(dataset), 2), dtype=np.int64)
+    labels = np.empty(len(dataset), dtype=np.int64)
+    i, offset = 0, 0
+    with open(os.path.join(out_dir, "images.bin"), "wb") as f:
+        for batch in loader:
+            for image, label in batch:
+                f.write(image.numpy().tobytes())
+                offsets[i] = offset
+                shapes[i] = image.shape[1:]
+                labels[i] = label
+                offset += image.numel()
+                i += 1
+    np.save(os.path.join(out_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(out_dir, "shapes.npy"), shapes)
+    np.save(os.path.join(out_dir, "labels.npy"), labels)
+
+    # written last, so an interrupted build is never mistaken for a complete cache
+    with open(os.path.join(out_dir, "index.json"), "w") as f:
+        json.dump(
+            {
+                "version": CACHE_VERSION,
+                "n": len(dataset),
+                "size": size,
+                "classes": dataset.classes,
+            },
+            f,
+        )
+
+
+class MmapImageDataset(torch.utils.data.Dataset):
+    """
+    Dataset over a cache written by `build_mmap_cache`, yielding `(transform(uint8 [3, H, W] tensor), label)`.
+    """
+
+    def __init__(self, cache_dir, transform=None):
+        index_file = os.path.join(cache_dir, "index.json")
+        if not os.path.exists(index_file):
+            raise FileNotFoundError(
+                f"No image cache in {cache_dir}, build it with `python build_mmap_cache.py`."
+            )
+        with open(index_file) as f:
+            index = json.load(f)
+        if index.get("version") != CACHE_VERSION:
+            # the first format held center crops, which narrow down the augmentation
+            raise ValueError(
+                f"Outdated image cache in {cache_dir}, rebuild it with `python build_mmap_cache.py`."
+            )
+        self.cache_dir = cache_dir
+        self.classes = index["classes"]
+        self.size = index["size"]
+        self.targets = np.load(os.path.join(cache_dir, "labels.npy"))
+        self.offsets = np.load(os.path.join(cache_dir, "offsets.npy"))
+        self.shapes = np.load(os.path.join(cache_dir, "shapes.npy"))
+        self.transform = transform
+        # opened lazily, so that every DataLoader worker maps the file itself instead of receiving a pickled copy
+        self._images = None
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        if self._images is None:
+            self._images = np.memmap(
+                os.path.join(self.cache_dir, "images.bin"), dtype=np.uint8, mode="c"
+            )
+        height, width = self.shapes[index]
+        offset = self.offsets[index]
+        image = torch.from_numpy(
+            self._images[offset : offset + 3 * height * width].reshape(3, height, width)
+        )
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, int(self.targets[index])
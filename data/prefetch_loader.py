@@ -0,0 +1,100 @@
+"""
+Look-ahead loading: while the model works on one batch, the next one is already copied to the device.
+
+On CUDA, the next batch is copied on a side stream and the compute stream only waits for it when it is needed.
+Elsewhere a background thread keeps up to `depth` batches ready. Either way, the `device_transform` of the
+dataset (e.g. the normalisation of uint8 images, see `--prefetch`) runs on the device as part of staging.
+"""
+import queue
+import threading
+
+import torch
+
+
+class PrefetchLoader:
+    def __init__(self, loader, device, transform=None, depth=2, seed=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.transform = transform
+        self.depth = depth
+        self.generator = torch.Generator(device=self.device)
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+        # `train.py` calls `train_loader.sampler.set_epoch` in distributed runs
+        self.dataset = loader.dataset
+        self.sampler = loader.sampler
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type == "cuda":
+            return self._stream_iter()
+        return self._thread_iter()
+
+    def _stage(self, images, targets):
+        images = images.to(self.device, non_blocking=True)
+        targets = targets.to(self.device, non_blocking=True)
+        if self.transform is not None:
+            images = self.transform(images, self.generator)
+        return images, targets
+
+    def _stream_iter(self):
+        stream = torch.cuda.Stream(device=self.device)
+        batches = iter(self.loader)
+
+        def stage_next():
+            batch = next(batches, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return self._stage(*batch)
+
+        staged = stage_next()
+        while staged is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            # the tensors were allocated on the side stream but are freed after their use on this one
+            for t in staged:
+                t.record_stream(current)
+            batch, staged = staged, stage_next()
+            yield batch
+
+    def _thread_iter(self):
+        ready = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # gives up once the consumer stopped iterating, instead of blocking on a full queue for good
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            # returning drops the iterator of `self.loader`, which shuts down its workers
+            try:
+                for batch in self.loader:
+                    if not put(self._stage(*batch)):
+                        return
+            except Exception as err:
+                put(err)
+            put(done)
+
+        threading.Thread(target=worker, daemon=True).start()
+        try:
+            while True:
+                batch = ready.get()
+                if batch is done:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # also runs when the consumer stops early (`break`, an exception, or the generator being closed)
+            stop.set()
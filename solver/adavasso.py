@@ -1,11 +1,13 @@
 import torch
 import torch.optim
-import numpy as np
 
 from utils.configurable import configurable
-from scipy.stats import spearmanr, pearsonr
+from utils.ring_buffer import DeviceRingBuffer
+from utils.streaming_stats import StreamingCorrelation
+from utils.amp import unscale_grads_
 
 from solver.build import OPTIMIZER_REGISTRY
+from solver.vasso import METRICS_BUFFER_SIZE
 
 
 @OPTIMIZER_REGISTRY.register()
@@ -42,17 +44,13 @@ def __init__(self, params, base_optimizer, logger, rho, theta, phi, momentum, ma
                 for key in itr_metric_keys:
                     self.state[p][key] = torch.zeros_like(p, requires_grad=False).to(p)
 
-        self.cos_sim_evolution_all_epochs = []
-        self.cos_sim_evolution_training_stage = []
-
-        self.w_normdiff_evolution_all_epochs = []
-        self.w_normdiff_evolution_training_stage = []
-
-        self.pert_normdiff_evolution_all_epochs = []
-        self.pert_normdiff_evolution_training_stage = []
-
-        self.g_prev_norm_evolution_all_epochs = []
-        self.g_prev_norm_evolution_training_stage = []
+        # correlations of the metrics over the current training stage and over all epochs
+        metric_names = ['cosSim(e_t, e_{t-1})', '||w_t - w_{t-1}||', '||g_{t-1}||', '||pert_t - pert_{t-1}||']
+        # per-step metrics stay on device and are read back in one transfer per flush
+        self.metrics_buffer = DeviceRingBuffer(metric_names, capacity=METRICS_BUFFER_SIZE,
+                                               device=self.param_groups[0]["params"][0].device)
+        self.stats_training_stage = StreamingCorrelation(metric_names)
+        self.stats_all_epochs = StreamingCorrelation(metric_names)
 
         # define here the custom metrics that will be tracked per batch
         custom_metrics_per_batch = ['cosSim(e_t, e_{t-1})', '||w_t - w_{t-1}||', '||g_{t-1}||', '||pert_t - pert_{t-1}||']
@@ -78,13 +76,21 @@ def from_config(cls, args):
         }
     
     @torch.enable_grad()
-    def inner_gradient_calculation(self, model, images, targets, criterion):
+    def inner_gradient_calculation(self, model, images, targets, criterion, amp=None):
         
-        output = model(images)
-        loss = criterion(output, targets)
+        if amp is None:
+            output = model(images)
+            loss = criterion(output, targets)
+        else:
+            with amp.autocast():
+                output = model(images)
+                loss = criterion(output, targets)
         self.base_optimizer.zero_grad()
-        loss.backward()
-        loss_w_t = loss.item()
+        if amp is None:
+            loss.backward()
+        else:
+            amp.backward(loss)
+        return output, loss
 
     @torch.no_grad()
     def first_step(self, zero_grad=False):
@@ -141,25 +147,15 @@ def first_step(self, zero_grad=False):
         self.pert_normdiff = self._normdiff('pert_t', 'pert_{t-1}')
         self.cos_sim = self._cosine_similarity('e_t', 'e_{t-1}')
 
-        if not self.iteration_step_counter == 0:
-        # update the lists that will be used for measuring correlations
-            self.cos_sim_evolution_all_epochs.append(self.cos_sim)
-            self.cos_sim_evolution_training_stage.append(self.cos_sim)
-
-            self.w_normdiff_evolution_all_epochs.append(self.normdiff.item())
-            self.w_normdiff_evolution_training_stage.append(self.normdiff.item())
-
-            self.pert_normdiff_evolution_all_epochs.append(self.pert_normdiff.item())
-            self.pert_normdiff_evolution_training_stage.append(self.pert_normdiff.item())
-
         if zero_grad: self.zero_grad()
 
     @torch.no_grad()
-    def second_step(self, zero_grad=False):
+    def second_step(self, zero_grad=False, skip_update=False):
         for group in self.param_groups:
             for p in group["params"]:
                 if p.grad is None: continue
                 p.sub_(self.state[p]['e_t'])
+                if skip_update: continue
 
                 # I am running here an analysis on the outer gradient, g_{SAM}, not the inner gradient.
                 self.state[p]['g_{t-1}'] = self.state[p]['g_t'].clone()
@@ -169,7 +165,7 @@ def second_step(self, zero_grad=False):
                 #     momentum_buffer = self.base_optimizer.state[p]['momentum_buffer']
                 #     self.state[p]['b_t'] = self.momentum * momentum_buffer + self.state[p]['grad']
 
-        self.base_optimizer.step()
+        if not skip_update: self.base_optimizer.step()
         if zero_grad: self.zero_grad()
 
     @torch.no_grad()
@@ -181,12 +177,19 @@ def step(self, closure=None, **kwargs):
         images = kwargs['images']
         targets = kwargs['targets']
         criterion = kwargs['criterion']
-
-        self.inner_gradient_calculation(model, images, targets, criterion)
+        amp = kwargs.get('amp')
+
+        innerOutput, innerLoss = self.inner_gradient_calculation(model, images, targets, criterion, amp)
+        # the moments and the perturbation have to be computed from the unscaled inner gradient
+        if not unscale_grads_(amp, self):
+            self.zero_grad()
+            amp.update()
+            return innerOutput, innerLoss
         self.first_step(True)
         with torch.enable_grad():
-            output, loss = closure()
-        self.second_step()
+            output, loss = closure(True, True)
+        self.second_step(skip_update=not unscale_grads_(amp, self))
+        if amp is not None: amp.update()
 
         self.iteration_step_counter += 1
 
@@ -236,73 +239,71 @@ def _cosine_similarity(self, key1, key2):
         norm_b = torch.norm(concatenated_tensor2, p=2)
         cosine_similarity = dot_product/(norm_a * norm_b)
         
-        return cosine_similarity.item()
+        return cosine_similarity
     
     def _metrics_logging(self):
-        self.logger.wandb_log_batch(**{'||w_t - w_{t-1}||': self.normdiff.item(), 'global_batch_counter': self.iteration_step_counter})
-        self.logger.wandb_log_batch(**{'cosSim(e_t, e_{t-1})': self.cos_sim, 'global_batch_counter': self.iteration_step_counter})
-        self.logger.wandb_log_batch(**{'||pert_t - pert_{t-1}||': self.pert_normdiff.item(), 'global_batch_counter': self.iteration_step_counter})
-
-        previous_sam_gradient_norm = self._avg_grad_norm('g_{t-1}').item()
-        self.logger.wandb_log_batch(**{'||g_{t-1}||': previous_sam_gradient_norm, 'global_batch_counter': self.iteration_step_counter})
-        if not self.iteration_step_counter == 1:
-            self.g_prev_norm_evolution_all_epochs.append(previous_sam_gradient_norm)
-            self.g_prev_norm_evolution_training_stage.append(previous_sam_gradient_norm)
+        previous_sam_gradient_norm = self._avg_grad_norm('g_{t-1}')
+        self.metrics_buffer.append(self.iteration_step_counter,
+                                   [self.cos_sim, self.normdiff, previous_sam_gradient_norm, self.pert_normdiff])
+        if self.metrics_buffer.full():
+            self._drain_metrics_buffer()
+
+    def _drain_metrics_buffer(self):
+        for step, metrics in self.metrics_buffer.drain():
+            self.logger.wandb_log_step(step, **metrics)
+            # the first step has no predecessor to compare to
+            if step == 1:
+                continue
+            self.stats_training_stage.update(metrics)
+            self.stats_all_epochs.update(metrics)
 
     def _correlation_logging(self, epoch):
-        # To be added soon:
-        # my_array = np.nan_to_num(my_array)
+        g_prev, cos_sim = '||g_{t-1}||', 'cosSim(e_t, e_{t-1})'
+        w_normdiff, pert_normdiff = '||w_t - w_{t-1}||', '||pert_t - pert_{t-1}||'
+
         if epoch % 5 == 1 and not self.logged_epoch == epoch:
             self.logged_epoch = epoch
+            self._drain_metrics_buffer()
+            stats = self.stats_training_stage
 
-            cos_sim_values_arr = np.array(self.cos_sim_evolution_training_stage)
-            g_prev_arr = np.array(self.g_prev_norm_evolution_training_stage)
-            w_normdiff_arr = np.array(self.w_normdiff_evolution_training_stage)
-            pert_normdiff_arr = np.array(self.pert_normdiff_evolution_training_stage)
-
-            pearson_corr_g_prev_cos_sim, p1 = pearsonr(g_prev_arr, cos_sim_values_arr)
+            pearson_corr_g_prev_cos_sim, p1 = stats.pearson(g_prev, cos_sim)
             self.logger.wandb_log_batch(**{'PEARSON_CORR_STAGE(||g_{t-1}||, cosSim)': pearson_corr_g_prev_cos_sim, 'p-value_||g_{t-1}||': p1, 'training_stage_%5': epoch//5})
 
-            spearman_corr_g_prev_cos_sim, q1 = spearmanr(g_prev_arr, cos_sim_values_arr)
+            spearman_corr_g_prev_cos_sim, q1 = stats.spearman(g_prev, cos_sim)
             self.logger.wandb_log_batch(**{'SPEARMAN_CORR_STAGE(||g_{t-1}||, cosSim)': spearman_corr_g_prev_cos_sim, 'q-value_||g_{t-1}||': q1, 'training_stage_%5': epoch//5})
 
-            pearson_corr_w_normdiff_cos_sim, r1 = pearsonr(w_normdiff_arr, cos_sim_values_arr)
+            pearson_corr_w_normdiff_cos_sim, r1 = stats.pearson(w_normdiff, cos_sim)
             self.logger.wandb_log_batch(**{'PEARSON_CORR_STAGE(||w_t - w_{t-1}||, cosSim)': pearson_corr_w_normdiff_cos_sim, 'r-value_||w_t - w_{t-1}||': r1, 'training_stage_%5': epoch//5})
 
-            spearman_corr_w_normdiff_cos_sim, s1 = pearsonr(w_normdiff_arr, cos_sim_values_arr)
+            spearman_corr_w_normdiff_cos_sim, s1 = stats.spearman(w_normdiff, cos_sim)
             self.logger.wandb_log_batch(**{'SPEARMAN_CORR_STAGE(||w_t - w_{t-1}||, cosSim)': spearman_corr_w_normdiff_cos_sim, 's-value_||w_t - w_{t-1}||': s1, 'training_stage_%5': epoch//5})
 
-            pearson_corr_pert_normdiff_cos_sim, pp1 = pearsonr(pert_normdiff_arr, cos_sim_values_arr)
+            pearson_corr_pert_normdiff_cos_sim, pp1 = stats.pearson(pert_normdiff, cos_sim)
             self.logger.wandb_log_batch(**{'PEARSON_CORR_STAGE(||pert_t - pert_{t-1}||, cosSim)': pearson_corr_pert_normdiff_cos_sim, 'pp-value_||pert_t - pert_{t-1}||': pp1, 'training_stage_%5': epoch//5})
 
-            pearson_corr_pert_normdiff_g_prev, qq1 = pearsonr(pert_normdiff_arr, g_prev_arr)
+            pearson_corr_pert_normdiff_g_prev, qq1 = stats.pearson(pert_normdiff, g_prev)
             self.logger.wandb_log_batch(**{'PEARSON_CORR_STAGE(||pert_t - pert_{t-1}||, ||g_{t-1}||)': pearson_corr_pert_normdiff_g_prev, 'qq-value_||pert_t - pert_{t-1}||': qq1, 'training_stage_%5': epoch//5})
 
-            pearson_corr_pert_normdiff_w_normdiff, rr1 = pearsonr(pert_normdiff_arr, w_normdiff_arr)
+            pearson_corr_pert_normdiff_w_normdiff, rr1 = stats.pearson(pert_normdiff, w_normdiff)
             self.logger.wandb_log_batch(**{'PEARSON_CORR_STAGE(||pert_t - pert_{t-1}||, ||w_t - w_{t-1}||)': pearson_corr_pert_normdiff_w_normdiff, 'rr-value_||pert_t - pert_{t-1}||': rr1, 'training_stage_%5': epoch//5})
 
-            self.cos_sim_evolution_training_stage.clear()
-            self.g_prev_norm_evolution_training_stage.clear()
-            self.w_normdiff_evolution_training_stage.clear()
-            self.pert_normdiff_evolution_training_stage.clear()
+            stats.reset()
 
         if epoch == self.max_epochs-1:
-            cos_sim_values_all_epochs_arr = np.array(self.cos_sim_evolution_all_epochs)
-            g_prev_all_epochs_arr = np.array(self.g_prev_norm_evolution_all_epochs)
-            w_normdiff_all_epochs_arr = np.array(self.w_normdiff_evolution_all_epochs)
-            pert_normdiff_all_epochs_arr = np.array(self.pert_normdiff_evolution_all_epochs)
+            self._drain_metrics_buffer()
+            stats = self.stats_all_epochs
 
-            pearson_corr_g_prev_cos_sim_all_epochs, p2 = pearsonr(g_prev_all_epochs_arr, cos_sim_values_all_epochs_arr)
+            pearson_corr_g_prev_cos_sim_all_epochs, p2 = stats.pearson(g_prev, cos_sim)
             self.logger.log(f'=====*****===== PEARSON_CORR_GLOBAL(||g_{{t-1}}||, cosSim) =  {pearson_corr_g_prev_cos_sim_all_epochs}, p-value_||g_{{t-1}}||: {p2}')
-            spearman_corr_g_prev_cos_sim_all_epochs, q2 = spearmanr(g_prev_all_epochs_arr, cos_sim_values_all_epochs_arr)
+            spearman_corr_g_prev_cos_sim_all_epochs, q2 = stats.spearman(g_prev, cos_sim)
             self.logger.log(f'=====*****===== SPEARMAN_CORR_GLOBAL(||g_{{t-1}}||, cosSim) =  {spearman_corr_g_prev_cos_sim_all_epochs}, q-value_||g_{{t-1}}||: {q2}')
 
-            pearson_corr_w_normdiff_cos_sim_all_epochs, r2 = pearsonr(w_normdiff_all_epochs_arr, cos_sim_values_all_epochs_arr)
+            pearson_corr_w_normdiff_cos_sim_all_epochs, r2 = stats.pearson(w_normdiff, cos_sim)
             self.logger.log(f'=====*****===== PEARSON_CORR_GLOBAL(||w_t - w_{{t-1}}||, cosSim) =  {pearson_corr_w_normdiff_cos_sim_all_epochs}, r-value_||w_t - w_{{t-1}}||: {r2}')
-            spearman_corr_w_normdiff_cos_sim_all_epochs, s2 = spearmanr(w_normdiff_all_epochs_arr, cos_sim_values_all_epochs_arr)
+            spearman_corr_w_normdiff_cos_sim_all_epochs, s2 = stats.spearman(w_normdiff, cos_sim)
             self.logger.log(f'=====*****===== SPEARMAN_CORR_GLOBAL(||w_t - w_{{t-1}}||, cosSim) =  {spearman_corr_w_normdiff_cos_sim_all_epochs}, s-value_||w_t - w_{{t-1}}||: {s2}')
 
-            pearson_corr_pert_normdiff_cos_sim_all_epochs, pp2 = pearsonr(pert_normdiff_all_epochs_arr, cos_sim_values_all_epochs_arr)
+            pearson_corr_pert_normdiff_cos_sim_all_epochs, pp2 = stats.pearson(pert_normdiff, cos_sim)
             self.logger.log(f'=====*****===== PEARSON_CORR_GLOBAL(||pert_t - pert_{{t-1}}||, cosSim) =  {pearson_corr_pert_normdiff_cos_sim_all_epochs}, p-value_||pert_t - pert_{{t-1}}||: {pp2}')
-            spearman_corr_pert_normdiff_cos_sim_all_epochs, qq2 = spearmanr(pert_normdiff_all_epochs_arr, cos_sim_values_all_epochs_arr)
+            spearman_corr_pert_normdiff_cos_sim_all_epochs, qq2 = stats.spearman(pert_normdiff, cos_sim)
             self.logger.log(f'=====*****===== SPEARMAN_CORR_GLOBAL(||pert_t - pert_{{t-1}}||, cosSim) =  {spearman_corr_pert_normdiff_cos_sim_all_epochs}, q-value_||pert_t - pert_{{t-1}}||: {qq2}')
@@ -1,5 +1,7 @@
 import torch.optim as optim
+from torch.distributed.optim import ZeroRedundancyOptimizer
 
+from utils.dist import is_dist_avail_and_initialized
 from utils.register import Registry
 
 OPTIMIZER_REGISTRY = Registry("Optimizer")
@@ -28,14 +30,22 @@ def build_base_optimizer(args, parameters):
 
     # Build Base Optimizer
     if base_opt == "sgd":
-        base_optimizer = optim.SGD(params=parameters, **opt_kwargs)
+        optimizer_class = optim.SGD
     elif base_opt == "adamw":
         del opt_kwargs["nesterov"]
         del opt_kwargs["momentum"]
-        base_optimizer = optim.AdamW(params=parameters, **opt_kwargs)
+        optimizer_class = optim.AdamW
     else:
         raise ValueError("Incorrect base optimizer.")
 
+    if getattr(args, "shard_state", False) and is_dist_avail_and_initialized():
+        # every process keeps the momentum etc. of its share of the parameters
+        base_optimizer = ZeroRedundancyOptimizer(
+            parameters, optimizer_class=optimizer_class, **opt_kwargs
+        )
+    else:
+        base_optimizer = optimizer_class(params=parameters, **opt_kwargs)
+
     return base_optimizer
 
 
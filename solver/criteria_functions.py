@@ -20,7 +20,7 @@ def random_criterion(self):
 
 
 def gSAMsharp_criterion(self):
-    criterion_trigger = self.tau < self.phi_prime * self.g_norm
+    criterion_trigger = self.criterion_trigger
     self.criterion_logger.append(criterion_trigger + 0)
     return (
         criterion_trigger
@@ -29,7 +29,7 @@ def gSAMsharp_criterion(self):
 
 
 def gSAMflat_criterion(self):
-    criterion_trigger = self.tau > self.phi * self.g_norm
+    criterion_trigger = self.criterion_trigger
     self.criterion_logger.append(criterion_trigger + 0)
     return (
         criterion_trigger
@@ -38,9 +38,7 @@ def gSAMflat_criterion(self):
 
 
 def gSAMratio_criterion(self):
-    criterion_trigger = (
-        self.tau > self.phi * self.g_norm or self.tau < self.phi_prime * self.g_norm
-    )
+    criterion_trigger = self.criterion_trigger
     self.criterion_logger.append(criterion_trigger + 0)
     return (
         criterion_trigger
@@ -49,9 +47,7 @@ def gSAMratio_criterion(self):
 
 
 def cosSim_criterion(self):
-    cos_sim = self._cosine_similarity("g_t", "g_{t-1}")
-    criterion_trigger = cos_sim <= self.crt_c
-    self.cosSims.append(cos_sim)
+    criterion_trigger = self.criterion_trigger
     self.criterion_logger.append(criterion_trigger + 0)
     return criterion_trigger or self.iteration_step_counter <= WARMUP_CONSTANT
 
@@ -71,31 +67,22 @@ def variance_criterion(self):
 def chebyshev_criterion(self):
     if self.iteration_step_counter <= WARMUP_CONSTANT:
         reset_stat_metrics(self)
-        self.logger.wandb_log_batch(
-            **{
-                "decision_type": 0,
-                "global_batch_counter": self.iteration_step_counter,
-            }
+        self.logger.wandb_log_step(
+            self.iteration_step_counter, **{"decision_type": 0}
         )
         return True
     elif not self.iteration_step_conuter % 100:
         reset_stat_metrics(self)
-        self.logger.wandb_log_batch(
-            **{
-                "decision_type": 1,
-                "global_batch_counter": self.iteration_step_counter,
-            }
+        self.logger.wandb_log_step(
+            self.iteration_step_counter, **{"decision_type": 1}
         )
         return True
     # By Chebyshev, the probability for the following event is bounded by 0.5
     elif abs(self.g_norm - self.mean_gsam_norm) >= np.sqrt(2) * np.sqrt(
         self.var_gsam_norm
     ):
-        self.logger.wandb_log_batch(
-            **{
-                "decision_type": 2,
-                "global_batch_counter": self.iteration_step_counter,
-            }
+        self.logger.wandb_log_step(
+            self.iteration_step_counter, **{"decision_type": 2}
         )
         self.decision_rule_counter += 1
         return True
@@ -109,6 +96,36 @@ def reset_stat_metrics(self):
     self.var_gsam_norm = 0
 
 
+"""
+TRIGGERS of the statistics based criteria.
+They are evaluated as device tensors at the end of every step (cf. VASSORE.second_step)
+and only read back on host when the criterion of a later step needs them.
+"""
+
+
+def gSAMsharp_trigger(self):
+    return self.tau < self.phi_prime * self.g_norm
+
+
+def gSAMflat_trigger(self):
+    return self.tau > self.phi * self.g_norm
+
+
+def gSAMratio_trigger(self):
+    return (self.tau > self.phi * self.g_norm) | (self.tau < self.phi_prime * self.g_norm)
+
+
+def cosSim_trigger(self):
+    return self.g_cos_sim <= self.crt_c
+
+
+criteria_triggers = {
+    "gSAMsharp": gSAMsharp_trigger,
+    "gSAMflat": gSAMflat_trigger,
+    "gSAMratio": gSAMratio_trigger,
+    "cosSim": cosSim_trigger,
+}
+
 # collect all possible criteria for inner gradient calculation
 criteria_functions = {
     "naive": naive_criterion,
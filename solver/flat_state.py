@@ -0,0 +1,213 @@
+from collections import OrderedDict
+
+import torch
+import torch.distributed as dist
+
+
+class FlatState:
+    """
+    Contiguous storage for parameters and per-parameter optimizer state.
+
+    Parameters are grouped into one bucket per (device, dtype). Every bucket owns a
+    single flat tensor for the parameters themselves (`p.data` becomes a view into it),
+    one for their gradients (`p.grad` is kept a view into it, cf. `zero_grads`, so that
+    backward accumulates into it) and one flat tensor per registered state key, whose
+    per-parameter views are put into `optimizer.state[p][key]`. Whole-bucket ops on these
+    buffers are therefore equivalent to looping over the parameters.
+
+    With `shard=(rank, world_size)`, every process only keeps its `1 / world_size` slice of each
+    state buffer (ZeRO-style). `params` and the gathered gradients are then the local slices as well,
+    so whole-bucket ops only update the local slice of the parameters; `all_gather_params` brings
+    the others back. There are no per-parameter views of the state or the gradients in this mode; only the
+    pieces of `p.grad` that overlap the local slice are copied into it.
+    """
+
+    def __init__(self, params, shard=None):
+        self.shard = shard
+        grouped = OrderedDict()
+        for p in params:
+            grouped.setdefault((p.device, p.dtype), []).append(p)
+
+        self.buckets = []
+        for (device, dtype), bucket_params in grouped.items():
+            numel = sum(p.numel() for p in bucket_params)
+            # padded so that the bucket splits into equal slices
+            padded = numel
+            if shard is not None:
+                padded = -(-numel // shard[1]) * shard[1]
+            flat = torch.zeros(padded, device=device, dtype=dtype)
+            slices = []
+            offset = 0
+            for p in bucket_params:
+                n = p.numel()
+                flat[offset : offset + n].copy_(p.data.reshape(-1))
+                p.data = flat[offset : offset + n].view_as(p)
+                slices.append((p, offset, n))
+                offset += n
+            shard_slice = self._shard_slice(padded)
+            self.buckets.append(
+                {
+                    "params": flat,
+                    "slices": slices,
+                    # only the local slice of the gradients is kept with `shard`
+                    "grads": torch.zeros_like(flat[shard_slice]),
+                    "numel": numel,
+                    "shard": shard_slice,
+                    "shard_slices": self._shard_overlaps(slices, shard_slice),
+                }
+            )
+
+        self.buffers = {}
+        self.bind_grads()
+
+    def _shard_slice(self, padded):
+        if self.shard is None:
+            return slice(0, padded)
+        rank, world_size = self.shard
+        size = padded // world_size
+        return slice(rank * size, (rank + 1) * size)
+
+    @staticmethod
+    def _shard_overlaps(slices, shard_slice):
+        """
+        `(p, start, shard_offset, n)` for every parameter overlapping the shard: its elements
+        `start : start + n` go to `shard_offset : shard_offset + n` of the local slice.
+        """
+        overlaps = []
+        for p, offset, n in slices:
+            start = max(offset, shard_slice.start)
+            stop = min(offset + n, shard_slice.stop)
+            if start < stop:
+                overlaps.append((p, start - offset, start - shard_slice.start, stop - start))
+        return overlaps
+
+    def __contains__(self, key):
+        return key in self.buffers
+
+    def __getitem__(self, key):
+        return self.buffers[key]
+
+    def add_buffer(self, key, state):
+        """
+        Allocate a zero-initialised flat buffer for `key` and expose its per-parameter views in `state`.
+        """
+        buffers = []
+        for bucket in self.buckets:
+            buf = torch.zeros_like(bucket["params"][bucket["shard"]])
+            if self.shard is not None:
+                buffers.append(buf)
+                continue
+            for p, offset, n in bucket["slices"]:
+                state[p][key] = buf[offset : offset + n].view_as(p)
+            buffers.append(buf)
+        self.buffers[key] = buffers
+        return buffers
+
+    @property
+    def params(self):
+        return [bucket["params"][bucket["shard"]] for bucket in self.buckets]
+
+    def all_gather_params(self):
+        """
+        Gathers the slices of the parameters from all processes, after they were updated locally.
+        """
+        if self.shard is None:
+            return
+        for bucket in self.buckets:
+            flat = bucket["params"]
+            dist.all_gather(list(flat.chunk(self.shard[1])), flat[bucket["shard"]].clone())
+
+    def sum_over_shards(self, value):
+        """
+        Sums a reduction over the local slices (e.g. a dot product) over all processes.
+        """
+        if self.shard is not None:
+            dist.all_reduce(value)
+        return value
+
+    @staticmethod
+    def _grad_views_bound(bucket):
+        grads = bucket["grads"]
+        return all(
+            p.grad is not None
+            and p.grad.data_ptr() == grads.data_ptr() + offset * grads.element_size()
+            for p, offset, _ in bucket["slices"]
+        )
+
+    @torch.no_grad()
+    def bind_grads(self):
+        """
+        Makes `p.grad` a view into the flat gradient buffer where it is not one (any more),
+        copying the gradient into it. Missing gradients are treated as zeros.
+        """
+        if self.shard is not None:
+            return
+        for bucket in self.buckets:
+            if self._grad_views_bound(bucket):
+                continue
+            for p, offset, n in bucket["slices"]:
+                view = bucket["grads"][offset : offset + n].view_as(p)
+                if p.grad is None:
+                    view.zero_()
+                elif p.grad.data_ptr() != view.data_ptr():
+                    view.copy_(p.grad)
+                p.grad = view
+
+    @torch.no_grad()
+    def zero_grads(self):
+        """
+        `optimizer.zero_grad()`: zeroes the flat gradient buffers instead of dropping the views into them.
+        """
+        for bucket in self.buckets:
+            bucket["grads"].zero_()
+        self.bind_grads()
+
+    @torch.no_grad()
+    def gather_grads(self, key=None):
+        """
+        The gradients as one flat tensor per bucket (its local slice with `shard`), copied into the
+        buffer of `key` if given. No copy is needed while `p.grad` are views into the flat buffer.
+        """
+        if self.shard is None:
+            self.bind_grads()
+            out = []
+            for i, bucket in enumerate(self.buckets):
+                flat = bucket["grads"]
+                if key is not None:
+                    flat = self.buffers[key][i].copy_(flat)
+                out.append(flat)
+            return out
+
+        # only the pieces of the gradients that overlap the local slice are copied
+        out = []
+        for i, bucket in enumerate(self.buckets):
+            flat = bucket["grads"] if key is None else self.buffers[key][i]
+            for p, start, shard_offset, n in bucket["shard_slices"]:
+                if p.grad is None:
+                    flat[shard_offset : shard_offset + n].zero_()
+                else:
+                    flat[shard_offset : shard_offset + n].copy_(
+                        p.grad.reshape(-1)[start : start + n]
+                    )
+            out.append(flat)
+        return out
+
+    def norm(self, key):
+        """
+        Global 2-norm over all buckets (and slices) of the buffer `key`.
+        A single fp32 reduction over millions of entries loses precision on CPU, so accumulate in fp64.
+        """
+        buffers = self.buffers[key]
+        shared_device = buffers[0].device
+        norm = torch.norm(
+            torch.stack(
+                [
+                    torch.linalg.vector_norm(buf, dtype=torch.float64).to(shared_device)
+                    for buf in buffers
+                ]
+            ),
+            p=2,
+        )
+        if self.shard is not None:
+            norm = self.sum_over_shards(norm**2).sqrt()
+        return norm.to(buffers[0].dtype)
@@ -0,0 +1,157 @@
+"""
+Multi-tensor kernels shared by the SAM family.
+
+Every function takes lists of tensors and dispatches to the batched `torch._foreach_*`
+ops when they are available, otherwise it falls back to a plain loop over the list.
+The lists can either be per-parameter tensors or the flat buckets of `FlatState`.
+"""
+import functools
+
+import torch
+
+_has_foreach = all(
+    hasattr(torch, op)
+    for op in ["_foreach_add_", "_foreach_mul_", "_foreach_mul", "_foreach_norm"]
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _foreach_tensor_scalar():
+    # `_foreach_mul(TensorList, Tensor)` only exists in newer torch versions
+    if not _has_foreach:
+        return False
+    try:
+        torch._foreach_mul([torch.zeros(1)], torch.ones(()))
+    except (RuntimeError, TypeError):
+        return False
+    return True
+
+
+def _use_foreach(foreach, scalar=None):
+    if foreach is None:
+        foreach = _has_foreach
+    if foreach and isinstance(scalar, torch.Tensor):
+        foreach = _foreach_tensor_scalar()
+    return foreach
+
+
+def norm(tensors, foreach=None):
+    """
+    Global 2-norm of a list of tensors, returned as a 0-dim tensor on the device of the first one.
+    """
+    shared_device = tensors[0].device
+    if _use_foreach(foreach):
+        norms = torch._foreach_norm(tensors, 2)
+    else:
+        norms = [t.norm(p=2) for t in tensors]
+    return torch.norm(torch.stack([n.to(shared_device) for n in norms]), p=2)
+
+
+def add_(tensors, others, alpha=1.0, foreach=None):
+    """
+    tensors[i] += alpha * others[i]
+    """
+    if _use_foreach(foreach):
+        torch._foreach_add_(tensors, others, alpha=alpha)
+    else:
+        for t, o in zip(tensors, others):
+            t.add_(o, alpha=alpha)
+
+
+def sub_(tensors, others, foreach=None):
+    """
+    tensors[i] -= others[i]
+    """
+    add_(tensors, others, alpha=-1.0, foreach=foreach)
+
+
+def mul_(tensors, scalar, foreach=None):
+    """
+    tensors[i] *= scalar, `scalar` can be a python number or a 0-dim tensor.
+    """
+    if _use_foreach(foreach, scalar):
+        torch._foreach_mul_(tensors, scalar)
+    else:
+        for t in tensors:
+            t.mul_(scalar)
+
+
+def scale(tensors, scalar, foreach=None):
+    """
+    Returns [t * scalar for t in tensors], `scalar` can be a python number or a 0-dim tensor.
+    """
+    if _use_foreach(foreach, scalar):
+        return list(torch._foreach_mul(tensors, scalar))
+    return [t * scalar for t in tensors]
+
+
+def perturb_(params, directions, scalar, out=None, foreach=None):
+    """
+    e[i] = scalar * directions[i], then params[i] += e[i]. Returns e, written into `out` if given.
+    """
+    if out is None:
+        out = scale(directions, scalar, foreach=foreach)
+    else:
+        for d, e in zip(directions, out):
+            torch.mul(d, scalar, out=e)
+    add_(params, out, foreach=foreach)
+    return out
+
+
+def ema_(emas, tensors, theta, foreach=None):
+    """
+    emas[i] = (1 - theta) * emas[i] + theta * tensors[i]
+    """
+    mul_(emas, 1 - theta, foreach=foreach)
+    add_(emas, tensors, alpha=theta, foreach=foreach)
+
+
+def copy_(tensors, others, foreach=None):
+    """
+    tensors[i] = others[i]
+    """
+    if _use_foreach(foreach) and hasattr(torch, "_foreach_copy_"):
+        torch._foreach_copy_(tensors, others)
+    else:
+        for t, o in zip(tensors, others):
+            t.copy_(o)
+
+
+def dot(tensors, others):
+    """
+    Global inner product of two lists of tensors, returned as a 0-dim fp64 tensor.
+    Per-tensor products are summed in fp64 to keep cancellations in derived metrics small.
+    """
+    shared_device = tensors[0].device
+    return torch.stack(
+        [
+            torch.dot(t.reshape(-1), o.reshape(-1)).to(shared_device, torch.float64)
+            for t, o in zip(tensors, others)
+        ]
+    ).sum()
+
+
+# kernels of the perturbation and its removal, cf. `compile_kernels`
+COMPILABLE_KERNELS = ["norm", "perturb_", "sub_", "ema_"]
+
+
+def compile_kernels(**compile_kwargs):
+    """
+    Replaces the kernels in `COMPILABLE_KERNELS` by `torch.compile`d versions, so that e.g. the norm, scaling
+    and climb of a perturbation become a few fused kernels. Callers look the kernels up as module attributes
+    at every call, so this also affects optimizers that are already built.
+    Inside a compiled kernel the plain loops are used, which the compiler fuses itself.
+    """
+    for name in COMPILABLE_KERNELS:
+        kernel = globals()[name]
+        if getattr(kernel, "_compiled", False):
+            continue
+        compiled = torch.compile(functools.partial(kernel, foreach=False), **compile_kwargs)
+
+        @functools.wraps(kernel)
+        def compiled_kernel(*args, _compiled=compiled, **kwargs):
+            kwargs.pop("foreach", None)
+            return _compiled(*args, **kwargs)
+
+        compiled_kernel._compiled = True
+        globals()[name] = compiled_kernel
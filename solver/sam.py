@@ -4,12 +4,21 @@
 from utils.configurable import configurable
 
 from solver.build import OPTIMIZER_REGISTRY
+from solver import multi_tensor
+from utils.amp import unscale_grads_
+from utils.dist import all_reduce_norm
+
+
+# How the inner pass of the SAM family runs under DDP:
+# "sync" all-reduces the inner gradient like any other, "local" perturbs every replica along its
+# local-batch gradient (no all-reduce), "norm" does the same but all-reduces the perturbation norm.
+DIST_SAM_MODES = ["sync", "local", "norm"]
 
 
 @OPTIMIZER_REGISTRY.register()
 class SAM(torch.optim.Optimizer):
     @configurable()
-    def __init__(self, params, base_optimizer, logger, rho) -> None:
+    def __init__(self, params, base_optimizer, logger, rho, dist_sam="sync") -> None:
         assert isinstance(
             base_optimizer, torch.optim.Optimizer
         ), "base_optimizer must be an `Optimizer`"
@@ -18,6 +27,8 @@ def __init__(self, params, base_optimizer, logger, rho) -> None:
         assert 0 <= rho, f"rho should be non-negative:{rho}"
         self.rho = rho
         self.logger = logger
+        assert dist_sam in DIST_SAM_MODES, f"Unknown dist_sam mode {dist_sam}"
+        self.dist_sam = dist_sam
         super(SAM, self).__init__(params, dict(rho=rho))
 
         # Counters to measure how much more backward passes etc.
@@ -32,62 +43,90 @@ def __init__(self, params, base_optimizer, logger, rho) -> None:
     def from_config(cls, args):
         return {
             "rho": args.rho,
+            "dist_sam": args.dist_sam,
         }
 
     @torch.no_grad()
     def first_step(self, zero_grad=False):
         grad_norm = self._grad_norm()
+        if self.dist_sam == "norm":
+            grad_norm = all_reduce_norm(grad_norm)
         for group in self.param_groups:
             scale = group["rho"] / (grad_norm + 1e-16)
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                e_w = p.grad * scale
-                p.add_(e_w)  # climb to the local maximum "w + e(w)"
+            params = [p for p in group["params"] if p.grad is not None]
+            if not self.sync_inner_grads:
+                self._save_params(params)
+            # climb to the local maximum "w + e(w)"
+            e_ws = multi_tensor.perturb_(params, [p.grad for p in params], scale)
+            for p, e_w in zip(params, e_ws):
                 self.state[p]["e_w"] = e_w
         if zero_grad:
             self.zero_grad()
 
     @torch.no_grad()
-    def second_step(self, zero_grad=False):
+    def second_step(self, zero_grad=False, skip_update=False):
         for group in self.param_groups:
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                p.sub_(self.state[p]["e_w"])  # get back to "w" from "w + e(w)"
+            params = [p for p in group["params"] if p.grad is not None]
+            # get back to "w" from "w + e(w)"
+            if self.sync_inner_grads:
+                multi_tensor.sub_(params, [self.state[p]["e_w"] for p in params])
+            else:
+                # the replicas climbed along different e(w), subtracting it would leave them apart by rounding
+                multi_tensor.copy_(params, [self.state[p]["w"] for p in params])
 
-        self.base_optimizer.step()
+        if not skip_update:
+            self.base_optimizer.step()
         if zero_grad:
             self.zero_grad()
 
     @torch.no_grad()
     def step(self, closure=None, **kwargs):
         assert closure is not None, "SAM requires closure, which is not provided."
+        amp = kwargs.get("amp")
 
         with torch.enable_grad():
-            innerOutput, innerLoss = closure(True, True)
+            innerOutput, innerLoss = closure(
+                True, True, sync_grads=self.sync_inner_grads
+            )
             self.inner_fwp_calculation_counter += 1
             self.inner_gradient_calculation_counter += 1
+        # the perturbation has to be computed from the unscaled inner gradient
+        if not unscale_grads_(
+            amp, self, all_ranks=not self.sync_inner_grads
+        ):
+            self.zero_grad()
+            amp.update()
+            return innerOutput, innerLoss
+        # e.g. `utils.hessian.SharpnessProbe`, which reuses the inner gradient
+        sharpness_probe = kwargs.get("sharpness_probe")
+        if sharpness_probe is not None:
+            sharpness_probe(self, closure, **kwargs)
         self.first_step()
         with torch.enable_grad():
             outerOutput, outerLoss = closure(True, True)
-        self.second_step()
+        self.second_step(skip_update=not unscale_grads_(amp, self))
+        if amp is not None:
+            amp.update()
 
         return innerOutput, innerLoss
 
+    @property
+    def sync_inner_grads(self):
+        return self.dist_sam == "sync"
+
+    def _save_params(self, params):
+        for p in params:
+            if "w" not in self.state[p]:
+                self.state[p]["w"] = torch.empty_like(p)
+        multi_tensor.copy_([self.state[p]["w"] for p in params], params)
+
     def _grad_norm(self):
-        shared_device = self.param_groups[0]["params"][
-            0
-        ].device  # put everything on the same device, in case of model parallelism
-        norm = torch.norm(
-            torch.stack(
-                [
-                    p.grad.norm(p=2).to(shared_device)
-                    for group in self.param_groups
-                    for p in group["params"]
-                    if p.grad is not None
-                ]
-            ),
-            p=2,
+        # put everything on the same device, in case of model parallelism
+        return multi_tensor.norm(
+            [
+                p.grad
+                for group in self.param_groups
+                for p in group["params"]
+                if p.grad is not None
+            ]
         )
-        return norm
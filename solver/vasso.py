@@ -1,11 +1,18 @@
 import torch
 import torch.optim
-import numpy as np
 
 from utils.configurable import configurable
 from solver.build import OPTIMIZER_REGISTRY
+from solver.flat_state import FlatState
+from solver import multi_tensor
+from solver.sam import DIST_SAM_MODES
+from utils.amp import unscale_grads_
+from utils.dist import all_reduce_norm, get_rank, get_world_size
+from utils.ring_buffer import DeviceRingBuffer
+from utils.streaming_stats import StreamingCorrelation
 
-from scipy.stats import spearmanr, pearsonr
+# number of steps whose per-batch metrics are kept on device before they are logged
+METRICS_BUFFER_SIZE = 100
 
 
 @OPTIMIZER_REGISTRY.register()
@@ -21,6 +28,9 @@ def __init__(
         max_epochs,
         extensive_metrics_mode,
         performance_scores_mode,
+        flat_state,
+        dist_sam="sync",
+        shard_state=False,
     ) -> None:
         assert isinstance(
             base_optimizer, torch.optim.Optimizer
@@ -41,52 +51,88 @@ def __init__(
             self.logger = logger
             self.cos_sim = 0
             self.normdiff = 0
+            self.pert_normdiff = 0
             self.max_epochs = max_epochs
             self.logged_epoch = 0
 
+            # scalars carried over from the previous step, cf. `_metrics_update`
+            self.prev_ema_norm = 0
+            self.prev_e_scale = 0
+            self.outer_grad_norm = 0
+            self.prev_outer_grad_norm = 0
+
         # VaSSO specific configurations
         assert 0 <= rho, f"rho should be non-negative:{rho}"
         assert 0 <= theta and theta <= 1, "theta must live in [0, 1]."
         self.rho = rho
         self.theta = theta
+        assert dist_sam in DIST_SAM_MODES, f"Unknown dist_sam mode {dist_sam}"
+        self.dist_sam = dist_sam
+        if shard_state:
+            # the slices of the state are updated from the all-reduced inner gradient
+            assert dist_sam == "sync", "shard_state needs `--dist_sam sync`"
+            assert (
+                not extensive_metrics_mode
+            ), "shard_state does not support extensive_metrics_mode"
 
         # base_optimizer
         super(VASSO, self).__init__(params, dict(rho=rho, theta=theta))
         self.param_groups = self.base_optimizer.param_groups
 
+        # flat state: parameters, `ema` and `e_t` live in one contiguous buffer per dtype/device,
+        # of which every process only keeps its slice with `shard_state`
+        self.flat_state = None
+        if flat_state or shard_state:
+            shard = None
+            if shard_state and get_world_size() > 1:
+                shard = (get_rank(), get_world_size())
+            self.flat_state = FlatState(
+                (p for group in self.param_groups for p in group["params"]),
+                shard=shard,
+            )
+            flat_keys = ["ema", "e_t"]
+            if not self.sync_inner_grads:
+                flat_keys.append("w")
+            if self.extensive_metrics_mode:
+                flat_keys.append("update")
+            for key in flat_keys:
+                self.flat_state.add_buffer(key, self.state)
+            self.ema_initialized = False
+
         for group in self.param_groups:
             group["rho"] = rho
             group["theta"] = theta
 
             for p in group["params"]:
+                # `update` holds w_t - w_{t-1}, the last step of the base optimizer.
+                # All other metrics are derived from it and from inner products, cf. `_metrics_update`.
                 if self.extensive_metrics_mode:
-                    itr_metric_keys = [
-                        "e_t",
-                        "e_{t-1}",
-                        "w_t",
-                        "w_{t-1}",
-                        "g_t",
-                        "g_{t-1}",
-                        "pert_t",
-                        "pert_{t-1}",
-                    ]
+                    itr_metric_keys = ["e_t", "update"]
                 else:
                     itr_metric_keys = ["e_t"]
                 for key in itr_metric_keys:
+                    if key in self.state[p]:
+                        continue
+                    if self.flat_state is not None and key in self.flat_state:
+                        continue
                     self.state[p][key] = torch.zeros_like(p, requires_grad=False).to(p)
 
         if self.extensive_metrics_mode:
-            self.cos_sim_evolution_all_epochs = []
-            self.cos_sim_evolution_training_stage = []
-
-            self.w_normdiff_evolution_all_epochs = []
-            self.w_normdiff_evolution_training_stage = []
-
-            self.pert_normdiff_evolution_all_epochs = []
-            self.pert_normdiff_evolution_training_stage = []
+            metric_names = [
+                "||w_t - w_{t-1}||",
+                "cosSim(e_t, e_{t-1})",
+                "||pert_t - pert_{t-1}||",
+                "||g_{t-1}||",
+            ]
+            self.metrics_buffer = DeviceRingBuffer(
+                metric_names,
+                capacity=METRICS_BUFFER_SIZE,
+                device=self.param_groups[0]["params"][0].device,
+            )
 
-            self.g_prev_norm_evolution_all_epochs = []
-            self.g_prev_norm_evolution_training_stage = []
+            # correlations of the metrics over the current training stage and over all epochs
+            self.stats_training_stage = StreamingCorrelation(metric_names)
+            self.stats_all_epochs = StreamingCorrelation(metric_names)
 
             # define here the custom metrics that will be tracked per batch
             custom_metrics_per_batch = [
@@ -121,27 +167,48 @@ def from_config(cls, args):
             "max_epochs": args.epochs,
             "extensive_metrics_mode": args.extensive_metrics_mode,
             "performance_scores_mode": args.performance_scores_mode,
+            "flat_state": args.flat_state,
+            "dist_sam": args.dist_sam,
+            "shard_state": args.shard_state,
         }
 
+    def zero_grad(self, set_to_none=True):
+        # with `flat_state` the gradients are views into its flat buffer, which is zeroed instead
+        if self.flat_state is not None and self.flat_state.shard is None:
+            self.flat_state.zero_grads()
+            return
+        super(VASSO, self).zero_grad(set_to_none)
+
     @torch.no_grad()
     def first_step(self, zero_grad=False):
         self._ema_update()
         self._perturbation(zero_grad)
 
     @torch.no_grad()
-    def second_step(self, zero_grad=False):
-        for group in self.param_groups:
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                p.sub_(self.state[p]["e_t"])
+    def second_step(self, zero_grad=False, skip_update=False):
+        self._remove_perturbation()
 
-                if self.extensive_metrics_mode:
-                    # I am running here an analysis on the outer gradient, g_{SAM}, not the inner gradient.
-                    self.state[p]["g_{t-1}"] = self.state[p]["g_t"].clone()
-                    self.state[p]["g_t"] = p.grad.clone().detach()
+        if self.extensive_metrics_mode:
+            # I am running here an analysis on the outer gradient, g_{SAM}, not the inner gradient.
+            self.prev_outer_grad_norm = self.outer_grad_norm
+            self.outer_grad_norm = multi_tensor.norm(
+                [
+                    p.grad
+                    for group in self.param_groups
+                    for p in group["params"]
+                    if p.grad is not None
+                ]
+            )
+            params, updates = self._params_and_state("update")
+            multi_tensor.copy_(updates, params)
+
+        if not skip_update:
+            self.base_optimizer.step()
 
-        self.base_optimizer.step()
+        if self.extensive_metrics_mode:
+            # update = w_t - w_{t-1}
+            multi_tensor.mul_(updates, -1)
+            multi_tensor.add_(updates, params)
         if zero_grad:
             self.zero_grad()
 
@@ -150,15 +217,31 @@ def step(self, closure=None, **kwargs):
         assert closure is not None, "SAM requires closure, which is not provided."
 
         epoch = kwargs["epoch"]
+        amp = kwargs.get("amp")
 
         with torch.enable_grad():
-            innerOutput, innerLoss = closure(True, True)
+            innerOutput, innerLoss = closure(
+                True, True, sync_grads=self.sync_inner_grads
+            )
             self.inner_fwp_calculation_counter += 1
             self.inner_gradient_calculation_counter += 1
+        # the EMA and the perturbation have to be computed from the unscaled inner gradient
+        if not unscale_grads_(
+            amp, self, all_ranks=not self.sync_inner_grads
+        ):
+            self.zero_grad()
+            amp.update()
+            return innerOutput, innerLoss
+        # e.g. `utils.hessian.SharpnessProbe`, which reuses the inner gradient
+        sharpness_probe = kwargs.get("sharpness_probe")
+        if sharpness_probe is not None:
+            sharpness_probe(self, closure, **kwargs)
         self.first_step()
         with torch.enable_grad():
             outerOutput, outerLoss = closure(True, True)
-        self.second_step()
+        self.second_step(skip_update=not unscale_grads_(amp, self))
+        if amp is not None:
+            amp.update()
 
         self.iteration_step_counter += 1
 
@@ -174,91 +257,210 @@ def step(self, closure=None, **kwargs):
     """
 
     def _ema_update(self):
-        for group in self.param_groups:
-            theta = group["theta"]
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                if "ema" not in self.state[p]:
-                    self.state[p]["ema"] = p.grad.clone().detach()
-                else:
-                    self._ema_update_inner(p, theta)
-
-                if self.extensive_metrics_mode:
-                    self.state[p]["w_{t-1}"] = self.state[p]["w_t"].clone()
-                    self.state[p]["w_t"] = p.clone().detach()
+        from_outer_gradient = self._ema_from_outer_gradient()
+        if self.extensive_metrics_mode:
+            self._metrics_inner_products(from_outer_gradient)
+
+        if self.flat_state is not None:
+            if from_outer_gradient:
+                grads = self.flat_state["g_t"]
+            else:
+                grads = self.flat_state.gather_grads()
+            if self.ema_initialized:
+                multi_tensor.ema_(self.flat_state["ema"], grads, self.theta)
+            else:
+                for ema, grad in zip(self.flat_state["ema"], grads):
+                    ema.copy_(grad)
+            self.ema_initialized = True
+        else:
+            for group in self.param_groups:
+                emas, grads = [], []
+                for p in group["params"]:
+                    if p.grad is None:
+                        continue
+                    grad = self.state[p]["g_t"] if from_outer_gradient else p.grad
+                    if "ema" not in self.state[p]:
+                        self.state[p]["ema"] = grad.clone().detach()
+                    else:
+                        emas.append(self.state[p]["ema"])
+                        grads.append(grad)
+                if emas:
+                    multi_tensor.ema_(emas, grads, group["theta"])
+
+    def _ema_from_outer_gradient(self):
+        """
+        Whether the EMA is fed with the last outer gradient `g_t` instead of `p.grad`.
+        """
+        return False
 
     @torch.no_grad()
-    def _ema_update_inner(self, p, theta):
-        self.state[p]["ema"].mul_(1 - theta)
-        self.state[p]["ema"].add_(p.grad, alpha=theta)
+    def _apply_perturbation(self, update_e_t=True):
+        """
+        Climb to "w + e_t". With `update_e_t`, e_t is first recomputed from the EMA.
+        """
+        if not self.sync_inner_grads:
+            self._save_params()
+        if update_e_t:
+            avg_grad_norm = self._avg_grad_norm("ema")
+            if self.dist_sam == "norm":
+                avg_grad_norm = all_reduce_norm(avg_grad_norm)
+            self.ema_norm = avg_grad_norm
+
+        if self.flat_state is not None:
+            if update_e_t:
+                multi_tensor.perturb_(
+                    self.flat_state.params,
+                    self.flat_state["ema"],
+                    self.rho / (avg_grad_norm + 1e-16),
+                    out=self.flat_state["e_t"],
+                )
+            else:
+                multi_tensor.add_(self.flat_state.params, self.flat_state["e_t"])
+            self.flat_state.all_gather_params()
+            return
 
-    def _perturbation(self, zero_grad):
-        avg_grad_norm = self._avg_grad_norm("ema")
         for group in self.param_groups:
-            scale = group["rho"] / (avg_grad_norm + 1e-16)
-            for p in group["params"]:
-                e_w = self._new_e_w_calculation(p, scale)
-                p.add_(e_w)
-
-                if self.extensive_metrics_mode:
-                    self.state[p]["e_{t-1}"] = self.state[p]["e_t"].clone()
+            params = [p for p in group["params"] if p.grad is not None]
+            if update_e_t:
+                scale = group["rho"] / (avg_grad_norm + 1e-16)
+                e_ts = multi_tensor.perturb_(
+                    params, [self.state[p]["ema"] for p in params], scale
+                )
+                for p, e_t in zip(params, e_ts):
+                    self.state[p]["e_t"] = e_t
+            else:
+                multi_tensor.add_(params, [self.state[p]["e_t"] for p in params])
+
+    def _params_and_state(self, key):
+        """
+        Parameters and their state `key` as two aligned lists (flat buckets in flat state mode).
+        """
+        if self.flat_state is not None and key in self.flat_state:
+            return self.flat_state.params, self.flat_state[key]
+        params = [
+            p
+            for group in self.param_groups
+            for p in group["params"]
+            if p.grad is not None
+        ]
+        return params, [self.state[p][key] for p in params]
+
+    def _save_params(self):
+        if self.flat_state is None:
+            for group in self.param_groups:
+                for p in group["params"]:
+                    if p.grad is not None and "w" not in self.state[p]:
+                        self.state[p]["w"] = torch.empty_like(p)
+        params, saved = self._params_and_state("w")
+        multi_tensor.copy_(saved, params)
 
-                    self.state[p]["pert_{t-1}"] = self.state[p]["pert_t"].clone()
-                    self.state[p]["pert_t"] = p.clone().detach()
+    @torch.no_grad()
+    def _remove_perturbation(self):
+        """
+        Get back to "w" from "w + e_t".
+        """
+        if not self.sync_inner_grads:
+            # the replicas climbed along different e_t, subtracting it would leave them apart by rounding
+            params, saved = self._params_and_state("w")
+            multi_tensor.copy_(params, saved)
+            return
 
-        if self.extensive_metrics_mode:
-            self.normdiff = self._normdiff("w_t", "w_{t-1}")
-            self.pert_normdiff = self._normdiff("pert_t", "pert_{t-1}")
-            self.cos_sim = self._cosine_similarity("e_t", "e_{t-1}")
+        if self.flat_state is not None:
+            multi_tensor.sub_(self.flat_state.params, self.flat_state["e_t"])
+            self.flat_state.all_gather_params()
+            return
 
-        # update the lists that will be used for measuring correlations
-        if self.extensive_metrics_mode and not self.iteration_step_counter == 0:
-            self.cos_sim_evolution_all_epochs.append(self.cos_sim)
-            self.cos_sim_evolution_training_stage.append(self.cos_sim)
+        for group in self.param_groups:
+            params = [p for p in group["params"] if p.grad is not None]
+            multi_tensor.sub_(params, [self.state[p]["e_t"] for p in params])
 
-            self.w_normdiff_evolution_all_epochs.append(self.normdiff.item())
-            self.w_normdiff_evolution_training_stage.append(self.normdiff.item())
+    def _perturbation(self, zero_grad):
+        self._apply_perturbation()
 
-            self.pert_normdiff_evolution_all_epochs.append(self.pert_normdiff.item())
-            self.pert_normdiff_evolution_training_stage.append(
-                self.pert_normdiff.item()
-            )
+        if self.extensive_metrics_mode:
+            self._metrics_update()
 
         if zero_grad:
             self.zero_grad()
 
-    def _new_e_w_calculation(self, p, scale):
-        if p.grad is None:
-            return
-        e_w = self.state[p]["ema"] * scale
-        self.state[p]["e_t"] = e_w
-        return e_w
+    @torch.no_grad()
+    def _metrics_inner_products(self, from_outer_gradient):
+        """
+        Inner products between the last update u = w_t - w_{t-1}, the EMA source gradient g
+        and the not yet updated ema_{t-1}. Must run before the EMA update.
+        """
+        params = [
+            p
+            for group in self.param_groups
+            for p in group["params"]
+            if p.grad is not None
+        ]
+        updates = [self.state[p]["update"] for p in params]
+        grads = [self.state[p]["g_t"] if from_outer_gradient else p.grad for p in params]
+        self.metrics_dots = {
+            "u.u": multi_tensor.dot(updates, updates),
+            "u.g": multi_tensor.dot(updates, grads),
+        }
+        if all("ema" in self.state[p] for p in params):
+            emas = [self.state[p]["ema"] for p in params]
+            self.metrics_dots["u.ema"] = multi_tensor.dot(updates, emas)
+            self.metrics_dots["g.ema"] = multi_tensor.dot(grads, emas)
+        else:
+            self.metrics_dots["u.ema"] = 0
+            self.metrics_dots["g.ema"] = 0
 
-    def _avg_grad_norm(self, key):
-        norm = torch.norm(
-            torch.stack(
-                [
-                    self.state[p][key].norm(p=2)
-                    for group in self.param_groups
-                    for p in group["params"]
-                    if p.grad is not None
-                ]
-            ),
-            p=2,
+    @torch.no_grad()
+    def _metrics_update(self):
+        """
+        Derives the extensive metrics without storing any previous iterate:
+            w_t - w_{t-1}       = u
+            e_t                 = c_t * ema_t, with c_t = rho / ||ema_t||
+            ema_t               = (1 - theta) * ema_{t-1} + theta * g
+            pert_t - pert_{t-1} = u + e_t - e_{t-1}
+        """
+        theta = self.theta
+        dots = self.metrics_dots
+        ema_norm, prev_ema_norm = self.ema_norm, self.prev_ema_norm
+        e_scale = self.rho / (ema_norm + 1e-16)
+        prev_e_scale = self.prev_e_scale
+
+        # <ema_t, ema_{t-1}> and <u, ema_t> through the EMA recursion
+        ema_dot = (1 - theta) * prev_ema_norm**2 + theta * dots["g.ema"]
+        u_ema_dot = (1 - theta) * dots["u.ema"] + theta * dots["u.g"]
+
+        e_diff_sq = (
+            (e_scale * ema_norm) ** 2
+            + (prev_e_scale * prev_ema_norm) ** 2
+            - 2 * e_scale * prev_e_scale * ema_dot
+        )
+        pert_diff_sq = (
+            dots["u.u"]
+            + e_diff_sq
+            + 2 * (e_scale * u_ema_dot - prev_e_scale * dots["u.ema"])
         )
-        return norm
 
-    def _normdiff(self, key1, key2):
-        shared_device = self.param_groups[0]["params"][0].device
-        vectors = []
-        for group in self.param_groups:
-            for p in group["params"]:
-                diff = torch.sub(self.state[p][key1], self.state[p][key2])
-                vectors.append(diff.norm(p=2).to(shared_device))
+        self.normdiff = dots["u.u"].sqrt()
+        self.pert_normdiff = pert_diff_sq.clamp(min=0).sqrt()
+        self.cos_sim = ema_dot / (ema_norm * prev_ema_norm)
 
-        norm = torch.norm(torch.stack(vectors), p=2)
-        return norm
+        self.prev_ema_norm = ema_norm
+        self.prev_e_scale = e_scale
+
+    @property
+    def sync_inner_grads(self):
+        return self.dist_sam == "sync"
+
+    def _avg_grad_norm(self, key):
+        if self.flat_state is not None and key in self.flat_state:
+            return self.flat_state.norm(key)
+        return multi_tensor.norm(
+            [
+                self.state[p][key]
+                for group in self.param_groups
+                for p in group["params"]
+                if p.grad is not None
+            ]
+        )
 
     def _cosine_similarity(self, key1, key2):
         flattened_tensors1 = []
@@ -276,49 +478,40 @@ def _cosine_similarity(self, key1, key2):
         norm_b = torch.norm(concatenated_tensor2, p=2)
         cosine_similarity = dot_product / (norm_a * norm_b)
 
-        return cosine_similarity.item()
+        return cosine_similarity
 
     def _metrics_logging(self):
-        self.logger.wandb_log_batch(
-            **{
-                "||w_t - w_{t-1}||": self.normdiff.item(),
-                "global_batch_counter": self.iteration_step_counter,
-            }
-        )
-        self.logger.wandb_log_batch(
-            **{
-                "cosSim(e_t, e_{t-1})": self.cos_sim,
-                "global_batch_counter": self.iteration_step_counter,
-            }
+        self.metrics_buffer.append(
+            self.iteration_step_counter,
+            [
+                self.normdiff,
+                self.cos_sim,
+                self.pert_normdiff,
+                self.prev_outer_grad_norm,
+            ],
         )
-        self.logger.wandb_log_batch(
-            **{
-                "||pert_t - pert_{t-1}||": self.pert_normdiff.item(),
-                "global_batch_counter": self.iteration_step_counter,
-            }
-        )
-
-        previous_sam_gradient_norm = self._avg_grad_norm("g_{t-1}").item()
-        self.logger.wandb_log_batch(
-            **{
-                "||g_{t-1}||": previous_sam_gradient_norm,
-                "global_batch_counter": self.iteration_step_counter,
-            }
-        )
-        if not self.iteration_step_counter == 1:
-            self.g_prev_norm_evolution_all_epochs.append(previous_sam_gradient_norm)
-            self.g_prev_norm_evolution_training_stage.append(previous_sam_gradient_norm)
+        if self.metrics_buffer.full():
+            self._drain_metrics_buffer()
+
+    def _drain_metrics_buffer(self):
+        for step, metrics in self.metrics_buffer.drain():
+            self.logger.wandb_log_step(step, **metrics)
+            # the first step has no predecessor to compare to
+            if step == 1:
+                continue
+            self.stats_training_stage.update(metrics)
+            self.stats_all_epochs.update(metrics)
 
     def _correlation_logging(self, epoch):
+        g_prev, cos_sim = "||g_{t-1}||", "cosSim(e_t, e_{t-1})"
+        w_normdiff, pert_normdiff = "||w_t - w_{t-1}||", "||pert_t - pert_{t-1}||"
+
         if epoch % 5 == 1 and not self.logged_epoch == epoch:
             self.logged_epoch = epoch
+            self._drain_metrics_buffer()
+            stats = self.stats_training_stage
 
-            cos_sim_values_arr = np.array(self.cos_sim_evolution_training_stage)
-            g_prev_arr = np.array(self.g_prev_norm_evolution_training_stage)
-            w_normdiff_arr = np.array(self.w_normdiff_evolution_training_stage)
-            pert_normdiff_arr = np.array(self.pert_normdiff_evolution_training_stage)
-
-            pearson_corr_g_prev_cos_sim, p1 = pearsonr(g_prev_arr, cos_sim_values_arr)
+            pearson_corr_g_prev_cos_sim, p1 = stats.pearson(g_prev, cos_sim)
             self.logger.wandb_log_batch(
                 **{
                     "PEARSON_CORR_STAGE(||g_{t-1}||, cosSim)": pearson_corr_g_prev_cos_sim,
@@ -327,7 +520,7 @@ def _correlation_logging(self, epoch):
                 }
             )
 
-            spearman_corr_g_prev_cos_sim, q1 = spearmanr(g_prev_arr, cos_sim_values_arr)
+            spearman_corr_g_prev_cos_sim, q1 = stats.spearman(g_prev, cos_sim)
             self.logger.wandb_log_batch(
                 **{
                     "SPEARMAN_CORR_STAGE(||g_{t-1}||, cosSim)": spearman_corr_g_prev_cos_sim,
@@ -336,9 +529,7 @@ def _correlation_logging(self, epoch):
                 }
             )
 
-            pearson_corr_w_normdiff_cos_sim, r1 = pearsonr(
-                w_normdiff_arr, cos_sim_values_arr
-            )
+            pearson_corr_w_normdiff_cos_sim, r1 = stats.pearson(w_normdiff, cos_sim)
             self.logger.wandb_log_batch(
                 **{
                     "PEARSON_CORR_STAGE(||w_t - w_{t-1}||, cosSim)": pearson_corr_w_normdiff_cos_sim,
@@ -347,9 +538,7 @@ def _correlation_logging(self, epoch):
                 }
             )
 
-            spearman_corr_w_normdiff_cos_sim, s1 = pearsonr(
-                w_normdiff_arr, cos_sim_values_arr
-            )
+            spearman_corr_w_normdiff_cos_sim, s1 = stats.spearman(w_normdiff, cos_sim)
             self.logger.wandb_log_batch(
                 **{
                     "SPEARMAN_CORR_STAGE(||w_t - w_{t-1}||, cosSim)": spearman_corr_w_normdiff_cos_sim,
@@ -358,8 +547,8 @@ def _correlation_logging(self, epoch):
                 }
             )
 
-            pearson_corr_pert_normdiff_cos_sim, pp1 = pearsonr(
-                pert_normdiff_arr, cos_sim_values_arr
+            pearson_corr_pert_normdiff_cos_sim, pp1 = stats.pearson(
+                pert_normdiff, cos_sim
             )
             self.logger.wandb_log_batch(
                 **{
@@ -369,8 +558,8 @@ def _correlation_logging(self, epoch):
                 }
             )
 
-            pearson_corr_pert_normdiff_g_prev, qq1 = pearsonr(
-                pert_normdiff_arr, g_prev_arr
+            pearson_corr_pert_normdiff_g_prev, qq1 = stats.pearson(
+                pert_normdiff, g_prev
             )
             self.logger.wandb_log_batch(
                 **{
@@ -380,8 +569,8 @@ def _correlation_logging(self, epoch):
                 }
             )
 
-            pearson_corr_pert_normdiff_w_normdiff, rr1 = pearsonr(
-                pert_normdiff_arr, w_normdiff_arr
+            pearson_corr_pert_normdiff_w_normdiff, rr1 = stats.pearson(
+                pert_normdiff, w_normdiff
             )
             self.logger.wandb_log_batch(
                 **{
@@ -391,53 +580,44 @@ def _correlation_logging(self, epoch):
                 }
             )
 
-            self.cos_sim_evolution_training_stage.clear()
-            self.g_prev_norm_evolution_training_stage.clear()
-            self.w_normdiff_evolution_training_stage.clear()
-            self.pert_normdiff_evolution_training_stage.clear()
+            stats.reset()
 
         if epoch == self.max_epochs - 1:
-            cos_sim_values_all_epochs_arr = np.array(self.cos_sim_evolution_all_epochs)
-            g_prev_all_epochs_arr = np.array(self.g_prev_norm_evolution_all_epochs)
-            w_normdiff_all_epochs_arr = np.array(self.w_normdiff_evolution_all_epochs)
-            pert_normdiff_all_epochs_arr = np.array(
-                self.pert_normdiff_evolution_all_epochs
-            )
+            self._drain_metrics_buffer()
+            stats = self.stats_all_epochs
 
-            pearson_corr_g_prev_cos_sim_all_epochs, p2 = pearsonr(
-                g_prev_all_epochs_arr, cos_sim_values_all_epochs_arr
-            )
+            pearson_corr_g_prev_cos_sim_all_epochs, p2 = stats.pearson(g_prev, cos_sim)
             self.logger.log(
                 f"=====*****===== PEARSON_CORR_GLOBAL(||g_{{t-1}}||, cosSim) =  {pearson_corr_g_prev_cos_sim_all_epochs}, p-value_||g_{{t-1}}||: {p2}"
             )
-            spearman_corr_g_prev_cos_sim_all_epochs, q2 = spearmanr(
-                g_prev_all_epochs_arr, cos_sim_values_all_epochs_arr
+            spearman_corr_g_prev_cos_sim_all_epochs, q2 = stats.spearman(
+                g_prev, cos_sim
             )
             self.logger.log(
                 f"=====*****===== SPEARMAN_CORR_GLOBAL(||g_{{t-1}}||, cosSim) =  {spearman_corr_g_prev_cos_sim_all_epochs}, q-value_||g_{{t-1}}||: {q2}"
             )
 
-            pearson_corr_w_normdiff_cos_sim_all_epochs, r2 = pearsonr(
-                w_normdiff_all_epochs_arr, cos_sim_values_all_epochs_arr
+            pearson_corr_w_normdiff_cos_sim_all_epochs, r2 = stats.pearson(
+                w_normdiff, cos_sim
             )
             self.logger.log(
                 f"=====*****===== PEARSON_CORR_GLOBAL(||w_t - w_{{t-1}}||, cosSim) =  {pearson_corr_w_normdiff_cos_sim_all_epochs}, r-value_||w_t - w_{{t-1}}||: {r2}"
             )
-            spearman_corr_w_normdiff_cos_sim_all_epochs, s2 = spearmanr(
-                w_normdiff_all_epochs_arr, cos_sim_values_all_epochs_arr
+            spearman_corr_w_normdiff_cos_sim_all_epochs, s2 = stats.spearman(
+                w_normdiff, cos_sim
             )
             self.logger.log(
                 f"=====*****===== SPEARMAN_CORR_GLOBAL(||w_t - w_{{t-1}}||, cosSim) =  {spearman_corr_w_normdiff_cos_sim_all_epochs}, s-value_||w_t - w_{{t-1}}||: {s2}"
             )
 
-            pearson_corr_pert_normdiff_cos_sim_all_epochs, pp2 = pearsonr(
-                pert_normdiff_all_epochs_arr, cos_sim_values_all_epochs_arr
+            pearson_corr_pert_normdiff_cos_sim_all_epochs, pp2 = stats.pearson(
+                pert_normdiff, cos_sim
             )
             self.logger.log(
                 f"=====*****===== PEARSON_CORR_GLOBAL(||pert_t - pert_{{t-1}}||, cosSim) =  {pearson_corr_pert_normdiff_cos_sim_all_epochs}, p-value_||pert_t - pert_{{t-1}}||: {pp2}"
             )
-            spearman_corr_pert_normdiff_cos_sim_all_epochs, qq2 = spearmanr(
-                pert_normdiff_all_epochs_arr, cos_sim_values_all_epochs_arr
+            spearman_corr_pert_normdiff_cos_sim_all_epochs, qq2 = stats.spearman(
+                pert_normdiff, cos_sim
             )
             self.logger.log(
                 f"=====*****===== SPEARMAN_CORR_GLOBAL(||pert_t - pert_{{t-1}}||, cosSim) =  {spearman_corr_pert_normdiff_cos_sim_all_epochs}, q-value_||pert_t - pert_{{t-1}}||: {qq2}"
@@ -1,12 +1,17 @@
 import torch
 import torch.optim
 import random
+from collections import deque
 
 from utils.configurable import configurable
 from solver.build import OPTIMIZER_REGISTRY
 
+from solver import multi_tensor
+from utils.amp import unscale_grads_
 from solver.vasso import VASSO
-from solver.criteria_functions import criteria_functions
+from solver.criteria_functions import criteria_functions, criteria_triggers
+from utils.dist import broadcast_, shared_seed
+from utils.host_sync import LazyHostTensor
 
 
 @OPTIMIZER_REGISTRY.register()
@@ -22,6 +27,7 @@ def __init__(
         max_epochs,
         extensive_metrics_mode,
         performance_scores_mode,
+        flat_state,
         crt,
         crt_k,
         crt_p,
@@ -30,7 +36,13 @@ def __init__(
         lam,
         crt_c,
         var_delta,
+        crt_lag,
+        dist_sam="sync",
+        seed=None,
+        shard_state=False,
     ) -> None:
+        # the extensive metrics of VASSO are not logged by the reuse variants, so neither their `update`
+        # buffers nor their per-step inner products are set up
         super().__init__(
             params,
             base_optimizer,
@@ -38,10 +50,16 @@ def __init__(
             rho,
             theta,
             max_epochs,
-            extensive_metrics_mode,
+            False,
             performance_scores_mode,
+            flat_state,
+            dist_sam,
+            shard_state,
         )
 
+        assert not (
+            shard_state and crt == "cosSim"
+        ), "shard_state does not support the cosSim criterion"
         assert 0 <= crt_k and isinstance(crt_k, int), "k must be a natural number"
         assert 0 <= crt_p and crt_p <= 1, "p must live in [0, 1]."
 
@@ -58,6 +76,9 @@ def __init__(
         else:
             self.phi_prime = (1 - lam) / crt_z + lam
 
+        # the reuse decisions must agree across processes, so the random criterion
+        # draws from a generator that is seeded alike on all of them
+        self.rng = random.Random(shared_seed(seed))
         self.rndm = 0.0
 
         self.crt_c = crt_c
@@ -76,6 +97,10 @@ def __init__(
 
         self.logger = logger
 
+        # the outer gradient is copied into a flat buffer instead of being referenced
+        if self.flat_state is not None:
+            self.flat_state.add_buffer("g_t", self.state)
+
         if self.crt[:4] == "gSAM" or self.crt == "cosSim":
             self.tau = 0
             self.gSAMema = []
@@ -87,6 +112,8 @@ def __init__(
                     if self.crt == "cosSim":
                         itr_metric_keys.append("g_{t-1}")
                     for key in itr_metric_keys:
+                        if self.flat_state is not None and key in self.flat_state:
+                            continue
                         self.state[p][key] = torch.zeros_like(
                             p, requires_grad=False
                         ).to(p)
@@ -94,7 +121,18 @@ def __init__(
         if not crt == "schedule":
             self.inner_gradient_calculation = criteria_functions[crt]
 
+        # Statistics based criteria: the trigger is computed on device in `second_step`
+        # and read back `crt_lag` steps later, so that reading it does not stall the device.
+        assert 0 <= crt_lag and isinstance(crt_lag, int), "lag must be a natural number"
+        self.crt_lag = crt_lag
+        self.criterion_trigger = False
+        self.pending_criterion_stats = deque()
+
         self.inner_grad = True
+        # loss at w, estimated on reuse steps, see `_inner_loss_estimate`
+        self.inner_loss = None
+        if self.performance_scores_mode:
+            self.logger.wandb_define_metrics_per_batch(["inner_loss"])
         # outer gradient norm
         self.g_norm = 0
 
@@ -110,46 +148,51 @@ def from_config(cls, args):
         config["crt_c"] = args.crt_c
         # Also put it into defaulf_cfg.py as an input option
         config["var_delta"] = args.var_delta
+        config["crt_lag"] = args.crt_lag
+        config["seed"] = args.seed
         return config
 
     @torch.no_grad()
     def first_step(self, zero_grad=False):
         if self.inner_grad:
             self._ema_update()
-
-        avg_grad_norm = self._avg_grad_norm("ema")
-        for group in self.param_groups:
-            if self.inner_grad:
-                scale = group["rho"] / (avg_grad_norm + 1e-16)
-
-            for p in group["params"]:
-                if self.inner_grad:
-                    e_w = self._new_e_w_calculation(p, scale)
-                else:
-                    e_w = self.state[p]["e_t"]
-
-                p.add_(e_w)
+        self._apply_perturbation(update_e_t=self.inner_grad)
         if zero_grad:
             self.zero_grad()
 
     @torch.no_grad()
-    def second_step(self, zero_grad=False):
-        for group in self.param_groups:
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                p.sub_(self.state[p]["e_t"])
-
-                if self.crt == "cosSim" or self.extensive_metrics_mode:
-                    # This is the outer gradient, g_{SAM}, not the inner gradient.
+    def second_step(self, zero_grad=False, skip_update=False):
+        self._remove_perturbation()
+        # non-finite outer gradients must not reach g_t and the criterion statistics
+        if skip_update:
+            if zero_grad:
+                self.zero_grad()
+            return
+
+        # This is the outer gradient, g_{SAM}, not the inner gradient.
+        if self.crt == "cosSim":
+            for group in self.param_groups:
+                for p in group["params"]:
+                    if p.grad is None:
+                        continue
                     self.state[p]["g_{t-1}"] = self.state[p]["g_t"].clone()
-                self.state[p]["g_t"] = p.grad
+        if self.flat_state is not None:
+            self.flat_state.gather_grads("g_t")
+        else:
+            for group in self.param_groups:
+                for p in group["params"]:
+                    if p.grad is None:
+                        continue
+                    self.state[p]["g_t"] = p.grad
 
         # For gSAMsharp and gSAMflat
         if self.crt[:4] == "gSAM":
-            self.g_norm = self._avg_grad_norm("g_t").item()
+            self.g_norm = self._avg_grad_norm("g_t")
             self.tau = (1 - self.lam) * self.tau + self.lam * self.g_norm
-            self.gSAMema.append({"gSAMnorm": self.g_norm, "tau": self.tau})
+            self._record_criterion_stats([self.g_norm, self.tau])
+        elif self.crt == "cosSim":
+            self.g_cos_sim = self._cosine_similarity("g_t", "g_{t-1}")
+            self._record_criterion_stats([self.g_cos_sim])
 
         # Variance or Chebyshev methods
         # ema calculation might be more preferable... how to decide btw statistical measures?
@@ -171,25 +214,88 @@ def step(self, closure=None, **kwargs):
         assert closure is not None, "SAM requires closure, which is not provided."
 
         if self.crt == "random":
-            self.rndm = random.random()
+            self.rndm = self.rng.random()
+        if self.crt in criteria_triggers:
+            self._read_criterion_stats()
 
+        amp = kwargs.get("amp")
         self.inner_grad = self.inner_gradient_calculation(self)
-        computeForward = self.performance_scores_mode or self.inner_grad
-        computeBackprop = self.inner_grad
-        self.inner_fwp_calculation_counter += computeForward
-        self.inner_gradient_calculation_counter += computeBackprop
-        with torch.enable_grad():
-            if computeForward:
-                innerOutput, innerLoss = closure(computeForward, computeBackprop)
-            else:
-                closure(computeForward, computeBackprop)
+        if self.inner_grad:
+            self.inner_fwp_calculation_counter += 1
+            self.inner_gradient_calculation_counter += 1
+            with torch.enable_grad():
+                innerOutput, innerLoss = closure(
+                    True, True, sync_grads=self.sync_inner_grads
+                )
+            self.inner_loss = innerLoss.detach()
+            # the EMA and the perturbation have to be computed from the unscaled inner gradient
+            if not unscale_grads_(
+                amp, self, all_ranks=not self.sync_inner_grads
+            ):
+                self.zero_grad()
+                amp.update()
+                return innerOutput, innerLoss
+            sharpness_probe = kwargs.get("sharpness_probe")
+            if sharpness_probe is not None:
+                sharpness_probe(self, closure, **kwargs)
+        # Reuse steps take the fast path: the perturbation e_t is reused as is,
+        # so the only forward and backward pass of the step is the one at w + e_t below.
         self.first_step()
         with torch.enable_grad():
             outerOutput, outerLoss = closure(True, True)
-        self.second_step()
+        # on reuse steps e_t is kept, only the update of this step is skipped on overflow
+        self.second_step(skip_update=not unscale_grads_(amp, self))
+        if amp is not None:
+            amp.update()
+
+        if self.performance_scores_mode:
+            if not self.inner_grad:
+                self.inner_loss = self._inner_loss_estimate(outerLoss)
+            self.logger.wandb_log_step(
+                self.iteration_step_counter, **{"inner_loss": self.inner_loss}
+            )
 
         self.iteration_step_counter += 1
 
         # With full knowledge that this is worse than innerOutput, innerLoss.
         # Reasoning: see closure() definition in utils/engine.py
         return outerOutput, outerLoss
+
+    """
+    HELPER METHODS
+    """
+
+    def _inner_loss_estimate(self, outer_loss):
+        """
+        First-order estimate of L(w) from the step at w + e_t: L(w) ~ L(w + e_t) - <g_t, e_t>.
+        """
+        _, g_ts = self._params_and_state("g_t")
+        _, e_ts = self._params_and_state("e_t")
+        g_e = multi_tensor.dot(g_ts, e_ts)
+        if self.flat_state is not None:
+            g_e = self.flat_state.sum_over_shards(g_e)
+        return outer_loss.detach() - g_e.to(outer_loss.dtype)
+
+    def _record_criterion_stats(self, values):
+        trigger = criteria_triggers[self.crt](self)
+        stats = torch.stack([trigger.to(values[0].dtype)] + values)
+        # the main process decides for all of them: one broadcast of a few scalars,
+        # which NCCL orders on the device stream, so the host does not wait for it
+        broadcast_(stats)
+        self.pending_criterion_stats.append(LazyHostTensor(stats))
+
+    def _read_criterion_stats(self, lag=None):
+        """
+        Read back all recorded criterion statistics except the newest `lag` ones.
+        """
+        lag = self.crt_lag if lag is None else lag
+        while len(self.pending_criterion_stats) > lag:
+            trigger, *values = self.pending_criterion_stats.popleft().get()
+            self.criterion_trigger = bool(trigger)
+            if self.crt[:4] == "gSAM":
+                self.gSAMema.append({"gSAMnorm": values[0], "tau": values[1]})
+            elif self.crt == "cosSim":
+                self.cosSims.append(values[0])
+
+    def flush_criterion_stats(self):
+        self._read_criterion_stats(lag=0)
@@ -20,6 +20,7 @@ def __init__(
         max_epochs,
         extensive_metrics_mode,
         performance_scores_mode,
+        flat_state,
         crt,
         crt_k,
         crt_p,
@@ -28,6 +29,10 @@ def __init__(
         lam,
         crt_c,
         var_delta,
+        crt_lag,
+        dist_sam="sync",
+        seed=None,
+        shard_state=False,
     ) -> None:
         super().__init__(
             params,
@@ -38,6 +43,7 @@ def __init__(
             max_epochs,
             extensive_metrics_mode,
             performance_scores_mode,
+            flat_state,
             crt,
             crt_k,
             crt_p,
@@ -46,6 +52,10 @@ def __init__(
             lam,
             crt_c,
             var_delta,
+            crt_lag,
+            dist_sam,
+            seed,
+            shard_state,
         )
 
     @torch.no_grad()
@@ -57,11 +67,6 @@ def first_step(self, zero_grad=False):
     HELPER methods overrides
     """
 
-    def _ema_update_inner(self, p, theta):
-        self.state[p]["ema"].mul_(1 - theta)
-        gradient = torch.zeros_like(p).to(p)
-        if self.inner_gradient_calculation(self):
-            gradient = p.grad
-        else:
-            gradient = self.state[p]["g_t"]
-        self.state[p]["ema"].add_(gradient, alpha=theta)
+    def _ema_from_outer_gradient(self):
+        # the decision of the current step has already been taken in `VASSORE.step`
+        return not self.inner_grad
@@ -1,4 +1,5 @@
 import os
+import copy
 import time
 import datetime
 
@@ -10,130 +11,130 @@
     build_dataset,
     build_train_dataloader,
     build_val_dataloader,
+    autotune_loader,
 )
 from solver.build import build_optimizer, build_lr_scheduler
 
 from utils.logger import Logger
 from utils.dist import init_distributed_model, is_main_process
-from utils.seed import setup_seed
-from utils.engine import train_one_epoch, evaluate
+from utils.seed import get_rng_state, set_rng_state, setup_seed
+from utils.engine import train_packed_epoch, evaluate_packed, compile_train_step
+from utils.amp import AMP
+from utils.step_profiler import StepProfiler
 from utils.optimiser_based_selection import (
     need_closure_fn,
     schedule_epoch_ranges,
     scheduling,
 )
 from utils.global_results_collection import training_result_save, decision_rule_save
-from utils.device import onServer
-
-from hessian_eigenthings import compute_hessian_eigenthings
-
-
-def main(args):
-    # init seed
-    setup_seed(args)
-
-    # init dist
-    init_distributed_model(args)
+from utils.device import device, onServer
+from utils.hessian import (
+    SharpnessProbe,
+    compute_hessian_spectrum,
+    hessian_subsample,
+)
 
-    # determine whether in logging_mode
-    logging_mode = args.logging_mode
 
-    # init log
-    logger = Logger(args)
-    logger.log(args)
+class Replica:
+    """
+    Model, optimizer and bookkeeping of one training run. With `--pack`, several of them
+    are trained in one process on the same batches.
+    """
 
-    # build dataset and dataloader
-    train_data, val_data, n_classes = build_dataset(args)
-    train_loader = build_train_dataloader(train_dataset=train_data, args=args)
-    val_loader = build_val_dataloader(val_dataset=val_data, args=args)
-    args.n_classes = n_classes
-    len_train_data = len(train_data)
-    # logger.log(f"Train Data: {len_train_data}, Test Data: {len(val_data)}.")
-
-    # build model
-    model = build_model(args)
-    model_without_ddp = model
-    if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
-        model_without_ddp = model.module
-    # logger.log(f"Model: {args.model}")
-
-    # build loss
-    criterion = torch.nn.CrossEntropyLoss()
-
-    # build solver
-    optimizer, base_optimizer = build_optimizer(
-        args, model=model_without_ddp, logger=logger
-    )
-    use_optimizer = optimizer
-    lr_scheduler = build_lr_scheduler(args, optimizer=base_optimizer)
-    # logger.log(f"Optimizer: {type(optimizer)}")
-    # logger.log(f"LR Scheduler: {type(lr_scheduler)}")
-
-    # just for SGD
-    if args.extensive_metrics_mode:
-        logger.wandb_define_metrics_per_batch(["||g_{SGD}||"])
-
-    # logger.wandb_define_runtime_metric("acc")
-
-    # resume
-    if args.resume:
-        checkpoint = torch.load(args.resume_path, map_location="cpu")
-        model_without_ddp.load_state_dict(checkpoint["model"])
-        optimizer.load_state_dict(checkpoint["optimizer"])
-        lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
-        args.start_epoch = checkpoint["epoch"] + 1
-        lr_scheduler.step(args.start_epoch)
-        logger.log(f"Resume training from {args.resmue_path}.")
-
-    # Re: Scheduling Optimizer
-    # schedule = True if in a VaSSO epoch
-    schedule = False
-    if args.crt == "schedule":
-        schedule = True
-        sch_epoch_ranges = schedule_epoch_ranges(args.crt_s)
-
-    need_closure = need_closure_fn(args)
+    def __init__(self, args, logger) -> None:
+        self.args = args
+        self.logger = logger
 
-    # ====================
-    # START TRAIN:
-    if onServer():
-        torch.cuda.reset_peak_memory_stats(device=None)
-    logger.log(f"Start training for {args.epochs} Epochs.")
-    start_training = time.time()
-    max_acc = 0.0
-    images_per_second_list = []
-    for epoch in range(args.start_epoch, args.epochs):
-        start_epoch = time.time()
+        # build model
+        model = build_model(args)
+        model_without_ddp = model
         if args.distributed:
-            train_loader.sampler.set_epoch(epoch)
+            model = torch.nn.parallel.DistributedDataParallel(
+                model, device_ids=[args.gpu] if device == "cuda" else None
+            )
+            model_without_ddp = model.module
+        # logger.log(f"Model: {args.model}")
 
-        if schedule:
-            if scheduling(current_epoch=epoch, epoch_ranges=sch_epoch_ranges):
-                use_optimizer = optimizer
-                need_closure = True
-            else:
-                use_optimizer = base_optimizer
-                need_closure = False
+        # build loss
+        self.criterion = torch.nn.CrossEntropyLoss()
 
-        train_stats = train_one_epoch(
-            model=model,
-            train_loader=train_loader,
-            criterion=criterion,
-            optimizer=use_optimizer,
-            epoch=epoch,
-            logger=logger,
-            log_freq=args.log_freq,
-            need_closure=need_closure,
-            optimizer_argument=args.opt,
-            extensive_metrics_mode=args.extensive_metrics_mode,
-            logging_mode=logging_mode,
+        # build solver
+        optimizer, base_optimizer = build_optimizer(
+            args, model=model_without_ddp, logger=logger
+        )
+        if args.compile:
+            model = compile_train_step(model)
+        self.model, self.model_without_ddp = model, model_without_ddp
+        self.optimizer, self.base_optimizer = optimizer, base_optimizer
+        self.use_optimizer = optimizer
+        self.lr_scheduler = build_lr_scheduler(args, optimizer=base_optimizer)
+        # logger.log(f"Optimizer: {type(optimizer)}")
+        # logger.log(f"LR Scheduler: {type(lr_scheduler)}")
+
+        # just for SGD
+        if args.extensive_metrics_mode:
+            logger.wandb_define_metrics_per_batch(["||g_{SGD}||"])
+
+        # logger.wandb_define_runtime_metric("acc")
+
+        # resume
+        if args.resume:
+            checkpoint = torch.load(args.resume_path, map_location="cpu")
+            model_without_ddp.load_state_dict(checkpoint["model"])
+            optimizer.load_state_dict(checkpoint["optimizer"])
+            self.lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+            args.start_epoch = checkpoint["epoch"] + 1
+            self.lr_scheduler.step(args.start_epoch)
+            logger.log(f"Resume training from {args.resmue_path}.")
+
+        # Re: Scheduling Optimizer
+        # schedule = True if in a VaSSO epoch
+        self.schedule = False
+        if args.crt == "schedule":
+            self.schedule = True
+            self.sch_epoch_ranges = schedule_epoch_ranges(args.crt_s)
+
+        self.need_closure = need_closure_fn(args)
+        self.amp = AMP(args)
+        self.profiler = StepProfiler(args)
+        self.sharpness_probe = SharpnessProbe(args)
+        if self.sharpness_probe.enabled:
+            logger.wandb_define_metrics_per_batch(["lambda_max (probe)"])
+
+        self.max_acc = 0.0
+        self.images_per_second_list = []
+        # throughput of the SAM-type (closure) epochs and the plain SGD epochs, e.g. for `schedule`
+        self.images_per_second_by_phase = {"sam": [], "sgd": []}
+
+    def train_kwargs(self, epoch):
+        """
+        Arguments of `train_one_epoch` for this replica in `epoch`.
+        """
+        if self.schedule:
+            if scheduling(current_epoch=epoch, epoch_ranges=self.sch_epoch_ranges):
+                self.use_optimizer = self.optimizer
+                self.need_closure = True
+            else:
+                self.use_optimizer = self.base_optimizer
+                self.need_closure = False
+
+        return dict(
+            model=self.model,
+            criterion=self.criterion,
+            optimizer=self.use_optimizer,
+            logger=self.logger,
+            need_closure=self.need_closure,
+            optimizer_argument=self.args.opt,
+            extensive_metrics_mode=self.args.extensive_metrics_mode,
+            amp=self.amp,
+            profiler=self.profiler,
+            sharpness_probe=self.sharpness_probe,
         )
-        lr_scheduler.step(epoch)
-        val_stats = evaluate(model, val_loader)
 
-        if max_acc < val_stats["test_acc1"]:
-            max_acc = val_stats["test_acc1"]
+    def end_epoch(self, epoch, train_stats, val_stats, epoch_time):
+        args, logger = self.args, self.logger
+        if self.max_acc < val_stats["test_acc1"]:
+            self.max_acc = val_stats["test_acc1"]
             # COMMENTED OUT because saving model checkpoints consumes too much memory
             # if is_main_process:
             #     torch.save(
@@ -147,12 +148,13 @@ def main(args):
             #         os.path.join(args.output_dir, args.output_name, "checkpoint.pth"),
             #     )
 
-        if logging_mode:
+        if args.logging_mode:
             custom_metrics_per_epoch = [
                 "train_loss",
                 "train_acc1",
                 "train_acc5",
                 "images/s",
+                "host_syncs/step",
                 "test_loss",
                 "test_acc1",
                 "test_acc5",
@@ -171,6 +173,7 @@ def main(args):
                     "Test Acc1:{test_acc1:.4f}(Max:{max_acc:.4f})",
                     "Test Acc5:{test_acc5:.4f}",
                     "Time:{epoch_time:.3f}s",
+                    "Host Syncs/Step:{host_syncs:.2f}",
                 ]
             )
             logger.log(
@@ -178,20 +181,228 @@ def main(args):
                     epoch=epoch,
                     **train_stats,
                     **val_stats,
-                    max_acc=max_acc,
-                    epoch_time=time.time() - start_epoch,
+                    max_acc=self.max_acc,
+                    epoch_time=epoch_time,
+                    host_syncs=train_stats["host_syncs/step"],
                 )
             )
-        train_acc1 = train_stats["train_acc1"]
-        test_loss = val_stats["test_loss"]
-        train_loss = train_stats["train_loss"]
-        images_per_second_list.append(train_stats["images/s"])
-    logger.log("Train Finish. Max Test Acc1:{:.4f}".format(max_acc))
+        self.train_acc1 = train_stats["train_acc1"]
+        self.test_loss = val_stats["test_loss"]
+        self.train_loss = train_stats["train_loss"]
+        self.images_per_second_list.append(train_stats["images/s"])
+        self.images_per_second_by_phase["sam" if self.need_closure else "sgd"].append(
+            train_stats["images/s"]
+        )
+
+    def finish(
+        self,
+        train_data,
+        val_data,
+        training_duration,
+        max_allocated_memory,
+        max_reserved_memory,
+        packed,
+    ):
+        args, logger, optimizer = self.args, self.logger, self.optimizer
+        logging_mode = args.logging_mode
+        max_acc = self.max_acc
+        logger.log("Train Finish. Max Test Acc1:{:.4f}".format(max_acc))
+        logger.finish()
+
+        training_duration_minutes = training_duration / 60
+        # logger.log("Training Time:{}".format(used_training))
+
+        # taken from the last round
+        overfitting_indicator = self.test_loss - self.train_loss
+
+        total_iterations = args.epochs * (len(train_data) // (args.batch_size))
+
+        if not (args.opt[:3] == "sgd" or args.opt[:4] == "adam"):
+            if logging_mode:
+                logger.log(
+                    "Total inner gradient calculations: {}, Total iterations: {}".format(
+                        optimizer.inner_gradient_calculation_counter,
+                        total_iterations,
+                    )
+                )
+                logger.log(
+                    "Total inner forward passes: {}, Total iterations: {}".format(
+                        optimizer.inner_fwp_calculation_counter,
+                        total_iterations,
+                    )
+                )
+            # the forward/backward passes of the sharpness probe are part of the overhead
+            probe_passes = self.sharpness_probe.passes
+            if probe_passes:
+                logger.log(
+                    "Sharpness probe forward/backward passes: {}".format(probe_passes)
+                )
+            fwp_overhead_over_sgd = 1 + (
+                optimizer.inner_fwp_calculation_counter + probe_passes
+            ) / total_iterations
+            bwp_overhead_over_sgd = 1 + (
+                optimizer.inner_gradient_calculation_counter + probe_passes
+            ) / total_iterations
+            logger.log("Overhead over SGD: {:.2f}".format(bwp_overhead_over_sgd))
+        else:
+            fwp_overhead_over_sgd = 1.0
+            bwp_overhead_over_sgd = 1.0
+
+        np_images_per_second = np.array(self.images_per_second_list)
+        images_per_sec = np.mean(np_images_per_second)
+
+        lambda_1, lambda_5 = None, None
+        hessian_time = None
+        # Computing the Hessian spectrum of the solution, on a fixed subsample of the training set
+        if args.hessian_samples > 0:
+            hessian_batches = hessian_subsample(
+                train_data,
+                val_data,
+                num_samples=args.hessian_samples,
+                batch_size=args.batch_size,
+                seed=args.seed,
+            )
+            hessian_spectrum, hessian_info = compute_hessian_spectrum(
+                model=self.model_without_ddp,
+                criterion=self.criterion,
+                batches=hessian_batches,
+                args=args,
+            )
+            lambda_1 = round(hessian_spectrum[0], 4)
+            # fewer than 5 with `--hessian_iters` < 5, or once the Krylov space is exhausted
+            if len(hessian_spectrum) >= 5:
+                lambda_5 = round(hessian_spectrum[4], 4)
+            hessian_time = hessian_info["time (s)"]
+            logger.log(
+                "Hessian spectrum: {} ({} Lanczos iterations, {:.1f}s)".format(
+                    hessian_spectrum, hessian_info["iterations"], hessian_time
+                )
+            )
+
+        if logging_mode:
+            logger.mv("{}_{:.4f}".format(logger.logger_path, max_acc))
+
+        # Saving everything into the csv is enough
+        training_result_save(
+            args,
+            max_acc,
+            overfitting_indicator,
+            fwp_overhead_over_sgd,
+            bwp_overhead_over_sgd,
+            images_per_sec=images_per_sec,
+            images_per_sec_by_phase={
+                phase: np.mean(values) if values else None
+                for phase, values in self.images_per_second_by_phase.items()
+            },
+            runtime=training_duration_minutes,
+            max_allocated_memory=max_allocated_memory,
+            max_reserved_memory=max_reserved_memory,
+            lambda_1=lambda_1,
+            lambda_5=lambda_5,
+            step_phase_times=self.profiler.run_summary(),
+            hessian_time=hessian_time,
+            packed=packed,
+        )
+
+        if args.crt[:4] == "gSAM" or args.crt == "cosSim":
+            decision_rule_save(args, optimizer)
+
+
+def main(args, pack_overrides=()):
+    # init seed
+    setup_seed(args)
+
+    # init dist
+    init_distributed_model(args)
+
+    # determine whether in logging_mode
+    logging_mode = args.logging_mode
+
+    # one replica per entry of `--pack`, each with its own options, logs and results row
+    replica_args = [args]
+    if pack_overrides:
+        replica_args = [copy.copy(args) for _ in pack_overrides]
+        for replica, overrides in zip(replica_args, pack_overrides):
+            vars(replica).update(overrides)
+
+    # init log
+    loggers = [Logger(replica) for replica in replica_args]
+    for replica, logger in zip(replica_args, loggers):
+        logger.log(replica)
+
+    # build dataset and dataloader
+    train_data, val_data, n_classes = build_dataset(args)
+    train_loader = build_train_dataloader(train_dataset=train_data, args=args)
+    val_loader = build_val_dataloader(val_dataset=val_data, args=args)
+    # logger.log(f"Train Data: {len(train_data)}, Test Data: {len(val_data)}.")
+
+    replicas = []
+    for replica, logger in zip(replica_args, loggers):
+        replica.n_classes = n_classes
+        if pack_overrides:
+            # e.g. different initialisations, the batches are the same for all replicas
+            setup_seed(replica)
+        replicas.append(Replica(replica, logger))
+        if len(replicas) == 1:
+            rng_state = get_rng_state()
+    # the shuffling follows the first replica, as if it was trained on its own
+    set_rng_state(rng_state)
+
+    # ====================
+    # START TRAIN:
+    if onServer() and device == "cuda":
+        torch.cuda.reset_peak_memory_stats(device=None)
+    for replica in replicas:
+        replica.logger.log(f"Start training for {args.epochs} Epochs.")
+    start_training = time.time()
+    for epoch in range(args.start_epoch, args.epochs):
+        start_epoch = time.time()
+        if args.distributed:
+            train_loader.sampler.set_epoch(epoch)
+
+        all_train_stats = train_packed_epoch(
+            train_loader=train_loader,
+            epoch=epoch,
+            log_freq=args.log_freq,
+            logging_mode=logging_mode,
+            runs=[replica.train_kwargs(epoch) for replica in replicas],
+        )
+        for replica in replicas:
+            replica.lr_scheduler.step(epoch)
+        # one pass over the validation data, every pass draws a seed from the global RNG
+        all_val_stats = evaluate_packed(
+            [replica.model for replica in replicas],
+            val_loader,
+            [replica.amp for replica in replicas],
+        )
+
+        if args.auto_tune_loader and epoch == args.start_epoch:
+            train_stats = all_train_stats[0]
+            if autotune_loader(args, train_stats):
+                train_loader = build_train_dataloader(
+                    train_dataset=train_data, args=args, epoch=epoch + 1
+                )
+                val_loader = build_val_dataloader(val_dataset=val_data, args=args)
+                # with `--pack` every replica has its own copy of `args`, and its results row must show the loader used
+                for replica in replica_args:
+                    replica.num_workers = args.num_workers
+                    replica.prefetch_factor = args.prefetch_factor
+            for replica in replicas:
+                replica.logger.log(
+                    f"DataLoader: num_workers={args.num_workers}, prefetch_factor={args.prefetch_factor} "
+                    f"(data wait {train_stats['data_wait (%)']:.1f}% in epoch {epoch})"
+                )
+
+        epoch_time = time.time() - start_epoch
+        for replica, train_stats, val_stats in zip(
+            replicas, all_train_stats, all_val_stats
+        ):
+            replica.end_epoch(epoch, train_stats, val_stats, epoch_time)
     end_training = time.time()
 
     # Memory measurements
     max_allocated_memory, max_reserved_memory = None, None
-    if onServer():
+    if onServer() and device == "cuda":
         max_allocated_memory = int(
             torch.cuda.max_memory_allocated(device=None) / (1024**2)
         )
@@ -201,75 +412,15 @@ def main(args):
 
     used_training = str(datetime.timedelta(seconds=end_training - start_training))
     training_duration = end_training - start_training
-    training_duration_minutes = training_duration / 60
-    # logger.log("Training Time:{}".format(used_training))
-
-    # taken from the last round
-    overfitting_indicator = test_loss - train_loss
-
-    total_iterations = args.epochs * (len_train_data // (args.batch_size))
-
-    if not (args.opt[:3] == "sgd" or args.opt[:4] == "adam"):
-        if logging_mode:
-            logger.log(
-                "Total inner gradient calculations: {}, Total iterations: {}".format(
-                    optimizer.inner_gradient_calculation_counter,
-                    total_iterations,
-                )
-            )
-            logger.log(
-                "Total inner forward passes: {}, Total iterations: {}".format(
-                    optimizer.inner_fwp_calculation_counter,
-                    total_iterations,
-                )
-            )
-        fwp_overhead_over_sgd = 1 + optimizer.inner_fwp_calculation_counter / (
-            total_iterations
-        )
-        bwp_overhead_over_sgd = 1 + optimizer.inner_gradient_calculation_counter / (
-            total_iterations
-        )
-        logger.log("Overhead over SGD: {:.2f}".format(bwp_overhead_over_sgd))
-    else:
-        fwp_overhead_over_sgd = 1.0
-        bwp_overhead_over_sgd = 1.0
-
-    np_images_per_second = np.array(images_per_second_list)
-    images_per_sec = np.mean(np_images_per_second)
-
-    lambda_1, lambda_5 = None, None
-    # Computing the Hessian spectrum of the solution
-    if not (args.model == "resnet18" and args.dataset[:7] == "CIFAR10"):
-        lambda_1, lambda_5 = None, None
-    else:
-        num_eigenthings = 5
-        hessian_eigenthings = compute_hessian_eigenthings(
-            model, train_loader, criterion, num_eigenthings, mode="lanczos"
+    for replica in replicas:
+        replica.finish(
+            train_data,
+            val_data,
+            training_duration,
+            max_allocated_memory,
+            max_reserved_memory,
+            packed=len(replicas),
         )
-        hessian_spectrum = hessian_eigenthings[0]
-        lambda_1 = round(hessian_spectrum[0], 4)
-        lambda_5 = round(hessian_spectrum[4], 4)
-
-    if logging_mode:
-        logger.mv("{}_{:.4f}".format(logger.logger_path, max_acc))
-
-    # Saving everything into the csv is enough
-    training_result_save(
-        args,
-        max_acc,
-        overfitting_indicator,
-        fwp_overhead_over_sgd,
-        bwp_overhead_over_sgd,
-        images_per_sec=images_per_sec,
-        runtime=training_duration_minutes,
-        max_allocated_memory=max_allocated_memory,
-        max_reserved_memory=max_reserved_memory,
-        lambda_1=lambda_1,
-        lambda_5=lambda_5,
-    )
-
-    if args.crt[:4] == "gSAM" or args.crt == "cosSim":
-        decision_rule_save(args, optimizer)
 
 
 if __name__ == "__main__":
@@ -277,4 +428,4 @@ def main(args):
 
     cfg_file = default_parser()
     args = cfg_file.get_args()
-    main(args)
+    main(args, cfg_file.pack_overrides(args))
@@ -0,0 +1,141 @@
+import torch
+
+from utils.configurable import configurable
+from utils.device import device
+from utils.dist import is_dist_avail_and_initialized
+from utils.host_sync import item
+
+
+class LossScaler:
+    """
+    Dynamic loss scaling for fp16 training, with the same schedule as `torch.cuda.amp.GradScaler`.
+
+    Unlike `GradScaler`, gradients can be unscaled more than once per step, which the SAM family needs:
+    the inner gradient has to be unscaled before the perturbation norm, the outer one before the update.
+    """
+
+    def __init__(
+        self,
+        init_scale=2.0**16,
+        growth_factor=2.0,
+        backoff_factor=0.5,
+        growth_interval=2000,
+    ) -> None:
+        self.scale = init_scale
+        self.growth_factor = growth_factor
+        self.backoff_factor = backoff_factor
+        self.growth_interval = growth_interval
+        self._growth_tracker = 0
+        self._found_inf = False
+
+    def scale_loss(self, loss):
+        return loss * self.scale
+
+    def unscale_(self, grads, all_ranks=False, record_inf=True):
+        """
+        Unscales `grads` in place. Returns whether all of them are finite, which costs one host sync.
+        With `all_ranks`, whether they are finite on every process, for gradients that were not all-reduced.
+        With `record_inf=False`, non-finite gradients do not back off the scale at the next `update`
+        (e.g. those of extra passes that are not part of the training step).
+        """
+        if not grads:
+            return True
+        per_device = {}
+        for g in grads:
+            per_device.setdefault(g.device, []).append(g)
+
+        found_inf = []
+        for grad_device, device_grads in per_device.items():
+            inv_scale = torch.full((), 1.0 / self.scale, device=grad_device)
+            device_found_inf = torch.zeros((), device=grad_device)
+            if hasattr(torch, "_amp_foreach_non_finite_check_and_unscale_"):
+                torch._amp_foreach_non_finite_check_and_unscale_(
+                    device_grads, device_found_inf, inv_scale
+                )
+            else:
+                for g in device_grads:
+                    g.mul_(inv_scale)
+                    device_found_inf += (~torch.isfinite(g)).any()
+            found_inf.append(device_found_inf.to(grads[0].device))
+
+        found_inf = torch.stack(found_inf).sum()
+        if all_ranks and is_dist_avail_and_initialized():
+            torch.distributed.all_reduce(found_inf, op=torch.distributed.ReduceOp.MAX)
+        finite = not item(found_inf > 0)
+        if record_inf:
+            self._found_inf |= not finite
+        return finite
+
+    def update(self):
+        """
+        Backs off after a step with non-finite gradients, grows after `growth_interval` finite steps.
+        """
+        if self._found_inf:
+            self.scale *= self.backoff_factor
+            self._growth_tracker = 0
+        else:
+            self._growth_tracker += 1
+            if self._growth_tracker == self.growth_interval:
+                self.scale *= self.growth_factor
+                self._growth_tracker = 0
+        self._found_inf = False
+
+
+class AMP:
+    """
+    Automatic mixed precision for the forward passes: `bf16` autocast, or `fp16` autocast with loss scaling.
+    """
+
+    @configurable
+    def __init__(self, mode, device_type) -> None:
+        assert mode in ["none", "bf16", "fp16"], f"Unknown amp mode {mode}"
+        self.mode = mode
+        self.device_type = device_type
+        self.dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(mode)
+        self.scaler = LossScaler() if mode == "fp16" else None
+
+    @classmethod
+    def from_config(cls, args):
+        return {
+            "mode": args.amp,
+            "device_type": torch.device(device).type,
+        }
+
+    @property
+    def enabled(self):
+        return self.mode != "none"
+
+    def autocast(self):
+        return torch.autocast(
+            device_type=self.device_type, dtype=self.dtype, enabled=self.enabled
+        )
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            loss = self.scaler.scale_loss(loss)
+        loss.backward()
+
+    def unscale_(self, grads, all_ranks=False, record_inf=True):
+        if self.scaler is None:
+            return True
+        return self.scaler.unscale_(grads, all_ranks, record_inf)
+
+    def update(self):
+        if self.scaler is not None:
+            self.scaler.update()
+
+
+def unscale_grads_(amp, optimizer, all_ranks=False, record_inf=True):
+    """
+    Unscales the gradients of all parameters of `optimizer`. Returns False if they are not all finite
+    (on any process with `all_ranks`, so that all of them skip the same steps).
+    """
+    if amp is None or amp.scaler is None:
+        return True
+    grads = [
+        p.grad
+        for group in optimizer.param_groups
+        for p in group["params"]
+        if p.grad is not None
+    ]
+    return amp.unscale_(grads, all_ranks, record_inf)
@@ -5,7 +5,7 @@
 import sys
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
-from utils.device import onHPC
+from utils.device import device
 
 
 def is_dist_avail_and_initialized():
@@ -28,6 +28,36 @@ def get_rank():
     return dist.get_rank()
 
 
+def all_reduce_norm(norm):
+    """
+    Root mean square of `norm` over all processes, with a single all_reduce of one scalar.
+    """
+    if not is_dist_avail_and_initialized():
+        return norm
+    norm_sq = norm.pow(2)
+    dist.all_reduce(norm_sq)
+    return (norm_sq / dist.get_world_size()).sqrt()
+
+
+def broadcast_(tensor, src=0):
+    """
+    Overwrites `tensor` with the one of process `src`, in place. Returns `tensor`.
+    """
+    if is_dist_avail_and_initialized():
+        dist.broadcast(tensor, src)
+    return tensor
+
+
+def shared_seed(seed=None):
+    """
+    `seed`, or if it is None a random seed drawn by the main process, the same on every process.
+    """
+    if seed is not None or not is_dist_avail_and_initialized():
+        return seed
+    seed = torch.randint(2**62, (1,), device=device)
+    return int(broadcast_(seed).item())
+
+
 def is_main_process(func=None):
     if func is not None:  # used as decorator
 
@@ -57,6 +87,22 @@ def print(*args, **kwargs):
     __builtin__.print = print
 
 
+def default_backend():
+    """
+    NCCL on CUDA, gloo everywhere else (e.g. one process per group of cores of a CPU node).
+    """
+    return "nccl" if device == "cuda" else "gloo"
+
+
+def _set_cpu_threads(args):
+    # every process gets its share of the cores, `torchrun` defaults to one thread each
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", args.world_size))
+    threads = args.threads_per_process or max(
+        1, (os.cpu_count() or 1) // local_world_size
+    )
+    torch.set_num_threads(threads)
+
+
 def init_distributed_model(args):
     if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
         args.rank = int(os.environ["RANK"])
@@ -69,11 +115,20 @@ def init_distributed_model(args):
 
     args.distributed = True
 
-    if onHPC():
+    if args.dist_backend == "auto":
+        args.dist_backend = default_backend()
+    assert (
+        args.dist_backend != "nccl" or device == "cuda"
+    ), "nccl needs CUDA, use `--dist_backend gloo` on CPU"
+    if device == "cuda":
         torch.cuda.set_device(args.gpu)
-    args.dist_backend = "nccl"
+    elif device == "cpu":
+        _set_cpu_threads(args)
     print(
-        "| distributed init (rank {}): {}".format(args.rank, args.dist_url), flush=True
+        "| distributed init (rank {}, {} on {}): {}".format(
+            args.rank, args.dist_backend, device, args.dist_url
+        ),
+        flush=True,
     )
     torch.distributed.init_process_group(
         backend=args.dist_backend,
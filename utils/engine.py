@@ -1,3 +1,4 @@
+import contextlib
 import time
 from collections import defaultdict
 from typing import Iterable
@@ -6,144 +7,389 @@
 import torch.distributed as dist
 from utils.dist import is_dist_avail_and_initialized
 from utils.device import device
+from utils.host_sync import host_syncs, item, tolist
+from solver import multi_tensor
+from utils.amp import AMP, unscale_grads_
+from utils.step_profiler import null_profiler
 
 
-def train_one_epoch(
-    model: torch.nn.Module,
-    train_loader: Iterable,
-    criterion,
-    optimizer,
-    epoch,
-    logger,
-    log_freq,
-    need_closure,
-    optimizer_argument,
-    extensive_metrics_mode,
-    logging_mode,
+def _sgd_step(
+    model, images, targets, criterion, optimizer, amp, profiler=null_profiler, **kwargs
 ):
-    model.train()
-
-    _memory = MetricLogger()
-    _memory.add_meter("train_loss", Metric())
-    _memory.add_meter("train_acc1", Metric())
-    _memory.add_meter("train_acc5", Metric())
-    _memory.add_meter("images/s", Metric())
-    for batch_idx, (images, targets) in enumerate(train_loader):
-        batch_start = time.time()
+    """
+    One forward and backward pass, then a step of the (base) optimizer.
+    """
+    optimizer.zero_grad()
+    with torch.enable_grad():
+        with profiler.phase("inner_fwd"), amp.autocast():
+            output = model(images)
+            loss = criterion(output, targets)
+        with profiler.phase("inner_bwd"):
+            amp.backward(loss)
+    with profiler.phase("optimizer_step"):
+        # with fp16 loss scaling, steps with non-finite gradients are skipped
+        if unscale_grads_(amp, optimizer):
+            optimizer.step()
+        amp.update()
+    return output, loss
 
-        images = images.to(device, non_blocking=True)
-        targets = targets.to(device, non_blocking=True)
 
-        # Forward- and Backward-pass function.
-        # Efficiency is mainly about how often, and which part of, this function gets called.
-        def closure(computeForward, computeBackprop):
+def _closure_step(
+    model, images, targets, criterion, optimizer, amp, profiler=null_profiler, **kwargs
+):
+    """
+    Step of the SAM family: the optimizer decides how often, and which part of, the closure runs.
+    """
+
+    # Forward- and Backward-pass function.
+    # Efficiency is mainly about how often, and which part of, this function gets called.
+    # With `sync_grads=False` the gradients stay local to each DDP replica (cf. `--dist_sam`).
+    # `stage` names the profiled phases of passes that are neither inner nor outer, e.g. "probe".
+    def closure(computeForward, computeBackprop, sync_grads=True, stage=None):
+        if stage is None:
+            stage = "outer" if profiler.perturbed else "inner"
+        with _grad_sync(model, sync_grads):
             if computeForward:
-                output = model(images)
-                loss = criterion(output, targets)
+                with profiler.phase(f"{stage}_fwd"), amp.autocast():
+                    output = model(images)
+                    loss = criterion(output, targets)
             if computeBackprop:
-                optimizer.zero_grad()
-                loss.backward()
+                with profiler.phase(f"{stage}_bwd"):
+                    optimizer.zero_grad()
+                    amp.backward(loss)
+
+        # computeForward=True in second_step() holds always.
+        # We return output and loss at the perturbed position
+        # as this is the bound on the generalization error up to a monotonic function (cf. Foret et. al.: SAM).
+        if computeForward:
+            return output, loss
+
+    sharpness_probe = kwargs.get("sharpness_probe")
+    if sharpness_probe is not None:
+        sharpness_probe.before_step(kwargs.get("step"))
+    return optimizer.step(
+        closure,
+        model=model,
+        images=images,
+        targets=targets,
+        criterion=criterion,
+        amp=amp,
+        **kwargs,
+    )
+
+
+def _grad_sync(model, sync_grads):
+    """
+    `model.no_sync()` if the gradients should not be all-reduced. It has to cover the forward pass
+    as well, DDP decides there whether the following backward pass syncs.
+    """
+    if sync_grads or not hasattr(model, "no_sync"):
+        return contextlib.nullcontext()
+    return model.no_sync()
 
-            # computeForward=True in second_step() holds always.
-            # We return output and loss at the perturbed position
-            # as this is the bound on the generalization error up to a monotonic function (cf. Foret et. al.: SAM).
-            if computeForward:
-                return output, loss
+
+def _timed_batches(loader, waits):
+    """
+    Yields the batches of `loader`, appending the time spent waiting for each of them to `waits`.
+    """
+    batches = iter(loader)
+    while True:
+        start = time.perf_counter()
+        batch = next(batches, None)
+        if batch is None:
+            return
+        waits.append(time.perf_counter() - start)
+        yield batch
+
+
+def compile_train_step(model, **compile_kwargs):
+    """
+    `torch.compile`s the forward and backward pass of `model` and the perturbation kernels of the SAM family.
+    The Python-side decisions of the optimizers, e.g. the reuse criteria, stay eager between the graphs.
+    """
+    assert hasattr(torch, "compile"), "Compiling the training step requires torch>=2.0"
+    multi_tensor.compile_kernels(**compile_kwargs)
+    return torch.compile(model, **compile_kwargs)
+
+
+def select_train_step(need_closure):
+    return _closure_step if need_closure else _sgd_step
+
+
+class _EpochRun:
+    """
+    One model trained over one epoch: its step function, running metrics and log lines.
+    The loop over the batches is `_train_epoch`, which can drive several of them on the same batches.
+    """
+
+    def __init__(
+        self,
+        model,
+        criterion,
+        optimizer,
+        epoch,
+        logger,
+        log_freq,
+        need_closure,
+        optimizer_argument,
+        extensive_metrics_mode,
+        logging_mode,
+        num_batches,
+        train_data,
+        amp=None,
+        profiler=null_profiler,
+        sharpness_probe=None,
+    ):
+        self.model = model
+        self.criterion = criterion
+        self.optimizer = optimizer
+        self.epoch = epoch
+        self.logger = logger
+        self.log_freq = log_freq
+        self.optimizer_argument = optimizer_argument
+        self.extensive_metrics_mode = extensive_metrics_mode
+        self.logging_mode = logging_mode
+        self.num_batches = num_batches
+        self.train_data = train_data
+        self.amp = amp
+        if amp is None:
+            self.amp = AMP(mode="none", device_type=torch.device(device).type)
+        self.profiler = profiler
+        self.sharpness_probe = sharpness_probe
+
+        model.train()
+        profiler.watch(optimizer)
+        self.memory = MetricLogger()
+        self.memory.add_meter("train_loss", Metric())
+        self.memory.add_meter("train_acc1", Metric())
+        self.memory.add_meter("train_acc5", Metric())
+        # chosen once per epoch, e.g. `schedule` switches between the modes epoch-wise
+        self.train_step = select_train_step(need_closure)
+        self.msg = " ".join(
+            [
+                "Epoch: {epoch}",
+                "[{batch_id}/{batch_len}]",
+                "lr:{lr:.6f}",
+                "Train Loss:{train_loss:.4f}",
+                "Train Acc1:{train_acc1:.4f}",
+                "Train Acc5:{train_acc5:.4f}",
+                "Time:{batch_time:.3f}s",
+            ]
+        )
+        self.num_images = 0
+        # host syncs of this run only, with `--pack` several runs share the process-wide counter
+        self.host_syncs = 0
+
+    def step(self, batch_idx, images, targets, batch_start):
+        profiler, logger, epoch = self.profiler, self.logger, self.epoch
+        step = epoch * self.num_batches + batch_idx
 
         # sgd needs "normal" output and loss calculation
-        if optimizer_argument[:3] == "sgd" and extensive_metrics_mode:
-            total_sgd_norm = (
-                sum(p.grad.data.norm(2).item() ** 2 for p in model.parameters()) ** 0.5
-            )
-            logger.wandb_log_batch(
-                **{
-                    "||g_{SGD}||": total_sgd_norm,
-                    "global_batch_counter": epoch * len(train_loader) + batch_idx,
-                }
-            )
+        if self.optimizer_argument[:3] == "sgd" and self.extensive_metrics_mode:
+            sgd_grads = [p.grad for p in self.model.parameters() if p.grad is not None]
+            if sgd_grads:
+                with profiler.phase("logging"):
+                    logger.wandb_log_step(
+                        step, **{"||g_{SGD}||": multi_tensor.norm(sgd_grads)}
+                    )
 
-        if need_closure:
-            output, loss = optimizer.step(
-                closure,
+        with profiler.phase("step"):
+            output, loss = self.train_step(
+                self.model,
+                images,
+                targets,
+                self.criterion,
+                self.optimizer,
                 epoch=epoch,
-                step=epoch * len(train_loader) + batch_idx,
+                step=step,
                 batch_idx=batch_idx,
-                model=model,
-                images=images,
-                targets=targets,
-                criterion=criterion,
-                train_data=train_loader.dataset,
+                train_data=self.train_data,
                 logger=logger,
+                amp=self.amp,
+                profiler=profiler,
+                sharpness_probe=self.sharpness_probe,
             )
-        else:
-            with torch.enable_grad():
-                output, loss = closure(True, True)
-            optimizer.step()
 
-        acc1, acc5 = accuracy(output, targets, topk=(1, 5))
-        batch_num = images.shape[0]
-        batch_t = time.time() - batch_start
-        _memory.update_meter("train_loss", loss.item(), n=batch_num)
-        _memory.update_meter("train_acc1", acc1.item(), n=batch_num)
-        _memory.update_meter("train_acc5", acc5.item(), n=batch_num)
-        _memory.update_meter("images/s", batch_num / batch_t, n=1)
-
-        if logging_mode:
-            msg = " ".join(
-                [
-                    "Epoch: {epoch}",
-                    "[{batch_id}/{batch_len}]",
-                    "lr:{lr:.6f}",
-                    "Train Loss:{train_loss:.4f}",
-                    "Train Acc1:{train_acc1:.4f}",
-                    "Train Acc5:{train_acc5:.4f}",
-                    "Time:{batch_time:.3f}s",
-                ]
-            )
-            if batch_idx % log_freq == 0:
+        with profiler.phase("logging"):
+            acc1, acc5 = accuracy(output, targets, topk=(1, 5))
+            batch_num = images.shape[0]
+            batch_t = time.time() - batch_start
+            # accumulated on device, read back only for the log lines and at the end of the epoch
+            self.memory.update_meter("train_loss", loss, n=batch_num)
+            self.memory.update_meter("train_acc1", acc1, n=batch_num)
+            self.memory.update_meter("train_acc5", acc5, n=batch_num)
+            self.num_images += batch_num
+
+            if self.logging_mode and batch_idx % self.log_freq == 0:
+                avgs = self.memory.global_avgs()
                 logger.log(
-                    msg.format(
+                    self.msg.format(
                         epoch=epoch,
                         batch_id=batch_idx,
-                        batch_len=len(train_loader),
-                        lr=optimizer.param_groups[0]["lr"],
-                        train_loss=_memory.meters["train_loss"].global_avg,
-                        train_acc1=_memory.meters["train_acc1"].global_avg,
-                        train_acc5=_memory.meters["train_acc5"].global_avg,
+                        batch_len=self.num_batches,
+                        lr=self.optimizer.param_groups[0]["lr"],
+                        train_loss=avgs["train_loss"],
+                        train_acc1=avgs["train_acc1"],
+                        train_acc5=avgs["train_acc5"],
                         batch_time=batch_t,
                     )
                 )
-            _memory.synchronize_between_processes()
-    return {name: meter.global_avg for name, meter in _memory.meters.items()}
+        profiler.step()
+
+    def averages(self):
+        self.logger.flush_step_buffer()
+        self.memory.synchronize_between_processes()
+        return self.memory.global_avgs()
+
+    def summary(self, train_stats, epoch_time, data_waits):
+        train_stats["images/s"] = self.num_images / epoch_time
+        # time the training loop was blocked on the loader
+        train_stats["data_wait (s)"] = sum(data_waits)
+        train_stats["data_wait (%)"] = 100 * sum(data_waits) / epoch_time
+        train_stats["host_syncs/step"] = self.host_syncs / max(host_syncs.steps, 1)
+        train_stats.update(self.profiler.epoch_summary())
+        if self.sharpness_probe is not None:
+            train_stats.update(self.sharpness_probe.epoch_summary())
+        return train_stats
+
+
+def _train_epoch(runs, train_loader):
+    """
+    Loads every batch once and runs the step of every run on it. The first run times the data loading.
+    """
+    profiler = runs[0].profiler
+    host_syncs.reset()
+    data_waits = []
+    epoch_start = time.time()
+    batches = profiler.iterate(_timed_batches(train_loader, data_waits))
+    for batch_idx, (images, targets) in enumerate(batches):
+        batch_start = time.time()
+        host_syncs.step()
+
+        with profiler.phase("data"):
+            images = images.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
+
+        for run in runs:
+            syncs = host_syncs.syncs
+            run.step(batch_idx, images, targets, batch_start)
+            run.host_syncs += host_syncs.syncs - syncs
+    averages = []
+    for run in runs:
+        syncs = host_syncs.syncs
+        averages.append(run.averages())
+        run.host_syncs += host_syncs.syncs - syncs
+    # the steps run asynchronously, so the throughput is only measured once the device has caught up
+    epoch_time = time.time() - epoch_start
+    return [
+        run.summary(train_stats, epoch_time, data_waits)
+        for run, train_stats in zip(runs, averages)
+    ]
+
+
+def train_one_epoch(
+    model: torch.nn.Module,
+    train_loader: Iterable,
+    criterion,
+    optimizer,
+    epoch,
+    logger,
+    log_freq,
+    need_closure,
+    optimizer_argument,
+    extensive_metrics_mode,
+    logging_mode,
+    amp=None,
+    profiler=null_profiler,
+    sharpness_probe=None,
+):
+    run = _EpochRun(
+        model,
+        criterion,
+        optimizer,
+        epoch,
+        logger,
+        log_freq,
+        need_closure,
+        optimizer_argument,
+        extensive_metrics_mode,
+        logging_mode,
+        num_batches=len(train_loader),
+        train_data=train_loader.dataset,
+        amp=amp,
+        profiler=profiler,
+        sharpness_probe=sharpness_probe,
+    )
+    return _train_epoch([run], train_loader)[0]
+
+
+def train_packed_epoch(train_loader: Iterable, epoch, log_freq, logging_mode, runs):
+    """
+    `train_one_epoch` of several models at once, e.g. replicas with different optimizer configs
+    (`--pack`): every batch is loaded once and used for a step of each of them in turn.
+    `runs` holds the per-model arguments of `train_one_epoch`, the stats come back in the same order.
+    """
+    return _train_epoch(
+        [
+            _EpochRun(
+                epoch=epoch,
+                log_freq=log_freq,
+                logging_mode=logging_mode,
+                num_batches=len(train_loader),
+                train_data=train_loader.dataset,
+                **run,
+            )
+            for run in runs
+        ],
+        train_loader,
+    )
 
 
 @torch.no_grad()
 def evaluate(
     model: torch.nn.Module,
     val_loader: Iterable,
+    amp=None,
 ):
-    model.eval()
-    criterion = torch.nn.CrossEntropyLoss()
+    return evaluate_packed([model], val_loader, [amp])[0]
+
 
-    _memory = MetricLogger()
-    _memory.add_meter("test_loss", Metric())
-    _memory.add_meter("test_acc1", Metric())
-    _memory.add_meter("test_acc5", Metric())
+@torch.no_grad()
+def evaluate_packed(models, val_loader: Iterable, amps):
+    """
+    `evaluate` of every model of a `--pack` in one pass over `val_loader`.
+    """
+    criterion = torch.nn.CrossEntropyLoss()
+    amps = [
+        AMP(mode="none", device_type=torch.device(device).type) if amp is None else amp
+        for amp in amps
+    ]
+    memories = []
+    for model in models:
+        model.eval()
+        _memory = MetricLogger()
+        _memory.add_meter("test_loss", Metric())
+        _memory.add_meter("test_acc1", Metric())
+        _memory.add_meter("test_acc5", Metric())
+        memories.append(_memory)
 
     for images, targets in val_loader:
         images = images.to(device, non_blocking=True)
         targets = targets.to(device, non_blocking=True)
+        batch_num = images.shape[0]
 
-        output = model(images)
-        loss = criterion(output, targets)
-        acc1, acc5 = accuracy(output, targets, topk=(1, 5))
+        for model, amp, _memory in zip(models, amps, memories):
+            with amp.autocast():
+                output = model(images)
+                loss = criterion(output, targets)
+            acc1, acc5 = accuracy(output, targets, topk=(1, 5))
 
-        batch_num = images.shape[0]
-        _memory.update_meter("test_loss", loss.item(), n=batch_num)
-        _memory.update_meter("test_acc1", acc1.item(), n=batch_num)
-        _memory.update_meter("test_acc5", acc5.item(), n=batch_num)
-    _memory.synchronize_between_processes()
-    return {name: meter.global_avg for name, meter in _memory.meters.items()}
+            _memory.update_meter("test_loss", loss, n=batch_num)
+            _memory.update_meter("test_acc1", acc1, n=batch_num)
+            _memory.update_meter("test_acc5", acc5, n=batch_num)
+    for _memory in memories:
+        _memory.synchronize_between_processes()
+    return [_memory.global_avgs() for _memory in memories]
 
 
 def accuracy(output, targets, topk=(1,)):
@@ -163,30 +409,25 @@ def accuracy(output, targets, topk=(1,)):
 
 
 class Metric:
+    """
+    Weighted running average. Tensor values are accumulated on their device, so updates never wait
+    for the device, only reading `global_avg` does.
+    """
+
     def __init__(self) -> None:
         self.value = 0
         self.num = 0
 
     def update(self, value, n=1):
         self.num += n
-        self.value += value * n
-
-    def synchronize_between_processes(self):
-        """
-        Warning: does not synchronize the deque!
-        """
-        if not is_dist_avail_and_initialized():
-            return
-        t = torch.tensor([self.num, self.value], dtype=torch.float64, device="cuda")
-        dist.barrier()
-        dist.all_reduce(t)
-        t = t.tolist()
-        self.num = int(t[0])
-        self.value = t[1]
+        if isinstance(value, torch.Tensor):
+            value = value.detach().to(_accumulation_dtype(value.device))
+        self.value = self.value + value * n
 
     @property
     def global_avg(self):
-        return self.value / self.num
+        avg = self.value / self.num
+        return item(avg) if isinstance(avg, torch.Tensor) else avg
 
 
 class MetricLogger:
@@ -199,6 +440,51 @@ def add_meter(self, name, meter):
     def update_meter(self, name, value, n):
         self.meters[name].update(value, n)
 
+    def global_avgs(self):
+        """
+        Averages of all meters, read from the device with a single host sync.
+        """
+        packed = self._pack()
+        return dict(zip(self.meters, tolist(packed[:, 1] / packed[:, 0])))
+
     def synchronize_between_processes(self):
-        for meter in self.meters.values():
-            meter.synchronize_between_processes()
+        """
+        Sums all meters across processes with one all-reduce. Call once per set of updates,
+        the meters hold the global sums afterwards.
+        """
+        if not is_dist_avail_and_initialized():
+            return
+        packed = self._pack()
+        dist.all_reduce(packed)
+        for meter, (num, value) in zip(self.meters.values(), packed):
+            meter.num, meter.value = num, value
+
+    def _pack(self):
+        # one `[num, value]` row per meter, on the device of the tensor-valued meters
+        pack_device = next(
+            (
+                meter.value.device
+                for meter in self.meters.values()
+                if isinstance(meter.value, torch.Tensor)
+            ),
+            torch.device(device),
+        )
+        dtype = _accumulation_dtype(pack_device)
+        return torch.stack(
+            [
+                torch.stack(
+                    [
+                        torch.as_tensor(field, dtype=dtype).to(pack_device)
+                        for field in (meter.num, meter.value)
+                    ]
+                )
+                for meter in self.meters.values()
+            ]
+        )
+
+
+def _accumulation_dtype(accumulation_device):
+    # MPS has no float64
+    if accumulation_device.type == "mps":
+        return torch.float32
+    return torch.float64
@@ -58,10 +58,14 @@ def training_result_save(
     max_reserved_memory,
     lambda_1=None,
     lambda_5=None,
+    images_per_sec_by_phase=None,
+    step_phase_times=None,
+    hessian_time=None,
+    packed=None,
 ):
     criterion = args.crt
     results = []
-    if lambda_1 is not None:
+    if lambda_1 is not None and lambda_5 is not None:
         jastr = round(lambda_1 / lambda_5, 4)
     else:
         jastr = None
@@ -81,6 +85,7 @@ def training_result_save(
         "l1": lambda_1,
         "l5": lambda_5,
         "l1/l5": jastr,
+        "hessian time (s)": None if hessian_time is None else round(hessian_time, 2),
         "fwp_overhead": round(fwp_overhead_over_sgd, 4),
         "bwp_overhead": round(bwp_overhead_over_sgd, 4),
         "images/s": round(images_per_sec, 2),
@@ -89,29 +94,59 @@ def training_result_save(
         "max_reserved_memory": max_reserved_memory,
         "epochs": args.epochs,
         "exclusive_run": args.exclusive_run,
+        "num_workers": args.num_workers,
+        "prefetch_factor": args.prefetch_factor,
+        # number of replicas trained in the same process (`--pack`), images/s is per replica
+        "packed": packed,
     }
+    for phase, value in (images_per_sec_by_phase or {}).items():
+        exp_res[f"images/s ({phase} phase)"] = (
+            None if value is None else round(value, 2)
+        )
+    # in ms, from `utils.step_profiler.StepProfiler`
+    for name, value in (step_phase_times or {}).items():
+        exp_res[name] = round(value, 3)
     if args.crt == "none":
         exp_res["criterion"] = "none"
         exp_res["crt_parameter"] = "none"
     results.append(exp_res)
     df = pd.DataFrame(results)
     numerical_results_csv_fp = args.dataset_nn_combination + "_results.csv"
-    try:
-        with open(numerical_results_csv_fp, "r"):
-            file_exists = True
-    except FileNotFoundError:
-        file_exists = False
+    append_results_csv(numerical_results_csv_fp, df)
+
 
-    df.to_csv(
-        numerical_results_csv_fp,
-        mode="a" if file_exists else "w",
-        header=not file_exists,
-        index=False,
-    )
+def append_results_csv(file_path, df):
+    """
+    Appends the rows of `df` to the csv at `file_path`.
+    If `df` brings new columns, the file is rewritten once with the union of the columns.
+    The whole read-modify-write holds an exclusive lock, runs sharing the file must not lose each other's rows.
+    """
+    with open(file_path, "a+", newline="") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            header = next(csv.reader(f), [])
+            if not header:
+                df.to_csv(f, header=True, index=False)
+            elif set(df.columns) <= set(header):
+                df.reindex(columns=header).to_csv(f, header=False, index=False)
+            else:
+                f.seek(0)
+                previous = pd.read_csv(f)
+                # in "a+" mode every write goes to the end, which is the start after truncating
+                f.truncate(0)
+                pd.concat([previous, df], ignore_index=True).to_csv(
+                    f, header=True, index=False
+                )
+        finally:
+            # the buffered rows must be on disk before the next process reads the file
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
 # As I want to know the distribution of gradient norms
 def decision_rule_save(args, optimizer):
+    optimizer.flush_criterion_stats()
     if args.crt[:4] == "gSAM":
         gSAMema = optimizer.gSAMema
         gSAMnorm_values = [entry["gSAMnorm"] for entry in gSAMema]
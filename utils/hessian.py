@@ -0,0 +1,278 @@
+"""
+Top Hessian eigenvalues of the training loss, by Lanczos iteration on Hessian-vector products.
+
+The loss is taken over a fixed subsample of the training set without augmentation (`hessian_subsample`),
+which is cached on the device once, so that every Hessian-vector product sees the same function.
+"""
+import copy
+import time
+
+import numpy as np
+import torch
+
+from data.device_dataset import DeviceDataset
+from solver import multi_tensor
+from utils.amp import unscale_grads_
+from utils.configurable import configurable
+from utils.device import device
+from utils.host_sync import tolist
+from utils.seed import get_rng_state, set_rng_state
+
+
+def hessian_subsample(train_data, val_data, num_samples, batch_size, seed=0):
+    """
+    `num_samples` random training images with the (augmentation-free) transforms of `val_data`,
+    as a list of `(images, targets)` batches on the device.
+    """
+    data = copy.copy(train_data)
+    data.transform = val_data.transform
+    generator = torch.Generator().manual_seed(0 if seed is None else seed)
+    indices = torch.randperm(len(data), generator=generator)[:num_samples]
+
+    if isinstance(data, DeviceDataset):
+        images, targets = data.get_batch(indices.to(data.images.device))
+    else:
+        samples = [data[i] for i in indices.tolist()]
+        images = torch.stack([image for image, _ in samples]).to(device)
+        targets = torch.as_tensor([target for _, target in samples]).to(device)
+        # e.g. the normalisation of uint8 images with `--prefetch`
+        device_transform = getattr(val_data, "device_transform", None)
+        if device_transform is not None:
+            images = device_transform(images)
+    return list(zip(images.split(batch_size), targets.split(batch_size)))
+
+
+class _HessianVectorProduct:
+    """
+    v -> H v of the mean loss over `batches`, for flat vectors `v` over all parameters.
+    With `retain_graphs`, the graph of the gradient of every batch is built once and reused
+    by every product, at the cost of keeping it in memory.
+    """
+
+    def __init__(self, model, criterion, batches, retain_graphs):
+        self.model = model
+        self.criterion = criterion
+        self.batches = batches
+        self.retain_graphs = retain_graphs
+        self.params = [p for p in model.parameters() if p.requires_grad]
+        self.num_samples = sum(images.size(0) for images, _ in batches)
+        self._grads = [None] * len(batches)
+
+    @property
+    def dim(self):
+        return sum(p.numel() for p in self.params)
+
+    def _batch_grads(self, i):
+        if self._grads[i] is not None:
+            return self._grads[i]
+        images, targets = self.batches[i]
+        loss = self.criterion(self.model(images), targets)
+        grads = torch.autograd.grad(loss, self.params, create_graph=True)
+        if self.retain_graphs:
+            self._grads[i] = grads
+        return grads
+
+    def __call__(self, v):
+        vs = [
+            t.view_as(p)
+            for t, p in zip(v.split([p.numel() for p in self.params]), self.params)
+        ]
+        hv = torch.zeros_like(v)
+        for i, (images, _) in enumerate(self.batches):
+            grads = self._batch_grads(i)
+            hvs = torch.autograd.grad(
+                grads, self.params, grad_outputs=vs, retain_graph=self.retain_graphs
+            )
+            hv.add_(
+                torch.cat([h.reshape(-1) for h in hvs]),
+                alpha=images.size(0) / self.num_samples,
+            )
+        return hv
+
+
+def _cfg_to_hessian(args):
+    return {
+        "max_iters": args.hessian_iters,
+        "tol": args.hessian_tol,
+        "retain_graphs": args.hessian_retain_graphs,
+        "seed": args.seed,
+    }
+
+
+@configurable(from_config=_cfg_to_hessian)
+def compute_hessian_spectrum(
+    model,
+    criterion,
+    batches,
+    *,
+    num_eigenvalues: int = 5,
+    max_iters: int = 30,
+    tol: float = 1e-3,
+    retain_graphs: bool = False,
+    seed: int = 0,
+):
+    """
+    The `num_eigenvalues` eigenvalues of largest magnitude of the Hessian of the loss over `batches`,
+    ordered by magnitude, by Lanczos iteration with full reorthogonalisation.
+    Stops once the residuals of all of them are below `tol` relative to their magnitude, or after `max_iters`.
+    BatchNorm layers use their running statistics.
+
+    Returns the eigenvalues and `{"iterations": ..., "time (s)": ...}`.
+    """
+    start = time.time()
+    was_training = model.training
+    model.eval()
+    hvp = _HessianVectorProduct(model, criterion, batches, retain_graphs)
+    max_iters = min(max_iters, hvp.dim)
+
+    # the basis (up to `max_iters` model-sized vectors) stays on the CPU, only the current vector is on the device
+    generator = torch.Generator().manual_seed(0 if seed is None else seed)
+    v = torch.randn(hvp.dim, generator=generator).to(hvp.params[0].dtype)
+    basis = [v / v.norm()]
+    alphas, betas = [], []
+    eigenvalues = []
+    for it in range(max_iters):
+        w = hvp(basis[-1].to(hvp.params[0].device)).cpu()
+        alphas.append(torch.dot(w, basis[-1]).item())
+        # full reorthogonalisation, Lanczos loses orthogonality quickly otherwise
+        # (classical Gram-Schmidt, done twice for stability)
+        for _ in range(2):
+            coeffs = [torch.dot(w, b) for b in basis]
+            for coeff, b in zip(coeffs, basis):
+                w.sub_(coeff * b)
+        betas.append(w.norm().item())
+
+        # Ritz values of the tridiagonal matrix and the residual estimates |beta_k * s_k|
+        tridiagonal = (
+            np.diag(alphas) + np.diag(betas[:-1], 1) + np.diag(betas[:-1], -1)
+        )
+        ritz_values, ritz_vectors = np.linalg.eigh(tridiagonal)
+        order = np.argsort(-np.abs(ritz_values))[:num_eigenvalues]
+        eigenvalues = ritz_values[order]
+        residuals = np.abs(betas[-1] * ritz_vectors[-1, order])
+        converged = len(order) == num_eigenvalues and np.all(
+            residuals <= tol * np.maximum(np.abs(eigenvalues), 1e-12)
+        )
+        if converged or betas[-1] == 0 or it == max_iters - 1:
+            break
+        basis.append(w / betas[-1])
+
+    model.train(was_training)
+    return [float(e) for e in eigenvalues], {
+        "iterations": len(alphas),
+        "time (s)": time.time() - start,
+    }
+
+
+class SharpnessProbe:
+    """
+    Online estimate of the top Hessian eigenvalue, by `iters` power-iteration steps every `every` training steps.
+
+    It runs inside the step of a SAM-type optimizer, right after the inner pass: the Hessian-vector products are
+    forward differences `(g(w + r v) - g(w)) / r` that reuse the inner gradient `g(w)`, and every power iteration
+    starts from the eigenvector of the previous probe. Each probe costs `iters` forward/backward passes, i.e.
+    about `iters / (2 * every)` of the training compute of SAM; they are counted in `passes`.
+    The probe passes replay the RNG state of the inner pass (cf. `before_step`), so that both gradients of
+    a difference see the same dropout masks, and leave the RNG state of the training step as they found it.
+    """
+
+    @configurable
+    def __init__(self, every, iters, radius=1e-3) -> None:
+        self.every = every
+        self.iters = iters
+        self.radius = radius
+        self.v = None
+        self.eigenvalues = []
+        self.passes = 0
+        self._next_step = 0
+        self._inner_rng_state = None
+
+    @classmethod
+    def from_config(cls, args):
+        return {
+            "every": args.sharpness_every,
+            "iters": args.sharpness_iters,
+        }
+
+    @property
+    def enabled(self):
+        return self.every > 0 and self.iters > 0
+
+    def before_step(self, step):
+        """
+        Records the RNG state before the inner pass of a step that probes.
+        """
+        if self.enabled and step >= self._next_step:
+            self._inner_rng_state = get_rng_state()
+
+    @torch.no_grad()
+    def __call__(
+        self, optimizer, closure, *, step, model, amp=None, logger=None, **kwargs
+    ):
+        # steps that reuse the perturbation (VASSORE) have no inner gradient, the probe waits for the next one
+        if not self.enabled or step < self._next_step:
+            return
+        self._next_step = step + self.every
+        params = [
+            p
+            for group in optimizer.param_groups
+            for p in group["params"]
+            if p.grad is not None
+        ]
+        inner_grads = [p.grad.clone() for p in params]
+        # the parameters are copied back rather than shifted back by `-radius * v`, which is not exact in floating
+        # point: it would add noise to every probed step, and let DDP replicas drift apart in the local modes
+        # of `--dist_sam`, where `v` differs between the replicas
+        weights = [torch.empty_like(p) for p in params]
+        multi_tensor.copy_(weights, params)
+        # the extra forward passes must not move the BatchNorm statistics
+        buffers = [b.clone() for b in model.buffers()]
+        rng_state = get_rng_state()
+
+        if self.v is None or len(self.v) != len(params):
+            self.v = [torch.randn_like(p) for p in params]
+        multi_tensor.mul_(self.v, 1 / multi_tensor.norm(self.v))
+        sync_grads = getattr(optimizer, "sync_inner_grads", True)
+        eigenvalue = None
+        for _ in range(self.iters):
+            if self._inner_rng_state is not None:
+                set_rng_state(self._inner_rng_state)
+            multi_tensor.add_(params, self.v, alpha=self.radius)
+            with torch.enable_grad():
+                closure(True, True, sync_grads=sync_grads, stage="probe")
+            self.passes += 1
+            multi_tensor.copy_(params, weights)
+            # an overflow of a probe pass only ends the probe, it must not back off the loss scale
+            if not unscale_grads_(
+                amp, optimizer, all_ranks=not sync_grads, record_inf=False
+            ):
+                break
+            hv = [(p.grad - g) / self.radius for p, g in zip(params, inner_grads)]
+            # Rayleigh quotient, `v` has unit norm
+            eigenvalue = multi_tensor.dot(hv, self.v)
+            self.v = multi_tensor.scale(hv, 1 / (multi_tensor.norm(hv) + 1e-16))
+
+        for p, g in zip(params, inner_grads):
+            p.grad.copy_(g)
+        for b, saved in zip(model.buffers(), buffers):
+            b.copy_(saved)
+        set_rng_state(rng_state)
+        self._inner_rng_state = None
+        if eigenvalue is None:
+            return
+        self.eigenvalues.append(eigenvalue)
+        if logger is not None:
+            logger.wandb_log_step(step, **{"lambda_max (probe)": eigenvalue})
+
+    def epoch_summary(self):
+        """
+        Mean and last probed top eigenvalue of the epoch, read with one host sync.
+        """
+        if not self.eigenvalues:
+            return {}
+        eigenvalues = tolist(torch.stack(self.eigenvalues))
+        self.eigenvalues = []
+        return {
+            "lambda_max (probe)": eigenvalues[-1],
+            "lambda_max (probe, mean)": float(np.mean(eigenvalues)),
+        }
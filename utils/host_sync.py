@@ -0,0 +1,82 @@
+import torch
+
+
+class HostSyncCounter:
+    """
+    Counts how often the training step has to wait for the device to hand a value to the host.
+    """
+
+    def __init__(self) -> None:
+        self.syncs = 0
+        self.steps = 0
+
+    def add(self, n=1):
+        self.syncs += n
+
+    def step(self):
+        self.steps += 1
+
+    def reset(self):
+        self.syncs = 0
+        self.steps = 0
+
+
+host_syncs = HostSyncCounter()
+
+
+def item(tensor):
+    """
+    `tensor.item()`, counted in `host_syncs` unless the tensor already lives on the host.
+    """
+    if tensor.device.type != "cpu":
+        host_syncs.add()
+    return tensor.item()
+
+
+def tolist(tensor):
+    """
+    `tensor.tolist()`, counted in `host_syncs` as one sync unless the tensor already lives on the host.
+    """
+    if tensor.device.type != "cpu":
+        host_syncs.add()
+    return tensor.tolist()
+
+
+class LazyHostTensor:
+    """
+    Non-blocking copy of a (small) device tensor to the host.
+    The copy is enqueued right away and only waited for when `get` is called,
+    which costs nothing if the device has already caught up by then.
+    """
+
+    def __init__(self, tensor) -> None:
+        tensor = tensor.detach()
+        self._event = None
+        if tensor.device.type == "cuda":
+            self._host = torch.empty(
+                tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=True
+            )
+            self._host.copy_(tensor, non_blocking=True)
+            self._event = torch.cuda.Event()
+            self._event.record()
+        elif tensor.device.type == "cpu":
+            self._host = tensor.clone()
+        else:
+            host_syncs.add()
+            self._host = tensor.cpu()
+
+    def ready(self):
+        return self._event is None or self._event.query()
+
+    def synchronize(self):
+        """
+        Waits for the copy without counting it as a host sync, for callers off the training thread.
+        """
+        if self._event is not None:
+            self._event.synchronize()
+
+    def get(self):
+        if not self.ready():
+            host_syncs.add()
+            self._event.synchronize()
+        return self._host.tolist()
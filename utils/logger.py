@@ -1,9 +1,15 @@
 import os
+import queue
+import threading
 import time
 
+import torch
+
 from pathlib import Path
 from utils.configurable import configurable
 from utils.dist import is_main_process
+from utils.host_sync import LazyHostTensor
+from utils.metrics_store import ColumnarMetricsStore
 
 try:
     import wandb
@@ -25,6 +31,8 @@ def __init__(
         wandb_name,
         distributed,
         time_fmt,
+        log_flush_steps,
+        metrics_backend,
         args,
     ):
         self.time_fmt = time_fmt
@@ -33,8 +41,15 @@ def __init__(
         self.logger_path = os.path.join(output_dir, output_name)
         # Path(self.logger_path).mkdir(parents=True, exist_ok=True)
 
+        # `self.run` is the metrics backend: a wandb run or a local columnar store
         self.enable_wandb = enable_wandb
-        if enable_wandb:
+        # with `--metrics_backend npz` the store replaces wandb (`--wandb` is not needed) and only rank 0 writes it,
+        # no process opens a wandb run
+        if metrics_backend == "npz":
+            self.run = None
+            if is_main_process():
+                self.run = ColumnarMetricsStore(os.path.join(self.logger_path, "metrics"))
+        elif enable_wandb:
             wandb_dict = {
                 "project": wandb_project,
                 "name": wandb_name,
@@ -43,22 +58,35 @@ def __init__(
                 wandb_dict["group"] = "DDP"
             self.run = wandb.init(**wandb_dict, config=args)
 
-            wandb.define_metric("global_batch_counter")
-            wandb.define_metric("epoch")
-            wandb.define_metric("training_stage_%5")
         else:
             self.run = None
 
+        if self.run is not None:
+            self.run.define_metric("global_batch_counter")
+            self.run.define_metric("epoch")
+            self.run.define_metric("training_stage_%5")
+
+        # per-step metrics buffered by `wandb_log_step` until the next flush
+        self.log_flush_steps = log_flush_steps
+        self._step_buffer = []
+        self._buffered_steps = set()
+        self._flush_queue = None
+        if self.run is not None:
+            self._flush_queue = queue.Queue()
+            threading.Thread(target=self._flush_worker, daemon=True).start()
+
     @classmethod
     def from_config(cls, args):
         return {
             "output_dir": args.output_dir,
             "output_name": args.output_name,
             "enable_wandb": args.wandb and _has_wandb,
+            "metrics_backend": args.metrics_backend,
             "wandb_project": args.wandb_project,
             "wandb_name": args.wandb_name,
             "time_fmt": "%Y-%m-%d %H:%M:%S",
             "distributed": args.distributed,
+            "log_flush_steps": args.log_flush_steps,
             "args": args,
         }
 
@@ -74,24 +102,24 @@ def from_config(cls, args):
     # called from within the constructor of the optimization algorithm class,
     # so from class VaSSO, class SAM, etc.
     def wandb_define_metrics_per_batch(self, custom_metrics):
-        if self.enable_wandb:
+        if self.run is not None:
             for metric in custom_metrics:
-                wandb.define_metric(metric, step_metric="global_batch_counter")
+                self.run.define_metric(metric, step_metric="global_batch_counter")
         else:
             return
 
     # one `training stage` is every 5 epochs
     def wandb_define_metrics_per_training_stage(self, custom_metrics):
-        if self.enable_wandb:
+        if self.run is not None:
             for metric in custom_metrics:
-                wandb.define_metric(metric, step_metric="training_stage_%5")
+                self.run.define_metric(metric, step_metric="training_stage_%5")
         else:
             return
 
     def wandb_define_metrics_per_epoch(self, custom_metrics):
-        if self.enable_wandb:
+        if self.run is not None:
             for metric in custom_metrics:
-                wandb.define_metric(metric, step_metric="epoch")
+                self.run.define_metric(metric, step_metric="epoch")
         else:
             return
 
@@ -113,18 +141,88 @@ def log(self, info, printf=True):
             print(header + str(info) + "\n")
 
     def wandb_log_epoch(self, **stats):
-        if self.enable_wandb:
+        if self.run is not None:
+            self._flush_queue.join()
             self.run.log(stats)
         else:
             return
 
     # this is the same as logging per iteration step
     def wandb_log_batch(self, **stats):
-        if self.enable_wandb:
+        if self.run is not None:
+            self._flush_queue.join()
             self.run.log(stats)
         else:
             return
 
+    def wandb_log_step(self, step, **stats):
+        """
+        Buffered per-step logging: tensor values stay on device until the buffer is flushed,
+        which happens once `log_flush_steps` distinct steps are buffered or on `flush_step_buffer`.
+        All metrics of one step end up in a single `run.log` call with `global_batch_counter=step`.
+        """
+        if self.run is None:
+            return
+        # a step is never split across two flushes
+        if step not in self._buffered_steps and len(self._buffered_steps) >= self.log_flush_steps:
+            self.flush_step_buffer()
+        names = [k for k, v in stats.items() if isinstance(v, torch.Tensor)]
+        values = None
+        if names:
+            values = torch.stack([stats.pop(k).detach().reshape(()).float() for k in names])
+        self._step_buffer.append((step, names, values, stats))
+        self._buffered_steps.add(step)
+
+    def flush_step_buffer(self, wait=False):
+        """
+        Hands the buffered steps to the flush thread: one device-to-host copy per device, no host sync here.
+        """
+        if self.run is None:
+            return
+        if self._step_buffer:
+            entries, self._step_buffer = self._step_buffer, []
+            self._buffered_steps = set()
+            per_device = {}
+            for i, (_, _, values, _) in enumerate(entries):
+                if values is not None:
+                    per_device.setdefault(values.device, []).append(i)
+            transfers = [
+                (indices, LazyHostTensor(torch.cat([entries[i][2] for i in indices])))
+                for indices in per_device.values()
+            ]
+            self._flush_queue.put((entries, transfers))
+        if wait:
+            self._flush_queue.join()
+
+    def _flush_worker(self):
+        while True:
+            entries, transfers = self._flush_queue.get()
+            try:
+                rows = {}
+                host_values = {}
+                for indices, values in transfers:
+                    values.synchronize()
+                    values = iter(values.get())
+                    for i in indices:
+                        host_values[i] = [next(values) for _ in entries[i][1]]
+                for i, (step, names, _, stats) in enumerate(entries):
+                    row = rows.setdefault(step, {})
+                    row.update(stats)
+                    row.update(zip(names, host_values.get(i, [])))
+                for step, row in rows.items():
+                    self.run.log({**row, "global_batch_counter": step})
+            finally:
+                self._flush_queue.task_done()
+
+    def finish(self):
+        """
+        Sends all buffered metrics to the backend and closes it.
+        """
+        if self.run is None:
+            return
+        self.flush_step_buffer(wait=True)
+        self.run.finish()
+
     @is_main_process
     def mv(self, new_name):
         os.system("mv {} {}".format(self.logger_path, new_name))
@@ -0,0 +1,92 @@
+import atexit
+import glob
+import os
+import threading
+
+import numpy as np
+
+# step metrics that decide which table a logged row belongs to
+STEP_METRICS = {
+    "global_batch_counter": "batch",
+    "epoch": "epoch",
+    "training_stage_%5": "stage",
+}
+
+
+class ColumnarMetricsStore:
+    """
+    Drop-in replacement for a wandb run that writes metrics to an append-only columnar store on disk.
+
+    Every logged row goes to the table of the step metric it carries (`batch`, `epoch`, `stage`, or `misc`).
+    Rows are buffered in memory and written out as one `.npz` chunk per `chunk_rows` rows and table,
+    with one float64 column per metric (NaN where a row does not set the metric).
+    Chunks are never rewritten, so a crashed run keeps everything up to its last chunk.
+    """
+
+    def __init__(self, path, chunk_rows=1000) -> None:
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.step_metrics = {}
+        self._tables = {}
+        self._chunks = {}
+        self._lock = threading.Lock()
+        atexit.register(self.finish)
+
+    def define_metric(self, name, step_metric=None):
+        self.step_metrics[name] = step_metric
+
+    def log(self, stats):
+        table = next((t for k, t in STEP_METRICS.items() if k in stats), "misc")
+        row = {}
+        for name, value in stats.items():
+            try:
+                row[name] = float(value)
+            except (TypeError, ValueError):
+                continue
+        with self._lock:
+            rows = self._tables.setdefault(table, [])
+            rows.append(row)
+            if len(rows) >= self.chunk_rows:
+                self._write_chunk(table)
+
+    def finish(self):
+        with self._lock:
+            for table in list(self._tables):
+                self._write_chunk(table)
+
+    def _write_chunk(self, table):
+        rows = self._tables.pop(table, [])
+        if not rows:
+            return
+        names = sorted({name for row in rows for name in row})
+        columns = {
+            name: np.array([row.get(name, np.nan) for row in rows], dtype=np.float64)
+            for name in names
+        }
+        os.makedirs(self.path, exist_ok=True)
+        index = self._chunks.get(table)
+        if index is None:
+            # continue after chunks of an earlier (resumed) run
+            index = len(glob.glob(os.path.join(self.path, f"{table}_*.npz")))
+        np.savez(os.path.join(self.path, f"{table}_{index:05d}.npz"), **columns)
+        self._chunks[table] = index + 1
+
+
+def load_metrics(path, table="batch"):
+    """
+    Loads all chunks of `table` written by a `ColumnarMetricsStore` in `path` as `{metric: np.ndarray}`.
+    """
+    chunks = []
+    for file in sorted(glob.glob(os.path.join(path, f"{table}_*.npz"))):
+        with np.load(file) as chunk:
+            chunks.append({name: chunk[name] for name in chunk.files})
+    names = sorted({name for chunk in chunks for name in chunk})
+    columns = {}
+    for name in names:
+        columns[name] = np.concatenate(
+            [
+                chunk.get(name, np.full(len(next(iter(chunk.values()))), np.nan))
+                for chunk in chunks
+            ]
+        )
+    return columns
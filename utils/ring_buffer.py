@@ -0,0 +1,49 @@
+import torch
+
+from utils.host_sync import host_syncs
+
+
+class DeviceRingBuffer:
+    """
+    Fixed-size buffer of per-step scalar rows that stays on device.
+    Rows are written without any host synchronisation and read back in a single transfer by `drain`.
+    """
+
+    def __init__(self, names, capacity, device, dtype=torch.float32) -> None:
+        assert capacity > 0, "capacity must be positive"
+        self.names = list(names)
+        self.capacity = capacity
+        self.buffer = torch.zeros(capacity, len(self.names), device=device, dtype=dtype)
+        self.steps = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def full(self):
+        return len(self.steps) == self.capacity
+
+    def append(self, step, values):
+        assert not self.full(), "drain the buffer before appending to it"
+        row = torch.stack(
+            [
+                torch.as_tensor(v).to(self.buffer.device, self.buffer.dtype)
+                for v in values
+            ]
+        )
+        self.buffer[len(self.steps)].copy_(row)
+        self.steps.append(step)
+
+    def drain(self):
+        """
+        Returns the buffered rows as a list of `(step, {name: value})` and empties the buffer.
+        """
+        if not self.steps:
+            return []
+        if self.buffer.device.type != "cpu":
+            host_syncs.add()
+        rows = self.buffer[: len(self.steps)].tolist()
+        drained = [
+            (step, dict(zip(self.names, row))) for step, row in zip(self.steps, rows)
+        ]
+        self.steps = []
+        return drained
@@ -11,4 +11,18 @@ def setup_seed(args):
     torch.cuda.manual_seed_all(seed)
     torch.cuda.manual_seed(seed)
     np.random.seed(seed)
-    random.seed(seed)
\ No newline at end of file
+    random.seed(seed)
+
+
+def get_rng_state():
+    cuda_state = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    return torch.get_rng_state(), cuda_state, np.random.get_state(), random.getstate()
+
+
+def set_rng_state(state):
+    torch_state, cuda_state, np_state, random_state = state
+    torch.set_rng_state(torch_state)
+    if cuda_state is not None:
+        torch.cuda.set_rng_state_all(cuda_state)
+    np.random.set_state(np_state)
+    random.setstate(random_state)
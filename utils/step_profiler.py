@@ -0,0 +1,152 @@
+import contextlib
+import functools
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+from utils.configurable import configurable
+from utils.device import device
+
+PERCENTILES = [50, 90, 99]
+
+
+class StepProfiler:
+    """
+    Times the phases of every training step: data wait, inner forward/backward, `first_step`,
+    outer forward/backward, `second_step`, the passes of the sharpness probe and logging, plus the whole step.
+
+    On CUDA the phases are timed with CUDA events on the device timeline, elsewhere with `perf_counter`.
+    Timings are only read back by `epoch_summary`, so profiling adds no host syncs to the steps.
+    """
+
+    @configurable
+    def __init__(self, enabled, device_type) -> None:
+        self.enabled = enabled
+        self.use_events = enabled and device_type == "cuda"
+        # set by the watched `first_step`, tells the closure whether it runs the inner or the outer pass
+        self.perturbed = False
+        self._step = 0
+        self._timings = []
+        self.epochs = []
+
+    @classmethod
+    def from_config(cls, args):
+        return {
+            "enabled": args.profile_steps,
+            "device_type": torch.device(device).type,
+        }
+
+    def _timestamp(self):
+        if self.use_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = self._timestamp()
+        try:
+            yield
+        finally:
+            self._timings.append((self._step, name, start, self._timestamp()))
+
+    def iterate(self, iterable, name="data"):
+        """
+        Yields from `iterable`, timing every `next` as phase `name`.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            yield batch
+
+    def step(self):
+        if not self.enabled:
+            return
+        self._step += 1
+        self.perturbed = False
+
+    def watch(self, optimizer):
+        """
+        Times `first_step` and `second_step` of a SAM-type optimizer, wherever its `step` calls them.
+        """
+        if not self.enabled or not hasattr(optimizer, "first_step"):
+            return
+        if getattr(optimizer, "_step_profiler", None) is self:
+            return
+        optimizer._step_profiler = self
+
+        def timed(name, method):
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    out = method(*args, **kwargs)
+                if name == "first_step":
+                    self.perturbed = True
+                return out
+
+            return wrapper
+
+        for name in ["first_step", "second_step"]:
+            setattr(optimizer, name, timed(name, getattr(optimizer, name)))
+
+    def epoch_summary(self):
+        """
+        Statistics of the phase times of the steps since the last call, in ms.
+        """
+        if not self.enabled or not self._timings:
+            return {}
+        if self.use_events:
+            torch.cuda.synchronize()
+        # NaN for steps that did not run a phase, the `next` ending the epoch is past the last step
+        num_steps = max(self._step, 1)
+        times = defaultdict(lambda: np.full(num_steps + 1, np.nan))
+        for step, name, start, end in self._timings:
+            if self.use_events:
+                elapsed = start.elapsed_time(end)
+            else:
+                elapsed = (end - start) * 1e3
+            times[name][step] = np.nan_to_num(times[name][step]) + elapsed
+        self.epochs.append(
+            (num_steps, {name: step_times[:num_steps] for name, step_times in times.items()})
+        )
+        self._timings = []
+        self._step = 0
+        return _phase_statistics(self.epochs[-1:])
+
+    def run_summary(self):
+        """
+        Statistics of the phase times over all epochs, in ms.
+        """
+        return _phase_statistics(self.epochs)
+
+
+def _phase_statistics(epochs):
+    """
+    Per phase: its mean time per step, and percentiles over the steps that ran it
+    (e.g. reuse steps of VASSORE have no inner pass).
+    """
+    num_steps = sum(epoch_steps for epoch_steps, _ in epochs)
+    names = list(dict.fromkeys(name for _, times in epochs for name in times))
+    stats = {}
+    for name in names:
+        step_times = np.concatenate([times[name] for _, times in epochs if name in times])
+        ran = step_times[~np.isnan(step_times)]
+        if len(ran) == 0:
+            continue
+        stats[f"{name} ms/step"] = ran.sum() / num_steps
+        for q, value in zip(PERCENTILES, np.percentile(ran, PERCENTILES)):
+            stats[f"{name} ms (p{q})"] = value
+    return stats
+
+
+null_profiler = StepProfiler(enabled=False, device_type="cpu")
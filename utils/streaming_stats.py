@@ -0,0 +1,75 @@
+import numpy as np
+from scipy.stats import beta, spearmanr
+
+
+class StreamingCorrelation:
+    """
+    Online correlation statistics of a stream of rows `{name: value}`.
+
+    Pearson correlations come from Welford-style running means and co-moments, so every update is O(1)
+    in the number of rows seen. Spearman correlations are computed on a uniform reservoir sample of at
+    most `reservoir_size` rows. Rows containing non-finite values are skipped.
+    """
+
+    def __init__(self, names, reservoir_size=4096, seed=0) -> None:
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.reservoir_size = reservoir_size
+        self.rng = np.random.default_rng(seed)
+        self.reset()
+
+    def reset(self):
+        k = len(self.names)
+        self.n = 0
+        self.mean = np.zeros(k)
+        self.comoment = np.zeros((k, k))
+        self.reservoir = np.empty((self.reservoir_size, k))
+
+    def __len__(self):
+        return self.n
+
+    def update(self, row):
+        x = np.array([row[name] for name in self.names], dtype=np.float64)
+        if not np.all(np.isfinite(x)):
+            return
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.comoment += np.outer(delta, x - self.mean)
+
+        # reservoir sampling (Algorithm R)
+        if self.n <= self.reservoir_size:
+            self.reservoir[self.n - 1] = x
+        else:
+            j = self.rng.integers(self.n)
+            if j < self.reservoir_size:
+                self.reservoir[j] = x
+
+    def pearson(self, a, b):
+        """
+        Returns the Pearson correlation of columns `a` and `b` and its two-sided p-value, as `scipy.stats.pearsonr`.
+        """
+        if self.n < 2:
+            return np.nan, np.nan
+        i, j = self.index[a], self.index[b]
+        denom = np.sqrt(self.comoment[i, i] * self.comoment[j, j])
+        if denom == 0:
+            return np.nan, np.nan
+        r = float(np.clip(self.comoment[i, j] / denom, -1.0, 1.0))
+        if self.n == 2:
+            return r, 1.0
+        # exact distribution of r under independence, cf. scipy.stats.pearsonr
+        ab = self.n / 2 - 1
+        p = float(2 * beta.cdf(-abs(r), ab, ab, loc=-1, scale=2))
+        return r, p
+
+    def spearman(self, a, b):
+        """
+        Returns the Spearman correlation of columns `a` and `b` and its p-value, estimated on the reservoir.
+        """
+        m = min(self.n, self.reservoir_size)
+        if m < 2:
+            return np.nan, np.nan
+        i, j = self.index[a], self.index[b]
+        rho, p = spearmanr(self.reservoir[:m, i], self.reservoir[:m, j])
+        return float(rho), float(p)